@@ -1,8 +1,12 @@
-import openai
-import asyncio
 import json
-import os
 import logging
+from typing import AsyncIterator
+from cache_mdl import TieredCache, make_key, normalize_text
+from scheduler_mdl import QueueFull
+from singleflight_mdl import SingleFlight
+from openai_client_mdl import ANSWER_TIMEOUT
+from router_mdl import model_router, complete_task, stream_task
+from config_mdl import get_setting
 
 # Настраиваем логирование, чтобы видеть, что происходит
 logging.basicConfig(
@@ -10,60 +14,103 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-# Читаем API ключ для OpenAI из JSON файла
-def load_openai_api_key():
-    api_keys_path = os.path.join('api_keys', 'api_keys.json')
-    try:
-        with open(api_keys_path, 'r') as file:
-            data = json.load(file)
-            return data['openai_api_key']
-    except FileNotFoundError:
-        logging.error("Не нашёл api_keys.json в папке api_keys")
-        raise
-    except KeyError:
-        logging.error("В api_keys.json нет ключа openai_api_key")
-        raise
-    except json.JSONDecodeError:
-        logging.error("Не смог разобрать JSON в api_keys.json")
-        raise
-
-# Создаём клиент для OpenAI
-client = openai.OpenAI(
-    api_key=load_openai_api_key(),
-    base_url="https://openrouter.ai/api/v1",
+SYSTEM_PROMPT = """
+                        Ты умный помощник. Отвечай кратко и по делу.
+                        Не добавляй HTML или Markdown, только чистый текст.
+                        """
+
+# Кэш ответов: одинаковые вопросы не гоняем в модель заново
+answer_cache = TieredCache(
+    "answers",
+    max_items=int(get_setting("ANSWER_CACHE_SIZE", "2000")),
+    ttl=float(get_setting("ANSWER_CACHE_TTL", str(24 * 3600))),
 )
 
+# Сколько раз мимо кэша прошли вопросы с контекстом разговора
+context_bypasses = 0
+
+# context - предыдущие сообщения разговора. Ключ с контекстом нужен только для схлопывания одинаковых
+# одновременных запросов: в кэш ответов такие ответы не попадают
+def answer_cache_key(query: str, context: list[dict] | None = None) -> str:
+    # Ответы разных моделей не различаем, но смена списка моделей сбрасывает кэш
+    parts = [model_router.signature("answer"), SYSTEM_PROMPT, normalize_text(query)]
+    if context:
+        parts.append(json.dumps(context, ensure_ascii=False, sort_keys=True))
+    return make_key(*parts)
+
+# Кэш покрывает только вопросы без контекста. Ответ с историей зависит от всей истории, такой ключ
+# почти никогда не повторяется: он бы только вытеснял полезные записи и занижал долю попаданий
+async def get_cached_answer(query: str, context: list[dict] | None = None) -> str | None:
+    global context_bypasses
+    if context:
+        context_bypasses += 1
+        return None
+    return await answer_cache.get(answer_cache_key(query))
+
+async def store_answer(query: str, answer: str, context: list[dict] | None = None):
+    if not context:
+        await answer_cache.set(answer_cache_key(query), answer)
+
+def get_cache_stats() -> dict:
+    return {**answer_cache.stats(), "context_bypasses": context_bypasses}
+
+# Схлопывание одинаковых запросов, которые идут одновременно
+answer_flight = SingleFlight("answer")
+
+def build_messages(query: str, context: list[dict] | None = None) -> list[dict]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        *(context or []),
+        {"role": "user", "content": query},
+    ]
+
 # Функция для обработки вопросов через OpenAI
-async def answer_question(query: str) -> tuple[str, bool]:
+# refresh=True - не смотрим в кэш, а спрашиваем модель и обновляем запись.
+# cache_checked=True - вызывающий уже смотрел в кэш и промахнулся, второй раз не смотрим (и не считаем)
+async def answer_question(query: str, refresh: bool = False, context: list[dict] | None = None,
+                          cache_checked: bool = False) -> tuple[str, bool]:
     # Проверяем, есть ли вообще вопрос
     if not query:
         return "Напиши вопрос после 'Ask', пожалуйста.", False
 
+    if not refresh and not cache_checked:
+        cached = await get_cached_answer(query, context)
+        if cached is not None:
+            logging.info("Ответ взят из кэша")
+            return cached, True
+
     try:
-        # Отправляем запрос к OpenAI
-        response = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: client.chat.completions.create(
-                model="nousresearch/deephermes-3-mistral-24b-preview:free",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
-                        Ты умный помощник. Отвечай кратко и по делу.
-                        Не добавляй HTML или Markdown, только чистый текст.
-                        """
-                    },
-                    {"role": "user", "content": query},
-                ],
-                temperature=0.4,
-                stream=False,
-                max_completion_tokens=10000
-            )
-        )
-
-        # Берём ответ
-        answer = response.choices[0].message.content.strip()
+        # Одинаковые вопросы, заданные одновременно, ждут один общий запрос
+        answer = await answer_flight.do(answer_cache_key(query, context), lambda: _request_answer(query, context))
         return answer, True
 
+    except QueueFull as e:
+        return str(e), False
     except Exception as e:
-        return f"Что-то пошло не так с вопросом: {str(e)}", False
\ No newline at end of file
+        return f"Что-то пошло не так с вопросом: {str(e)}", False
+
+async def _request_answer(query: str, context: list[dict] | None = None) -> str:
+    # Спрашиваем первую здоровую модель из маршрута "answer", дождавшись своей очереди
+    answer = await complete_task(
+        "answer", build_messages(query, context), temperature=0.4, max_tokens=10000, timeout=ANSWER_TIMEOUT
+    )
+    await store_answer(query, answer, context)
+    return answer
+
+# Отдаём ответ по кусочкам, как только модель их генерирует.
+# Одинаковые вопросы, заданные одновременно, читают один общий поток
+def stream_answer(query: str, context: list[dict] | None = None) -> AsyncIterator[str]:
+    return answer_flight.stream(answer_cache_key(query, context), lambda: _stream_answer(query, context))
+
+# В кэш ответ попадает, только если поток дочитали до конца
+async def _stream_answer(query: str, context: list[dict] | None = None) -> AsyncIterator[str]:
+    parts = []
+    # Слот бэкенда держим, пока читаем поток; до первого куска можно переключиться на запасную модель
+    async for delta in stream_task(
+        "answer", build_messages(query, context), temperature=0.4, max_tokens=10000, timeout=ANSWER_TIMEOUT
+    ):
+        parts.append(delta)
+        yield delta
+    answer = "".join(parts).strip()
+    if answer:
+        await store_answer(query, answer, context)
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from config_mdl import get_setting
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Раскодирование и нарезка голосовых - работа для CPU, делаем её в отдельных процессах.
+# Модуль специально лёгкий: его импортируют процессы пула
+AUDIO_DECODE_WORKERS = int(get_setting("AUDIO_DECODE_WORKERS", "2"))
+
+# Распознавателям речи хватает моно 16 кГц, 16 бит
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+
+# Нарезка по паузам: пауза от стольких мс, тише среднего уровня записи на столько дБ
+MIN_SILENCE_MS = 400
+SILENCE_BELOW_AVERAGE_DB = 16
+# Сколько тишины оставляем по краям куска, чтобы не обрезать слова
+KEEP_SILENCE_MS = 200
+# Соседние фразы склеиваем в куски примерно такой длины; длиннее MAX режем без паузы
+TARGET_CHUNK_MS = int(get_setting("VOICE_CHUNK_SECONDS", "15")) * 1000
+MAX_CHUNK_MS = 30 * 1000
+# Шаг поиска пауз: точнее не нужно, а по 1 мс на длинной записи слишком медленно
+SEEK_STEP_MS = 10
+
+_pool = None
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, а не fork: в процессе бота уже крутятся потоки (запись в базу, executor)
+        _pool = ProcessPoolExecutor(max_workers=AUDIO_DECODE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+# Границы кусков (начало, конец) в мс: фразы между паузами, склеенные до TARGET_CHUNK_MS
+def chunk_ranges(speech: list[tuple[int, int]], duration: int,
+                 target_ms: int = TARGET_CHUNK_MS, max_ms: int = MAX_CHUNK_MS) -> list[tuple[int, int]]:
+    chunks = []
+    current = None
+    for start, end in speech:
+        start, end = max(0, start - KEEP_SILENCE_MS), min(duration, end + KEEP_SILENCE_MS)
+        if current is not None and end - current[0] <= target_ms:
+            current = (current[0], end)
+            continue
+        if current is not None:
+            chunks.append(current)
+        # Фраза без пауз длиннее MAX - режем как есть
+        while end - start > max_ms:
+            chunks.append((start, start + max_ms))
+            start += max_ms
+        current = (start, end)
+    if current is not None:
+        chunks.append(current)
+    return chunks
+
+# Раскодируем запись (OGG/Opus, MP3 и т.д. через ffmpeg; WAV - без него), приводим к моно 16 кГц
+# и режем по паузам. Возвращаем [(начало в мс, сырые 16-битные сэмплы)]
+def _decode_and_split_sync(audio_data: bytes, audio_format: str | None) -> list[tuple[int, bytes]]:
+    from pydub import AudioSegment
+    from pydub.silence import detect_nonsilent
+
+    audio = AudioSegment.from_file(BytesIO(audio_data), format=audio_format)
+    audio = audio.set_channels(1).set_frame_rate(SAMPLE_RATE).set_sample_width(SAMPLE_WIDTH)
+    if audio.dBFS == float("-inf"):
+        # Полная тишина
+        return []
+    speech = detect_nonsilent(
+        audio,
+        min_silence_len=MIN_SILENCE_MS,
+        silence_thresh=audio.dBFS - SILENCE_BELOW_AVERAGE_DB,
+        seek_step=SEEK_STEP_MS,
+    )
+    return [(start, audio[start:end].raw_data) for start, end in chunk_ranges(speech, len(audio))]
+
+# Готовим голосовое к распознаванию в пуле процессов, не занимая цикл событий
+async def decode_and_split(audio_data: bytes, audio_format: str | None = None) -> list[tuple[int, bytes]]:
+    chunks = await asyncio.get_running_loop().run_in_executor(
+        _get_pool(), _decode_and_split_sync, audio_data, audio_format
+    )
+    logging.info(f"Раскодировал голосовое: {len(audio_data)} байт -> кусков {len(chunks)}")
+    return chunks
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
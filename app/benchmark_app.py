@@ -0,0 +1,273 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from fake_services_mdl import run_fake_services
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Бенчмарк бота без живых сервисов: поднимаем заглушки OpenRouter, pollinations и Telegram,
+# прогоняем синтетические апдейты через настоящий диспетчер и печатаем пропускную способность,
+# p50/p99 по обработчикам и пик памяти. С --baseline работает как проверка на регрессию.
+
+TOPICS = [
+    "python", "черные дыры", "фотосинтез", "блокчейн", "римская империя", "квантовые компьютеры",
+    "нейросети", "вулканы", "ДНК", "инфляция", "теория относительности", "SQL индексы",
+    "асинхронность", "TCP", "компиляторы", "океанские течения", "пчёлы", "электромобили",
+]
+QUESTION_TEMPLATES = ["что такое {}?", "как работает {}?", "почему важна тема {}?", "расскажи про {}"]
+IMAGE_TEMPLATES = ["нарисуй {}", "сгенерируй картинку с темой {}"]
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ("text", "image", "photo", "callback"):
+            raise argparse.ArgumentTypeError(f"Неизвестный тип апдейта: {name}")
+        mix[name] = float(weight)
+    return mix
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк AI YALY бота")
+    parser.add_argument("--updates", type=int, default=1000, help="Сколько апдейтов прогнать")
+    parser.add_argument("--concurrency", type=int, default=64, help="Сколько апдейтов обрабатывается одновременно")
+    parser.add_argument("--users", type=int, default=200, help="Сколько разных пользователей")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("text=70,image=10,photo=10,callback=10"),
+                        help="Доли типов апдейтов: text, image, photo, callback")
+    parser.add_argument("--unique-queries", type=int, default=500,
+                        help="Сколько разных запросов (меньше - больше попаданий в кэши)")
+    parser.add_argument("--seed", type=int, default=1)
+    # Задержки заглушек: fixed:S, uniform:A:B, exp:MEAN, lognormal:MEDIAN:SIGMA
+    parser.add_argument("--openrouter-latency", default="lognormal:0.3:0.5")
+    parser.add_argument("--openrouter-errors", type=float, default=0.0)
+    parser.add_argument("--stream-chunk-delay", type=float, default=0.01)
+    parser.add_argument("--pollinations-latency", default="lognormal:0.5:0.5")
+    parser.add_argument("--pollinations-errors", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", default="uniform:0.02:0.08")
+    parser.add_argument("--telegram-errors", type=float, default=0.0)
+    parser.add_argument("--unlimited-backends", action="store_true",
+                        help="Снять лимиты планировщика, чтобы мерить накладные расходы самого бота")
+    parser.add_argument("--tracemalloc", action="store_true", help="Считать пик памяти Python-объектов (медленнее)")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", dest="json_path", help="Сохранить отчёт в JSON")
+    parser.add_argument("--baseline", help="Отчёт JSON, с которым сравниваем")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Допустимое ухудшение относительно baseline")
+    parser.add_argument("--keep-workdir", action="store_true")
+    return parser.parse_args()
+
+# Готовим синтетический поток апдейтов (словари в формате Bot API)
+def build_updates(args: argparse.Namespace) -> list[dict]:
+    rng = random.Random(args.seed)
+    kinds = list(args.mix)
+    weights = [args.mix[kind] for kind in kinds]
+    next_message_id = {}
+    questions = {}
+    updates = []
+
+    for update_id in range(1, args.updates + 1):
+        user_id = 1000 + rng.randrange(args.users)
+        message_id = next_message_id.get(user_id, 1)
+        next_message_id[user_id] = message_id + 1
+        user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+        chat = {"id": user_id, "type": "private"}
+        topic_number = rng.randrange(args.unique_queries)
+        topic = f"{TOPICS[topic_number % len(TOPICS)]} {topic_number // len(TOPICS) or ''}".strip()
+        kind = rng.choices(kinds, weights)[0]
+
+        if kind == "callback" and questions.get(user_id):
+            question_id = rng.choice(questions[user_id])
+            action = rng.choice(["regenerate", "explain"])
+            updates.append({
+                "update_id": update_id,
+                "callback_query": {
+                    "id": str(update_id),
+                    "from": user,
+                    "chat_instance": str(user_id),
+                    "data": f"{action}_{question_id}",
+                    "message": {"message_id": 10**6 + question_id, "date": 0, "chat": chat,
+                                "from": {"id": 123, "is_bot": True, "first_name": "Bench"}, "text": "ответ"},
+                },
+            })
+            continue
+
+        message = {"message_id": message_id, "date": int(time.time()), "chat": chat, "from": user}
+        if kind == "photo":
+            file_id = f"photo{topic_number}"
+            message["photo"] = [
+                {"file_id": f"{file_id}-s", "file_unique_id": f"{file_id}-s", "width": 320, "height": 240},
+                {"file_id": f"{file_id}-m", "file_unique_id": f"{file_id}-m", "width": 800, "height": 600},
+                {"file_id": f"{file_id}-x", "file_unique_id": f"{file_id}-x", "width": 1280, "height": 960},
+            ]
+        elif kind == "image":
+            message["text"] = rng.choice(IMAGE_TEMPLATES).format(topic)
+        else:
+            message["text"] = rng.choice(QUESTION_TEMPLATES).format(topic)
+            questions.setdefault(user_id, []).append(message_id)
+        updates.append({"update_id": update_id, "message": message})
+    return updates
+
+# Готовим рабочую папку с фиктивными ключами и направляем бота на заглушки
+def prepare_environment(ports: dict) -> str:
+    workdir = tempfile.mkdtemp(prefix="yaly-bench-")
+    os.makedirs(os.path.join(workdir, "api_keys"))
+    with open(os.path.join(workdir, "api_keys", "api_keys.json"), "w") as file:
+        json.dump({"telegram_api_token": "123456:BENCHMARK", "openai_api_key": "benchmark"}, file)
+    os.chdir(workdir)
+    os.environ["OPENROUTER_BASE_URL"] = f"http://127.0.0.1:{ports['openrouter']}"
+    os.environ["POLLINATIONS_TEXT_URL"] = f"http://127.0.0.1:{ports['pollinations']}/"
+    os.environ["POLLINATIONS_IMAGE_URL"] = f"http://127.0.0.1:{ports['pollinations']}/"
+    os.environ.setdefault("STORAGE_BACKEND", "local")
+    return workdir
+
+async def replay(args: argparse.Namespace, updates: list[dict], telegram_port: int) -> dict:
+    # Модули бота импортируем только после того, как окружение направлено на заглушки
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import Update
+    import main_app
+    import metrics_mdl
+    import scheduler_mdl
+
+    metrics_mdl.RESERVOIR_SIZE = max(metrics_mdl.RESERVOIR_SIZE, len(updates))
+    if args.unlimited_backends:
+        for scheduler in scheduler_mdl.schedulers.values():
+            scheduler.concurrency = scheduler.max_queue = 10**6
+            scheduler.rate = scheduler.burst = scheduler._tokens = 10**6
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{telegram_port}"))
+    bot = main_app.create_bot(session=session)
+    main_app.open_database()
+    await main_app.train_from_db(main_app.db)
+    parsed = [Update.model_validate(update, context={"bot": bot}) for update in updates]
+
+    failures = {}
+    queue = asyncio.Queue()
+    for update in parsed:
+        queue.put_nowait(update)
+
+    async def worker():
+        while not queue.empty():
+            update = queue.get_nowait()
+            try:
+                await main_app.dp.feed_update(bot, update)
+            except Exception as e:
+                failures[type(e).__name__] = failures.get(type(e).__name__, 0) + 1
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    await main_app.db.flush()
+    duration = time.perf_counter() - started
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+
+    summary = metrics_mdl.get_latency_summary()
+    errors = {
+        "/".join(filter(None, key)): value
+        for key, value in metrics_mdl.errors_total._values.items()
+    }
+    await main_app.shutdown()
+    return {
+        "updates": len(updates),
+        "duration_s": duration,
+        "updates_per_sec": len(updates) / duration if duration else 0.0,
+        "handlers": summary["handlers"],
+        "stages": summary["stages"],
+        "backends": summary["backends"],
+        "errors": errors,
+        "unhandled_exceptions": failures,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "traced_peak_mb": traced_peak / 1024 / 1024 if traced_peak is not None else None,
+    }
+
+def print_report(report: dict):
+    print(f"\nАпдейтов: {report['updates']} за {report['duration_s']:.2f} с -> {report['updates_per_sec']:.1f} апдейтов/с")
+    print(f"Пик памяти (RSS): {report['max_rss_mb']:.1f} МБ", end="")
+    if report["traced_peak_mb"] is not None:
+        print(f", Python-объекты: {report['traced_peak_mb']:.1f} МБ", end="")
+    print()
+    for title, section in (("Обработчики", "handlers"), ("Этапы", "stages"), ("Бэкенды", "backends")):
+        print(f"\n{title}:")
+        print(f"  {'имя':<36}{'кол-во':>8}{'p50, мс':>10}{'p99, мс':>10}")
+        for name, values in sorted(report[section].items()):
+            print(f"  {name:<36}{values['count']:>8}{values['p50'] * 1000:>10.1f}{values['p99'] * 1000:>10.1f}")
+    if report["errors"] or report["unhandled_exceptions"]:
+        print(f"\nОшибки: {report['errors']}, не пойманы обработчиками: {report['unhandled_exceptions']}")
+    print(f"\nВызовы заглушек: {json.dumps(report['fakes'], ensure_ascii=False)}")
+
+# Сравниваем с прошлым отчётом: пропускная способность не ниже, p99 обработчиков не выше (с допуском)
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    problems = []
+    if report["updates_per_sec"] < baseline["updates_per_sec"] * (1 - tolerance):
+        problems.append(f"апдейтов/с: {report['updates_per_sec']:.1f} < {baseline['updates_per_sec']:.1f}")
+    for name, values in baseline["handlers"].items():
+        current = report["handlers"].get(name)
+        if current and current["p99"] > values["p99"] * (1 + tolerance):
+            problems.append(f"p99 {name}: {current['p99'] * 1000:.1f} мс > {values['p99'] * 1000:.1f} мс")
+    return problems
+
+def main():
+    args = parse_args()
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+
+    # Заглушки живут в отдельном процессе
+    config = {
+        "openrouter": {"behavior": {"latency": args.openrouter_latency, "error_rate": args.openrouter_errors},
+                       "options": {"chunk_delay": args.stream_chunk_delay}},
+        "pollinations": {"behavior": {"latency": args.pollinations_latency, "error_rate": args.pollinations_errors}},
+        "telegram": {"behavior": {"latency": args.telegram_latency, "error_rate": args.telegram_errors}},
+    }
+    context = multiprocessing.get_context("spawn")
+    parent_connection, child_connection = context.Pipe()
+    fakes = context.Process(target=run_fake_services, args=(config, child_connection), name="fake-services")
+    fakes.start()
+    ports = parent_connection.recv()
+
+    workdir = prepare_environment(ports)
+    logging.getLogger().setLevel(args.log_level)
+    try:
+        updates = build_updates(args)
+        report = asyncio.run(replay(args, updates, ports["telegram"]))
+    finally:
+        parent_connection.send("stop")
+        fake_stats = parent_connection.recv()
+        fakes.join()
+        os.chdir(app_dir)
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report["fakes"] = fake_stats
+    report["config"] = {key: value for key, value in vars(args).items() if key not in ("baseline", "json_path")}
+    print_report(report)
+    if json_path:
+        with open(json_path, "w") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+    if baseline_path:
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+        problems = compare_with_baseline(report, baseline, args.tolerance)
+        if problems:
+            print("\nРегрессия относительно baseline:\n  " + "\n  ".join(problems))
+            sys.exit(1)
+        print("\nРегрессий относительно baseline нет")
+
+if __name__ == '__main__':
+    main()
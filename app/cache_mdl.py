@@ -0,0 +1,319 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from storage_mdl import StorageError, is_shared, namespaced
+from metrics_mdl import registry
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+CACHE_DB_PATH = "cache.db"
+
+# Нормализуем текст для ключа: регистр, пробелы, пунктуация, ё -> е
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).lower().replace("ё", "е")
+    text = "".join(" " if unicodedata.category(char).startswith("P") else char for char in text)
+    return " ".join(text.split())
+
+# Ключ кэша - хэш от всех частей (модель, системный промпт, запрос и т.д.)
+def make_key(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+# Кэш в памяти: LRU с ограничением по размеру и временем жизни записей
+class LRUCache:
+    def __init__(self, max_items: int = 1000, ttl: float = 3600):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._items[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value, ttl: float | None = None):
+        self._items[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: str):
+        self._items.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+# Постоянный уровень кэша в SQLite, чтобы кэш переживал перезапуск
+class SQLiteCacheTier:
+    def __init__(self, table: str, db_path: str = CACHE_DB_PATH, max_rows: int = 100000):
+        self.table = table
+        self.max_rows = max_rows
+        self.evictions = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires REAL NOT NULL
+                )
+            """)
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_expires ON {table} (expires)")
+
+    def _get_sync(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    def _set_sync(self, key: str, value: str, ttl: float):
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl)
+            )
+            self._writes += 1
+            # Время от времени чистим просроченное и лишнее
+            if self._writes % 500 == 0:
+                self._prune()
+
+    def _prune(self):
+        self._conn.execute(f"DELETE FROM {self.table} WHERE expires < ?", (time.time(),))
+        excess = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0] - self.max_rows
+        if excess > 0:
+            self._conn.execute(f"""
+                DELETE FROM {self.table} WHERE key IN (
+                    SELECT key FROM {self.table} ORDER BY expires ASC LIMIT ?
+                )
+            """, (excess,))
+            self.evictions += excess
+
+    def _delete_sync(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    async def get(self, key: str) -> str | None:
+        return await asyncio.to_thread(self._get_sync, key)
+
+    async def set(self, key: str, value: str, ttl: float):
+        await asyncio.to_thread(self._set_sync, key, value, ttl)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._delete_sync, key)
+
+# Все двухуровневые кэши процесса - для /metrics
+_tiered_caches = []
+
+# Двухуровневый кэш: сначала память, потом диск (или общее хранилище, если STORAGE_BACKEND=redis).
+# Постоянный уровень открывается при первом обращении, а не при импорте модуля
+class TieredCache:
+    def __init__(self, name: str, max_items: int = 1000, ttl: float = 3600, persistent: bool = True):
+        self.name = name
+        self.ttl = ttl
+        self.memory = LRUCache(max_items=max_items, ttl=ttl)
+        _tiered_caches.append(self)
+        self._persistent_wanted = persistent
+        self.persistent = None
+        self.persistent_hits = 0
+
+    def _get_persistent(self):
+        if self._persistent_wanted:
+            self._persistent_wanted = False
+            if is_shared():
+                # Кэш общий для всех процессов и хостов
+                self.persistent = namespaced(f"cache:{self.name}")
+            else:
+                try:
+                    self.persistent = SQLiteCacheTier(table=f"cache_{self.name}")
+                except sqlite3.Error as e:
+                    logging.error(f"Не смог открыть постоянный кэш {self.name}, работаю только в памяти: {str(e)}")
+        return self.persistent
+
+    async def get(self, key: str) -> str | None:
+        value = self.memory.get(key)
+        if value is not None or self._get_persistent() is None:
+            return value
+        try:
+            value = await self.persistent.get(key)
+        except (sqlite3.Error, StorageError) as e:
+            logging.error(f"Ошибка чтения кэша {self.name}: {str(e)}")
+            return None
+        if value is not None:
+            # Поднимаем запись в память, чтобы следующий раз было быстрее
+            self.persistent_hits += 1
+            self.memory.set(key, value)
+        return value
+
+    async def set(self, key: str, value: str):
+        self.memory.set(key, value)
+        if self._get_persistent() is not None:
+            try:
+                await self.persistent.set(key, value, self.ttl)
+            except (sqlite3.Error, StorageError) as e:
+                logging.error(f"Ошибка записи кэша {self.name}: {str(e)}")
+
+    async def delete(self, key: str):
+        self.memory.delete(key)
+        if self._get_persistent() is not None:
+            try:
+                await self.persistent.delete(key)
+            except (sqlite3.Error, StorageError) as e:
+                logging.error(f"Ошибка удаления из кэша {self.name}: {str(e)}")
+
+    def stats(self) -> dict:
+        memory = self.memory.stats()
+        hits = memory["hits"] + self.persistent_hits
+        # Промах памяти, найденный на диске, - это попадание
+        misses = memory["misses"] - self.persistent_hits
+        lookups = hits + misses
+        return {
+            **memory,
+            "hits": hits,
+            "misses": misses,
+            "memory_hits": memory["hits"],
+            "persistent_hits": self.persistent_hits,
+            "persistent_evictions": self.persistent.evictions if self.persistent else 0,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+        }
+
+# Кэш бинарных данных на диске: файлы лежат по хэшу содержимого, старые удаляются по размеру.
+# Папка создаётся и обходится при первом обращении, а не при импорте модуля
+class DiskBlobCache:
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._total_bytes = None
+
+    # Вызывается из потока: обход папки на большом кэше небыстрый
+    def _ensure_ready(self):
+        with self._lock:
+            if self._total_bytes is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._total_bytes = sum(size for _, size, _ in self._scan())
+
+    def _path(self, blob_hash: str) -> str:
+        return os.path.join(self.directory, blob_hash[:2], blob_hash)
+
+    def _scan(self) -> list[tuple[str, int, float]]:
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _read_sync(self, blob_hash: str) -> bytes | None:
+        self._ensure_ready()
+        path = self._path(blob_hash)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            # Отмечаем использование, чтобы популярное не вытеснялось
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _write_sync(self, data: bytes) -> str:
+        self._ensure_ready()
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self._path(blob_hash)
+        if os.path.exists(path):
+            os.utime(path)
+            return blob_hash
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+        return blob_hash
+
+    def _evict(self):
+        # Удаляем самые давно использованные файлы, пока не освободим 10% запаса
+        target = self.max_bytes * 0.9
+        files = sorted(self._scan(), key=lambda item: item[2])
+        self._total_bytes = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if self._total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+                self._total_bytes -= size
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+
+    async def get(self, blob_hash: str) -> bytes | None:
+        return await asyncio.to_thread(self._read_sync, blob_hash)
+
+    async def put(self, data: bytes) -> str:
+        return await asyncio.to_thread(self._write_sync, data)
+
+    def stats(self) -> dict:
+        return {"bytes": self._total_bytes or 0, "max_bytes": self.max_bytes, "evictions": self.evictions}
+
+def _collect_metrics() -> list[tuple]:
+    samples = []
+    for cache in _tiered_caches:
+        stats = cache.stats()
+        labels = {"cache": cache.name}
+        samples.append(("bot_cache_hits_total", "counter", "Попадания в кэш", labels, stats["hits"]))
+        samples.append(("bot_cache_misses_total", "counter", "Промахи кэша", labels, stats["misses"]))
+        samples.append(("bot_cache_size", "gauge", "Записей в памяти", labels, stats["size"]))
+    return samples
+
+registry.add_collector(_collect_metrics)
@@ -0,0 +1,53 @@
+import json
+import logging
+import os
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Файл с ключами и настройками; переменные окружения важнее файла
+API_KEYS_PATH = os.environ.get("API_KEYS_PATH", os.path.join("api_keys", "api_keys.json"))
+
+_config = None
+
+# Читаем файл один раз на процесс. Файла может и не быть - тогда всё берётся из окружения
+def load_config() -> dict:
+    global _config
+    if _config is None:
+        try:
+            with open(API_KEYS_PATH, "r") as file:
+                _config = json.load(file)
+        except FileNotFoundError:
+            _config = {}
+        except json.JSONDecodeError:
+            logging.error(f"Не смог разобрать JSON в {API_KEYS_PATH}")
+            raise
+    return _config
+
+def _to_text(value) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return str(value)
+
+# Настройка по имени переменной окружения: сначала окружение, потом файл (ключ как есть или в нижнем регистре),
+# иначе default. Значения всегда строки - как из окружения
+def get_setting(name: str, default: str | None = None) -> str | None:
+    value = os.environ.get(name)
+    if value is not None:
+        return value
+    config = load_config()
+    for key in (name, name.lower()):
+        if config.get(key) is not None:
+            return _to_text(config[key])
+    return default
+
+# Обязательная настройка (токены и ключи): без неё бот не запустится
+def require_setting(name: str) -> str:
+    value = get_setting(name)
+    if not value:
+        logging.error(f"Нет {name}: задайте переменную окружения или ключ {name.lower()} в {API_KEYS_PATH}")
+        raise KeyError(name)
+    return value
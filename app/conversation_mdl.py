@@ -0,0 +1,118 @@
+import asyncio
+import logging
+from database_mdl import Database
+from openai_client_mdl import FORMAT_TIMEOUT
+from router_mdl import complete_task
+from scheduler_mdl import set_request_context, PRIORITY_BACKGROUND
+from config_mdl import get_setting
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Помнить ли разговор в чате (CONVERSATION_CONTEXT=0 - каждый вопрос сам по себе)
+CONVERSATION_CONTEXT = get_setting("CONVERSATION_CONTEXT", "1") == "1"
+# Жёсткий бюджет на промпт: системный промпт + свёртка + последние реплики + вопрос
+CONTEXT_TOKEN_BUDGET = int(get_setting("CONTEXT_TOKEN_BUDGET", "3000"))
+# Сколько токенов максимум отдаём под свёртку и под одну старую реплику
+SUMMARY_TOKEN_LIMIT = 600
+TURN_TOKEN_LIMIT = 800
+# Сколько последних реплик держим дословно; всё, что старше, сворачивается в фоне
+KEEP_RECENT_TURNS = int(get_setting("CONTEXT_RECENT_TURNS", "6"))
+# Сворачиваем не после каждого ответа, а когда несвёрнутого накопилось на столько реплик больше
+SUMMARY_BATCH_TURNS = KEEP_RECENT_TURNS
+# Больше стольких реплик в один запрос свёртки не кладём - остальное свернётся следующим
+SUMMARY_MAX_TURNS = KEEP_RECENT_TURNS * 4
+
+# Фоновые свёртки: не больше одной на чат
+_summary_tasks = {}
+
+# Грубая оценка токенов: ~4 символа на токен, без токенизатора
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def _truncate(text: str, tokens: int) -> str:
+    limit = tokens * 4
+    return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + "…"
+
+# Собираем контекст для вопроса: свёртка старого разговора и последние реплики, пока влезают в бюджет.
+# before_message_id - контекст на момент конкретного сообщения (для перегенерации)
+async def build_context(db: Database, chat_id: int, query: str, system_prompt: str,
+                        before_message_id: int | None = None) -> list[dict]:
+    if not CONVERSATION_CONTEXT:
+        return []
+    budget = CONTEXT_TOKEN_BUDGET - estimate_tokens(system_prompt) - estimate_tokens(query)
+    summary, last_id = await db.get_summary(chat_id)
+    turns = await db.get_recent_turns(chat_id, after_id=last_id, before_message_id=before_message_id,
+                                      limit=KEEP_RECENT_TURNS + SUMMARY_BATCH_TURNS)
+
+    context = []
+    if summary and budget > 0:
+        summary = _truncate(summary, min(SUMMARY_TOKEN_LIMIT, budget))
+        context.append({"role": "system", "content": f"Краткое содержание разговора до этого: {summary}"})
+        budget -= estimate_tokens(summary)
+
+    # Идём от новых реплик к старым, пока хватает бюджета
+    recent = []
+    for _, turn_query, turn_answer in reversed(turns):
+        turn_answer = _truncate(turn_answer, TURN_TOKEN_LIMIT)
+        cost = estimate_tokens(turn_query) + estimate_tokens(turn_answer)
+        if cost > budget:
+            break
+        budget -= cost
+        recent.append([
+            {"role": "user", "content": turn_query},
+            {"role": "assistant", "content": turn_answer},
+        ])
+    for pair in reversed(recent):
+        context.extend(pair)
+    return context
+
+# После нового ответа проверяем, не пора ли свернуть старые реплики (в фоне, вне пути ответа)
+def schedule_summary(db: Database, chat_id: int):
+    if not CONVERSATION_CONTEXT:
+        return
+    task = _summary_tasks.get(chat_id)
+    if task is not None and not task.done():
+        return
+    _summary_tasks[chat_id] = asyncio.create_task(_summarize(db, chat_id))
+
+async def _summarize(db: Database, chat_id: int):
+    # Фоновая работа не должна мешать живым запросам
+    set_request_context(None, PRIORITY_BACKGROUND)
+    try:
+        await db.flush()
+        summary, last_id = await db.get_summary(chat_id)
+        while True:
+            total, turns = await db.get_turns_after(chat_id, last_id, SUMMARY_MAX_TURNS)
+            if total <= KEEP_RECENT_TURNS + SUMMARY_BATCH_TURNS:
+                return
+            # Сворачиваем самые старые реплики, последние оставляем дословными. Берём их по порядку,
+            # поэтому при большом хвосте ничего не пропадает - просто понадобится несколько заходов
+            old_turns = turns[:min(len(turns), total - KEEP_RECENT_TURNS)]
+            dialogue = "\n".join(
+                f"Пользователь: {_truncate(turn_query, TURN_TOKEN_LIMIT)}\nАссистент: {_truncate(turn_answer, TURN_TOKEN_LIMIT)}"
+                for _, turn_query, turn_answer in old_turns
+            )
+            prompt = f"""
+            Обнови краткое содержание разговора. Сохрани факты, имена, решения и открытые вопросы,
+            которые могут понадобиться дальше. Не больше {SUMMARY_TOKEN_LIMIT * 3} символов, только текст.
+            Текущее краткое содержание: {summary or "(пусто)"}
+            Новые реплики:
+            {dialogue}
+            """
+            new_summary = await complete_task(
+                "summary", [{"role": "user", "content": prompt}], temperature=0.2, timeout=FORMAT_TIMEOUT
+            )
+            if not new_summary:
+                return
+            summary, last_id = new_summary, old_turns[-1][0]
+            await db.save_summary(chat_id, summary, last_id)
+            logging.info(f"Свернул разговор в чате {chat_id}: реплик {len(old_turns)}")
+    except Exception as e:
+        logging.error(f"Не смог свернуть разговор в чате {chat_id}: {str(e)}")
+    finally:
+        if _summary_tasks.get(chat_id) is asyncio.current_task():
+            del _summary_tasks[chat_id]
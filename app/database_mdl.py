@@ -1,6 +1,13 @@
+import asyncio
+import queue
 import sqlite3
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import AsyncIterator
+from storage_mdl import StorageError
 
 # Настраиваем логи, чтобы следить за базой
 logging.basicConfig(
@@ -8,65 +15,436 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
+# ALTER TABLE ADD COLUMN не умеет IF NOT EXISTS - проверяем колонку сами
+def _add_column(table: str, column: str, column_type: str):
+    def migrate(conn: sqlite3.Connection):
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    return migrate
+
+# Миграции схемы: номер версии хранится в PRAGMA user_version.
+# Шаг - SQL-строка или функция от подключения; каждый шаг можно безопасно повторить
+MIGRATIONS = [
+    # 1: исходная таблица запросов
+    [
+        """
+        CREATE TABLE IF NOT EXISTS user_queries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            query TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        )
+        """,
+    ],
+    # 2: покрывающие индексы для get_query и /history, чтобы не сканировать всю таблицу
+    [
+        "CREATE INDEX IF NOT EXISTS idx_user_queries_chat_message ON user_queries (chat_id, message_id, query)",
+        "CREATE INDEX IF NOT EXISTS idx_user_queries_user_time ON user_queries (user_id, timestamp, query)",
+    ],
+    # 3: ответы и свёртки разговоров для контекста диалога
+    [
+        _add_column("user_queries", "answer", "TEXT"),
+        "CREATE INDEX IF NOT EXISTS idx_user_queries_chat_id ON user_queries (chat_id, id)",
+        """
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            chat_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_id INTEGER NOT NULL,
+            updated TEXT NOT NULL
+        )
+        """,
+    ],
+    # 4: сообщения бота с ответом (длинный ответ - несколько сообщений) -> сообщение с запросом
+    [
+        """
+        CREATE TABLE IF NOT EXISTS reply_messages (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            query_message_id INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID
+        """,
+    ],
+    # 5: связки из версии 4 не нужны - кнопки под ответом и так несут ID сообщения с запросом
+    [
+        "DROP TABLE IF EXISTS reply_messages",
+    ],
+]
+
+# Сколько раз повторяем пачку, если база занята другим процессом, и первая пауза между попытками
+WRITE_RETRIES = 3
+WRITE_RETRY_DELAY = 0.1
+
+# Запись, которая не вставка запроса (обновление ответа, свёртка разговора) - идёт той же пачкой
+class _Statement:
+    def __init__(self, sql: str, params: tuple):
+        self.sql = sql
+        self.params = params
+
 class Database:
-    def __init__(self, db_path: str = "user_queries.db"):
+    def __init__(self, db_path: str = "user_queries.db", batch_size: int = 200, flush_interval: float = 0.05,
+                 query_store=None, query_ttl: float = 30 * 24 * 3600):
         # Создаём подключение к базе
         self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Общее хранилище связок "сообщение -> запрос", чтобы кнопки работали на любом хосте
+        self.query_store = query_store
+        self.query_ttl = query_ttl
+
+        # Запросы, которые ещё лежат в очереди на запись: (chat_id, message_id) -> query
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._write_queue = queue.Queue()
+
+        # Чтение идёт в отдельных потоках, у каждого своё долгоживущее подключение
+        self._local = threading.local()
+        self._read_conns = []
+        self._read_conns_lock = threading.Lock()
+        self._read_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db-read")
+
         self._init_db()
 
+        # Фоновый писатель собирает вставки в пачки и пишет их одной транзакцией
+        self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
     def _init_db(self):
-        # Создаём таблицу для запросов, если её нет
+        # Создаём таблицу и доводим схему до последней версии
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS user_queries (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        chat_id INTEGER NOT NULL,
-                        message_id INTEGER NOT NULL,
-                        query TEXT NOT NULL,
-                        timestamp TEXT NOT NULL
-                    )
-                """)
-                conn.commit()
-                logging.info("Таблица user_queries готова к работе.")
+            conn = self._connect()
+            # Транзакциями управляем сами: BEGIN IMMEDIATE сразу берёт блокировку на запись
+            conn.isolation_level = None
+            try:
+                # Воркеры (--workers N) стартуют одновременно: версию читаем уже под блокировкой,
+                # так что миграции прогоняет только первый, остальные видят готовую схему
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    version = conn.execute("PRAGMA user_version").fetchone()[0]
+                    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                        for statement in statements:
+                            if callable(statement):
+                                statement(conn)
+                            else:
+                                conn.execute(statement)
+                        conn.execute(f"PRAGMA user_version = {number}")
+                        logging.info(f"База обновлена до версии схемы {number}")
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+            finally:
+                conn.close()
+            logging.info("Таблица user_queries готова к работе.")
         except sqlite3.Error as e:
             logging.error(f"Не смог настроить базу: {str(e)}")
             raise
 
-    def save_query(self, user_id: int, chat_id: int, message_id: int, query: str):
-        # Сохраняем запрос юзера в базу
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                timestamp = datetime.utcnow().isoformat()
-                cursor.execute("""
-                    INSERT INTO user_queries (user_id, chat_id, message_id, query, timestamp)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (user_id, chat_id, message_id, query, timestamp))
-                conn.commit()
-                logging.info(f"Сохранил запрос: user_id={user_id}, message_id={message_id}")
-        except sqlite3.Error as e:
-            logging.error(f"Не смог сохранить запрос: {str(e)}")
-            raise
+    def _read_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            # Запоминаем, чтобы закрыть при остановке
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        return conn
+
+    async def _run_read(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._read_executor, func, *args)
+
+    def _writer_loop(self):
+        conn = self._connect()
+        running = True
+        while running:
+            batch = [self._write_queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # Добираем пачку, пока не истекло окно или пачка не заполнилась
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._write_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            rows = [item for item in batch if isinstance(item, tuple)]
+            statements = [item for item in batch if isinstance(item, _Statement)]
+            callbacks = [item for item in batch if callable(item)]
+            running = batch[-1] is not None
+
+            if rows or statements:
+                try:
+                    self._write_batch(conn, rows, statements)
+                    logging.info(f"Сохранил пачку: запросов {len(rows)}, обновлений {len(statements)}")
+                except sqlite3.Error as e:
+                    # Одна плохая запись не должна утянуть за собой всю пачку - пишем по одной
+                    logging.error(f"Не смог сохранить пачку запросов, пишу по одной: {str(e)}")
+                    self._write_one_by_one(conn, rows, statements)
+                finally:
+                    with self._pending_lock:
+                        for _, chat_id, message_id, query, _, _ in rows:
+                            if self._pending.get((chat_id, message_id)) == query:
+                                del self._pending[(chat_id, message_id)]
+
+            for callback in callbacks:
+                # Упавший обработчик не должен останавливать писателя: save_query продолжает класть в очередь
+                try:
+                    callback()
+                except Exception as e:
+                    logging.error(f"Ошибка в обработчике после записи пачки: {str(e)}")
+        conn.close()
+
+    @staticmethod
+    def _insert(conn: sqlite3.Connection, rows: list[tuple]):
+        conn.executemany("""
+            INSERT INTO user_queries (user_id, chat_id, message_id, query, timestamp, answer)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, rows)
+
+    # Пачка одной транзакцией; если база занята (другой процесс пишет), повторяем с паузой
+    def _write_batch(self, conn: sqlite3.Connection, rows: list[tuple], statements: list[_Statement]):
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                with conn:
+                    self._insert(conn, rows)
+                    for statement in statements:
+                        conn.execute(statement.sql, statement.params)
+                return
+            except sqlite3.OperationalError as e:
+                if attempt == WRITE_RETRIES:
+                    raise
+                logging.warning(f"База занята, повторяю пачку: {str(e)}")
+                time.sleep(WRITE_RETRY_DELAY * 2 ** attempt)
+
+    # Каждая запись своей транзакцией: теряем только те, что не записываются сами по себе
+    def _write_one_by_one(self, conn: sqlite3.Connection, rows: list[tuple], statements: list[_Statement]):
+        dropped = 0
+        for row in rows:
+            try:
+                with conn:
+                    self._insert(conn, [row])
+            except sqlite3.Error as e:
+                dropped += 1
+                logging.error(f"Не смог сохранить запрос message_id={row[2]}: {str(e)}")
+        for statement in statements:
+            try:
+                with conn:
+                    conn.execute(statement.sql, statement.params)
+            except sqlite3.Error as e:
+                dropped += 1
+                logging.error(f"Не смог выполнить обновление: {str(e)}")
+        logging.info(f"Сохранил по одной: {len(rows) + len(statements) - dropped}, потеряно: {dropped}")
+
+    async def save_query(self, user_id: int, chat_id: int, message_id: int, query: str, answer: str | None = None):
+        # Кладём запрос (и ответ, если он уже есть) в очередь, писатель сохранит его в ближайшей пачке
+        timestamp = datetime.utcnow().isoformat()
+        with self._pending_lock:
+            self._pending[(chat_id, message_id)] = query
+        self._write_queue.put((user_id, chat_id, message_id, query, timestamp, answer))
+        if self.query_store is not None:
+            try:
+                await self.query_store.set(f"{chat_id}:{message_id}", query, self.query_ttl)
+            except StorageError as e:
+                logging.error(f"Не смог сохранить запрос в общее хранилище: {str(e)}")
+        logging.info(f"Поставил запрос в очередь на запись: user_id={user_id}, message_id={message_id}")
+
+    async def save_answer(self, chat_id: int, message_id: int, answer: str):
+        # Новый ответ на уже сохранённый запрос (например, после перегенерации)
+        self._write_queue.put(_Statement(
+            "UPDATE user_queries SET answer = ? WHERE chat_id = ? AND message_id = ?",
+            (answer, chat_id, message_id)
+        ))
+
+    async def flush(self):
+        # Ждём, пока всё, что уже в очереди, окажется в базе
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        self._write_queue.put(lambda: loop.call_soon_threadsafe(done.set_result, None))
+        await done
+
+    def _get_query_sync(self, message_id: int, chat_id: int) -> str | None:
+        cursor = self._read_conn().execute(
+            "SELECT query FROM user_queries WHERE chat_id = ? AND message_id = ? LIMIT 1", (chat_id, message_id)
+        )
+        result = cursor.fetchone()
+        return result[0] if result else None
 
-    def get_query(self, message_id: int, chat_id: int) -> str | None:
+    async def get_query(self, message_id: int, chat_id: int) -> str | None:
         # Ищем запрос по ID сообщения и чата
+        with self._pending_lock:
+            pending = self._pending.get((chat_id, message_id))
+        if pending is not None:
+            return pending
+
+        if self.query_store is not None:
+            try:
+                shared = await self.query_store.get(f"{chat_id}:{message_id}")
+                if shared is not None:
+                    return shared
+            except StorageError as e:
+                logging.error(f"Не смог прочитать запрос из общего хранилища: {str(e)}")
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT query FROM user_queries
-                    WHERE message_id = ? AND chat_id = ?
-                """, (message_id, chat_id))
-                result = cursor.fetchone()
-                if result:
-                    logging.info(f"Нашёл запрос для message_id={message_id}, chat_id={chat_id}")
-                    return result[0]
-                else:
-                    logging.warning(f"Запрос не нашёл для message_id={message_id}, chat_id={chat_id}")
-                    return None
+            result = await self._run_read(self._get_query_sync, message_id, chat_id)
+            if result:
+                logging.info(f"Нашёл запрос для message_id={message_id}, chat_id={chat_id}")
+            else:
+                logging.warning(f"Запрос не нашёл для message_id={message_id}, chat_id={chat_id}")
+            return result
         except sqlite3.Error as e:
             logging.error(f"Ошибка при поиске запроса: {str(e)}")
-            return None
\ No newline at end of file
+            return None
+
+    def _recent_turns_sync(self, chat_id: int, after_id: int, before_message_id: int | None, limit: int) -> list[tuple]:
+        conditions = ["chat_id = ?", "id > ?", "answer IS NOT NULL"]
+        params = [chat_id, after_id]
+        if before_message_id is not None:
+            conditions.append("message_id < ?")
+            params.append(before_message_id)
+        cursor = self._read_conn().execute(f"""
+            SELECT id, query, answer FROM user_queries
+            WHERE {' AND '.join(conditions)}
+            ORDER BY id DESC
+            LIMIT ?
+        """, (*params, limit))
+        return cursor.fetchall()[::-1]
+
+    def _turns_after_sync(self, chat_id: int, after_id: int, limit: int) -> tuple[int, list[tuple]]:
+        conn = self._read_conn()
+        total = conn.execute(
+            "SELECT COUNT(*) FROM user_queries WHERE chat_id = ? AND id > ? AND answer IS NOT NULL", (chat_id, after_id)
+        ).fetchone()[0]
+        cursor = conn.execute("""
+            SELECT id, query, answer FROM user_queries
+            WHERE chat_id = ? AND id > ? AND answer IS NOT NULL
+            ORDER BY id ASC
+            LIMIT ?
+        """, (chat_id, after_id, limit))
+        return total, cursor.fetchall()
+
+    # Самые старые вопросы с ответами после строки after_id (для свёртки) и сколько их всего
+    async def get_turns_after(self, chat_id: int, after_id: int, limit: int) -> tuple[int, list[tuple[int, str, str]]]:
+        try:
+            return await self._run_read(self._turns_after_sync, chat_id, after_id, limit)
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при чтении истории чата: {str(e)}")
+            return 0, []
+
+    # Последние вопросы с ответами в чате (от старых к новым), после строки after_id
+    async def get_recent_turns(self, chat_id: int, after_id: int = 0, before_message_id: int | None = None,
+                               limit: int = 50) -> list[tuple[int, str, str]]:
+        try:
+            return await self._run_read(self._recent_turns_sync, chat_id, after_id, before_message_id, limit)
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при чтении истории чата: {str(e)}")
+            return []
+
+    def _recent_queries_sync(self, limit: int) -> list[str]:
+        cursor = self._read_conn().execute("SELECT query FROM user_queries ORDER BY id DESC LIMIT ?", (limit,))
+        return [query for (query,) in cursor.fetchall()]
+
+    # Последние запросы всех пользователей (для обучения классификатора намерений)
+    async def get_recent_queries(self, limit: int = 5000) -> list[str]:
+        try:
+            return await self._run_read(self._recent_queries_sync, limit)
+        except sqlite3.Error as e:
+            logging.error(f"Не смог прочитать запросы для обучения классификатора: {str(e)}")
+            return []
+
+    def _summary_sync(self, chat_id: int) -> tuple[str, int] | None:
+        cursor = self._read_conn().execute(
+            "SELECT summary, last_id FROM conversation_summaries WHERE chat_id = ?", (chat_id,)
+        )
+        return cursor.fetchone()
+
+    # Свёртка старой части разговора и ID последней свёрнутой строки
+    async def get_summary(self, chat_id: int) -> tuple[str, int]:
+        try:
+            row = await self._run_read(self._summary_sync, chat_id)
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при чтении свёртки разговора: {str(e)}")
+            row = None
+        return row if row else ("", 0)
+
+    async def save_summary(self, chat_id: int, summary: str, last_id: int):
+        self._write_queue.put(_Statement("""
+            INSERT INTO conversation_summaries (chat_id, summary, last_id, updated) VALUES (?, ?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET summary = excluded.summary, last_id = excluded.last_id,
+                                               updated = excluded.updated
+        """, (chat_id, summary, last_id, datetime.utcnow().isoformat())))
+
+    def _history_page_sync(self, user_id: int, since: str | None, after: tuple | None, size: int) -> list[tuple]:
+        # Одна страница истории по индексу (user_id, timestamp): продолжаем с последней строки
+        conditions = ["user_id = ?"]
+        params = [user_id]
+        if since:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        if after:
+            conditions.append("(timestamp, id) > (?, ?)")
+            params.extend(after)
+        cursor = self._read_conn().execute(f"""
+            SELECT id, query, timestamp FROM user_queries
+            WHERE {' AND '.join(conditions)}
+            ORDER BY timestamp ASC, id ASC
+            LIMIT ?
+        """, (*params, size))
+        return cursor.fetchall()
+
+    def _history_offset_sync(self, user_id: int, since: str | None, last: int) -> tuple | None:
+        # Для "последних N" находим строку, с которой начинать выгрузку
+        conditions = ["user_id = ?"]
+        params = [user_id]
+        if since:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        cursor = self._read_conn().execute(f"""
+            SELECT timestamp, id FROM user_queries
+            WHERE {' AND '.join(conditions)}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT 1 OFFSET ?
+        """, (*params, last))
+        return cursor.fetchone()
+
+    async def iter_history(self, user_id: int, since: str | None = None, last: int | None = None,
+                           chunk_size: int = 500) -> AsyncIterator[list[tuple[str, str]]]:
+        # Отдаём историю пользователя страницами (query, timestamp), не держа её целиком в памяти
+        await self.flush()
+        after = None
+        if last is not None:
+            after = await self._run_read(self._history_offset_sync, user_id, since, last)
+        while True:
+            rows = await self._run_read(self._history_page_sync, user_id, since, after, chunk_size)
+            if not rows:
+                return
+            yield [(query, timestamp) for _, query, timestamp in rows]
+            row_id, _, timestamp = rows[-1]
+            after = (timestamp, row_id)
+
+    def stats(self) -> dict:
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {"write_queue": self._write_queue.qsize(), "pending": pending}
+
+    async def close(self):
+        # Дописываем очередь и останавливаем писателя
+        self._write_queue.put(None)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._writer.join)
+        # Дожидаемся начатых чтений и закрываем подключения потоков чтения
+        await loop.run_in_executor(None, self._read_executor.shutdown)
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from ai_answer_mdl import answer_question
+from cache_mdl import TieredCache
+from metrics_mdl import registry
+from scheduler_mdl import has_spare_capacity, set_request_context, PRIORITY_BACKGROUND
+from config_mdl import get_setting
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Заранее готовить подробное объяснение, пока пользователь читает ответ (по умолчанию выключено)
+EXPLAIN_PREFETCH = get_setting("EXPLAIN_PREFETCH", "0") == "1"
+# Бюджет: сколько предзагрузок в минуту и сколько одновременно
+EXPLAIN_PREFETCH_PER_MINUTE = float(get_setting("EXPLAIN_PREFETCH_PER_MINUTE", "10"))
+EXPLAIN_PREFETCH_MAX_IN_FLIGHT = 2
+# Сколько живёт неиспользованное объяснение
+EXPLAIN_PREFETCH_TTL = float(get_setting("EXPLAIN_PREFETCH_TTL", "900"))
+
+# Готовые объяснения по (chat_id, message_id) исходного вопроса
+explain_prefetches = TieredCache("explain_prefetch", max_items=500, ttl=EXPLAIN_PREFETCH_TTL)
+
+# Бюджет как у планировщика: токены копятся со временем, одна предзагрузка - один токен
+_budget = {"tokens": EXPLAIN_PREFETCH_PER_MINUTE, "updated": time.monotonic()}
+_pending = {}
+prefetch_stats = {"started": 0, "skipped": 0, "stored": 0, "failed": 0, "used": 0}
+
+# Промпт для кнопки "Объяснить подробнее"
+def explain_prompt(query: str) -> str:
+    return f"Объясните тему или вопрос подробно: {query}"
+
+def _key(chat_id: int, message_id: int) -> str:
+    return f"{chat_id}:{message_id}"
+
+def _take_budget() -> bool:
+    now = time.monotonic()
+    _budget["tokens"] = min(
+        EXPLAIN_PREFETCH_PER_MINUTE,
+        _budget["tokens"] + (now - _budget["updated"]) * EXPLAIN_PREFETCH_PER_MINUTE / 60
+    )
+    _budget["updated"] = now
+    if _budget["tokens"] < 1:
+        return False
+    _budget["tokens"] -= 1
+    return True
+
+# После отправки ответа: если у модели есть свободные слоты и бюджет не исчерпан, готовим объяснение в фоне
+def schedule_explain_prefetch(chat_id: int, message_id: int, query: str):
+    if not EXPLAIN_PREFETCH or not query:
+        return
+    key = _key(chat_id, message_id)
+    if key in _pending:
+        return
+    if (len(_pending) >= EXPLAIN_PREFETCH_MAX_IN_FLIGHT or not has_spare_capacity("answer")
+            or not _take_budget()):
+        prefetch_stats["skipped"] += 1
+        return
+    prefetch_stats["started"] += 1
+    task = asyncio.create_task(_prefetch(key, query))
+    _pending[key] = task
+    task.add_done_callback(lambda _: _pending.pop(key, None))
+
+async def _prefetch(key: str, query: str):
+    # Фоновая работа пропускает вперёд все живые запросы
+    set_request_context(None, PRIORITY_BACKGROUND)
+    result, success = await answer_question(explain_prompt(query))
+    if success:
+        prefetch_stats["stored"] += 1
+        await explain_prefetches.set(key, result)
+    else:
+        prefetch_stats["failed"] += 1
+        logging.warning(f"Не получилось заранее подготовить объяснение: {result}")
+
+# Объяснение для кнопки: готовое или то, что ещё генерируется в фоне (тогда дожидаемся его, а не спрашиваем заново).
+# Предзагрузка стартует только при свободном бэкенде, так что в очереди она почти не стоит
+async def get_prefetched_explanation(chat_id: int, message_id: int) -> str | None:
+    key = _key(chat_id, message_id)
+    task = _pending.get(key)
+    if task is not None:
+        await asyncio.shield(task)
+    result = await explain_prefetches.get(key)
+    if result is not None:
+        prefetch_stats["used"] += 1
+    return result
+
+def _collect_metrics() -> list[tuple]:
+    return [("bot_explain_prefetch_total", "counter", "Предзагрузки объяснений по исходу", {"outcome": outcome}, value)
+            for outcome, value in prefetch_stats.items()]
+
+registry.add_collector(_collect_metrics)
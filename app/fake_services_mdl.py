@@ -0,0 +1,327 @@
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+import zlib
+from io import BytesIO
+from PIL import Image as PILImage
+from aiohttp import web
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Заглушки внешних сервисов для бенчмарка: OpenRouter, pollinations (текст и картинки) и Telegram Bot API.
+# Задержки и доля ошибок настраиваются, чтобы мерить бота без живых сервисов
+
+FAKE_ANSWER = (
+    "**Коротко**: это пример ответа для бенчмарка.\n\n"
+    "Подробнее:\n"
+    "- первый пункт с `кодом`;\n"
+    "- второй пункт с *курсивом*;\n"
+    "- третий пункт.\n\n"
+    "```python\nprint('hello')\n```\n"
+) * 3
+
+# Распределение задержки: "fixed:0.05", "uniform:0.01:0.1", "exp:0.2", "lognormal:0.3:0.5" (медиана и сигма)
+class LatencyModel:
+    def __init__(self, spec: str = "fixed:0"):
+        self.spec = spec
+        kind, *params = spec.split(":")
+        self.kind = kind
+        self.params = [float(param) for param in params]
+        if kind not in ("fixed", "uniform", "exp", "lognormal"):
+            raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.params[0] if self.params else 0.0
+        if self.kind == "uniform":
+            return rng.uniform(self.params[0], self.params[1])
+        if self.kind == "exp":
+            return rng.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+        median, sigma = self.params
+        return median * math.exp(rng.gauss(0, sigma))
+
+# Поведение одной заглушки: задержка, доля ошибок и счётчики
+class FakeBehavior:
+    def __init__(self, latency: str = "fixed:0", error_rate: float = 0.0, seed: int = 0):
+        self.latency = LatencyModel(latency)
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = {}
+        self.errors = 0
+
+    async def delay(self, name: str) -> bool:
+        # Ждём и решаем, вернуть ли ошибку. True - отвечаем ошибкой
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self.latency.sample(self.rng))
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    def stats(self) -> dict:
+        return {"calls": dict(self.calls), "errors": self.errors}
+
+def _make_jpeg(width: int, height: int) -> bytes:
+    # Градиенты и немного шума - похоже на фото по размеру файла
+    red = PILImage.linear_gradient("L").resize((width, height))
+    green = PILImage.linear_gradient("L").rotate(90).resize((width, height))
+    blue = PILImage.effect_noise((width, height), 40)
+    output = BytesIO()
+    PILImage.merge("RGB", (red, green, blue)).save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+# OpenRouter: /chat/completions, обычный ответ и поток (SSE)
+def create_openrouter_app(behavior: FakeBehavior, answer: str = FAKE_ANSWER, chunk_size: int = 24,
+                          chunk_delay: float = 0.01) -> web.Application:
+    async def completions(request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        if await behavior.delay("chat.completions"):
+            return web.json_response({"error": {"message": "fake upstream error", "code": 502}}, status=502)
+        created = int(time.time())
+        base = {"id": "chatcmpl-fake", "created": created, "model": payload.get("model", "fake")}
+
+        if not payload.get("stream"):
+            return web.json_response({
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": answer}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": len(answer) // 4, "total_tokens": 10 + len(answer) // 4},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for start in range(0, len(answer), chunk_size):
+            chunk = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": answer[start:start + chunk_size]}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            if chunk_delay:
+                await asyncio.sleep(chunk_delay)
+        done = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        await response.write(f"data: {json.dumps(done)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post("/chat/completions", completions)
+    return app
+
+# pollinations: текст (намерение, перевод) и генерация картинок
+def create_pollinations_app(behavior: FakeBehavior, image_side: int = 512) -> web.Application:
+    image_data = _make_jpeg(image_side, image_side)
+
+    async def text(request: web.Request) -> web.Response:
+        payload = await request.json()
+        if await behavior.delay("text"):
+            return web.Response(status=500, text="fake upstream error")
+        messages = payload.get("messages") or [{}]
+        prompt = str(messages[-1].get("content", ""))
+        if "[image_description]" in prompt:
+            return web.Response(text="[question]")
+        return web.Response(text=f"translated: {prompt.strip()[-80:]}")
+
+    async def image(request: web.Request) -> web.Response:
+        if await behavior.delay("image"):
+            return web.Response(status=500, text="fake upstream error")
+        return web.Response(body=image_data, content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_post("/", text)
+    app.router.add_post("/prompt/{prompt:.*}", image)
+    return app
+
+# Telegram Bot API: отвечаем на методы, которые вызывает бот, и отдаём файлы фоток
+def create_telegram_app(behavior: FakeBehavior, photo_side: int = 1280, photo_variants: int = 8) -> web.Application:
+    # Несколько разных фоток, чтобы кэш описаний не отвечал на всё с первого раза
+    photos = [_make_jpeg(photo_side, photo_side * 3 // 4) for _ in range(photo_variants)]
+    message_ids = iter(range(10_000_000, 2**31))
+    bot_user = {"id": 123, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+    def make_message(chat_id, **fields) -> dict:
+        return {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": bot_user,
+            **fields,
+        }
+
+    async def method(request: web.Request) -> web.Response:
+        name = request.match_info["method"]
+        form = await request.post()
+        if await behavior.delay(name):
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1},
+            }, status=429)
+
+        chat_id = form.get("chat_id", 0)
+        if name in ("sendMessage", "editMessageText"):
+            result = make_message(chat_id, text=str(form.get("text", "")))
+        elif name == "sendPhoto":
+            result = make_message(chat_id, photo=[
+                {"file_id": f"photo-{next(message_ids)}", "file_unique_id": "u1", "width": 512, "height": 512},
+            ])
+        elif name == "sendDocument":
+            result = make_message(chat_id, document={"file_id": f"doc-{next(message_ids)}", "file_unique_id": "u2"})
+        elif name == "getFile":
+            file_id = str(form.get("file_id", ""))
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": f"photos/{file_id}.jpg"}
+        elif name == "getMe":
+            result = bot_user
+        else:
+            # answerCallbackQuery, sendChatAction, setWebhook и прочее
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def file(request: web.Request) -> web.Response:
+        await behavior.delay("file")
+        photo = photos[zlib.crc32(request.match_info["path"].encode("utf-8")) % len(photos)]
+        return web.Response(body=photo, content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", method)
+    app.router.add_get("/file/bot{token}/{path:.*}", file)
+    return app
+
+# Заглушка Redis: говорит на RESP2 и понимает команды, которые нужны боту и aiogram RedisStorage
+# (HELLO, GET, SET с EX/PX/NX/XX, DEL, EXISTS и служебные). Для проверок STORAGE_BACKEND=redis без настоящего Redis
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.calls = {}
+        self._server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Версия протокола у каждого подключения своя: HELLO 3 переключает на RESP3
+        connection = {"proto": 2}
+        try:
+            while True:
+                command = await self._read_command(reader)
+                if command is None:
+                    break
+                writer.write(self._execute(command, connection))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # Команда приходит массивом bulk-строк: *2\r\n$3\r\nGET\r\n$3\r\nkey\r\n
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader) -> list[bytes] | None:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    def _alive(self, key: bytes) -> bytes | None:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires is not None and expires <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    @staticmethod
+    def _bulk(value: bytes | None, proto: int = 2) -> bytes:
+        if value is None:
+            return b"_\r\n" if proto == 3 else b"$-1\r\n"
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def _execute(self, command: list[bytes], connection: dict) -> bytes:
+        name = command[0].decode().upper()
+        args = command[1:]
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if name == "PING":
+            return b"+PONG\r\n"
+        if name == "HELLO":
+            # redis-py 8 по умолчанию просит RESP3
+            proto = connection["proto"] = int(args[0]) if args else connection["proto"]
+            fields = [b"server", b"redis", b"proto", proto, b"mode", b"standalone"]
+            reply = b"%%%d\r\n" % (len(fields) // 2) if proto == 3 else b"*%d\r\n" % len(fields)
+            for field in fields:
+                reply += b":%d\r\n" % field if isinstance(field, int) else self._bulk(field)
+            return reply
+        if name in ("SELECT", "CLIENT", "QUIT"):
+            return b"+OK\r\n"
+        if name == "GET":
+            return self._bulk(self._alive(args[0]), connection["proto"])
+        if name == "SET":
+            key, value = args[0], args[1]
+            options = [arg.decode().upper() for arg in args[2:]]
+            expires = None
+            exists = self._alive(key) is not None
+            if ("NX" in options and exists) or ("XX" in options and not exists):
+                return self._bulk(None, connection["proto"])
+            for option, factor in (("EX", 1.0), ("PX", 0.001)):
+                if option in options:
+                    expires = time.monotonic() + float(options[options.index(option) + 1]) * factor
+            self.data[key] = (expires, value)
+            return b"+OK\r\n"
+        if name in ("DEL", "UNLINK", "EXISTS"):
+            found = [key for key in args if self._alive(key) is not None]
+            if name != "EXISTS":
+                for key in found:
+                    del self.data[key]
+            return b":%d\r\n" % len(found)
+        if name == "FLUSHDB":
+            self.data.clear()
+            return b"+OK\r\n"
+        return b"-ERR unknown command '%s'\r\n" % name.encode()
+
+# Запускаем все заглушки в отдельном процессе, чтобы они не мешали замерам CPU и памяти бота.
+# config: {"openrouter": {"latency", "error_rate", ...}, "pollinations": {...}, "telegram": {...}}
+def run_fake_services(config: dict, connection):
+    async def serve():
+        behaviors = {name: FakeBehavior(**config.get(name, {}).get("behavior", {}), seed=index)
+                     for index, name in enumerate(("openrouter", "pollinations", "telegram"))}
+        apps = {
+            "openrouter": create_openrouter_app(behaviors["openrouter"], **config.get("openrouter", {}).get("options", {})),
+            "pollinations": create_pollinations_app(behaviors["pollinations"]),
+            "telegram": create_telegram_app(behaviors["telegram"]),
+        }
+        runners = []
+        ports = {}
+        for name, app in apps.items():
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            ports[name] = site._server.sockets[0].getsockname()[1]
+            runners.append(runner)
+
+        connection.send(ports)
+        # Ждём команду остановки из родительского процесса
+        await asyncio.get_running_loop().run_in_executor(None, connection.recv)
+        connection.send({name: behavior.stats() for name, behavior in behaviors.items()})
+        for runner in runners:
+            await runner.cleanup()
+
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    asyncio.run(serve())
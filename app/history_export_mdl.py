@@ -0,0 +1,90 @@
+import asyncio
+import gzip
+import logging
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from database_mdl import Database
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Файлы больше этого размера отправляем сжатыми в .gz
+GZIP_THRESHOLD = 512 * 1024
+# Сколько строк тянем из базы за раз
+CHUNK_SIZE = 500
+# Потолок для /history last N
+MAX_LAST = 10 ** 9
+
+_PERIOD_RE = re.compile(r"^(\d+)([hdwm])$")
+_PERIOD_UNITS = {"h": timedelta(hours=1), "d": timedelta(days=1), "w": timedelta(weeks=1), "m": timedelta(days=30)}
+
+# Разбираем аргументы /history: "7d", "12h", "2w", "last 500" (можно вместе)
+def parse_history_args(text: str) -> tuple[str | None, int | None]:
+    args = text.split()[1:]
+    since = None
+    last = None
+    position = 0
+    while position < len(args):
+        arg = args[position].lower()
+        period = _PERIOD_RE.match(arg)
+        if period:
+            try:
+                delta = int(period.group(1)) * _PERIOD_UNITS[period.group(2)]
+                since = (datetime.utcnow() - delta).isoformat()
+            except OverflowError:
+                # Период длиннее, чем умеет datetime, - значит, вся история
+                since = None
+        elif arg == "last" and position + 1 < len(args) and args[position + 1].isdigit():
+            last = int(args[position + 1])
+            if last <= 0:
+                raise ValueError("После last нужно число больше нуля")
+            # Больше не бывает, а слишком большое число не влезет в LIMIT SQLite
+            last = min(last, MAX_LAST)
+            position += 1
+        else:
+            raise ValueError(f"Не понимаю аргумент: {args[position]}")
+        position += 1
+    return since, last
+
+def _write_lines(file, lines: list[str]):
+    file.write("".join(lines).encode("utf-8"))
+
+def _compress(path: str) -> str:
+    # Сжимаем файл кусками, не читая его целиком в память
+    gz_path = path + ".gz"
+    with open(path, "rb") as source, gzip.open(gz_path, "wb", compresslevel=6) as target:
+        shutil.copyfileobj(source, target, length=1024 * 1024)
+    os.remove(path)
+    return gz_path
+
+# Пишем историю во временный файл по страницам. Возвращаем путь, имя файла и число строк.
+# Путь нужно удалить после отправки
+async def export_history(db: Database, user_id: int, title: str,
+                         since: str | None = None, last: int | None = None) -> tuple[str, str, int]:
+    file = tempfile.NamedTemporaryFile(prefix=f"history_{user_id}_", suffix=".txt", delete=False)
+    path = file.name
+    count = 0
+    try:
+        with file:
+            await asyncio.to_thread(_write_lines, file, [f"История запросов пользователя {title}:\n\n"])
+            async for rows in db.iter_history(user_id, since=since, last=last, chunk_size=CHUNK_SIZE):
+                lines = [f"[{timestamp}] {query}\n" for query, timestamp in rows]
+                await asyncio.to_thread(_write_lines, file, lines)
+                count += len(rows)
+
+        filename = f"history_{user_id}.txt"
+        if os.path.getsize(path) > GZIP_THRESHOLD:
+            path = await asyncio.to_thread(_compress, path)
+            filename += ".gz"
+        logging.info(f"Собрал историю: user_id={user_id}, строк={count}, файл={filename}")
+        return path, filename, count
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from config_mdl import get_setting
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Перекодирование картинок - тяжёлая работа для CPU, поэтому делаем её в отдельных процессах.
+# Модуль специально лёгкий: его импортируют процессы пула
+IMAGE_ENCODE_WORKERS = int(get_setting("IMAGE_ENCODE_WORKERS", "2"))
+
+# Уровни качества для перекодирования
+QUALITY_TIERS = {"low": 60, "standard": 82, "high": 92}
+
+# Форматы на выходе: как есть от генератора, прогрессивный JPEG или WebP
+OUTPUT_FORMATS = ("original", "jpeg", "webp")
+
+_pool = None
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, а не fork: в процессе бота уже крутятся потоки (запись в базу, executor)
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_ENCODE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+# Определяем формат по первым байтам, не раскодируя картинку
+def sniff_format(image_data: bytes) -> str | None:
+    if image_data[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if image_data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def _encode_sync(image_data: bytes, output_format: str, quality: int, max_side: int | None) -> bytes:
+    from PIL import Image as PILImage
+    with PILImage.open(BytesIO(image_data)) as image:
+        if max_side and max(image.size) > max_side:
+            image.draft("RGB", (max_side, max_side))
+            image = image.convert("RGB")
+            image.thumbnail((max_side, max_side), PILImage.Resampling.LANCZOS)
+        else:
+            image = image.convert("RGB")
+        output = BytesIO()
+        if output_format == "webp":
+            image.save(output, format="WEBP", quality=quality, method=4)
+        else:
+            image.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+        return output.getvalue()
+
+# Исходные байты можно отправить как есть: формат тот, что просили, и сторона не больше max_side
+def _can_pass_through(image_data: bytes, output_format: str, max_side: int | None) -> bool:
+    if output_format not in ("original", sniff_format(image_data)):
+        return False
+    if not max_side and output_format != "jpeg":
+        return True
+    from PIL import Image as PILImage
+    # Читается только заголовок, сами пиксели не раскодируются
+    with PILImage.open(BytesIO(image_data)) as image:
+        if max_side and max(image.size) > max_side:
+            return False
+        # "jpeg" - это прогрессивный JPEG, обычный (baseline) перекодируем
+        return output_format != "jpeg" or bool(image.info.get("progressive"))
+
+# Готовим картинку к отправке. Если формат и размер подходят, отдаём исходные байты без перекодирования
+async def encode_image(image_data: bytes, output_format: str = "original", quality_tier: str = "standard",
+                       max_side: int | None = None) -> bytes:
+    if _can_pass_through(image_data, output_format, max_side):
+        return image_data
+    if output_format == "original":
+        output_format = "jpeg"
+    encoded = await asyncio.get_running_loop().run_in_executor(
+        _get_pool(), _encode_sync, image_data, output_format, QUALITY_TIERS[quality_tier], max_side
+    )
+    logging.info(f"Перекодировал картинку в {output_format}: {len(image_data)} -> {len(encoded)} байт")
+    return encoded
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
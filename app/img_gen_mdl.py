@@ -1,8 +1,14 @@
-import asyncio
-from io import BytesIO
-from PIL import Image as PILImage
-import pollinations
+import json
+import os
+import zlib
+from pollinations_client_mdl import run_image_model
 import logging
+from cache_mdl import TieredCache, DiskBlobCache, make_key, normalize_text
+from scheduler_mdl import slot, QueueFull
+from router_mdl import complete_task
+from singleflight_mdl import SingleFlight
+from img_encode_mdl import encode_image, sniff_format
+from config_mdl import get_setting
 
 # Настраиваем логи, чтобы следить за процессом
 logging.basicConfig(
@@ -10,32 +16,114 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-# Создаём модель для работы с текстом
-text_model = pollinations.Text()
+# Параметры генерации (входят в ключ кэша картинок)
+IMAGE_MODEL = "flux"
+IMAGE_WIDTH = 1024
+IMAGE_HEIGHT = 1024
+IMAGE_ENHANCE = True
+# Формат отправки: "original" - байты генератора как есть, "jpeg" (прогрессивный) или "webp" - перекодирование в пуле процессов
+IMAGE_OUTPUT_FORMAT = get_setting("IMAGE_OUTPUT_FORMAT", "original")
+# Качество перекодирования: low, standard, high
+IMAGE_QUALITY_TIER = get_setting("IMAGE_QUALITY_TIER", "standard")
+# Сторона быстрого превью, которое отправляем до полной картинки (0 - без превью)
+IMAGE_PREVIEW_SIDE = int(get_setting("IMAGE_PREVIEW_SIDE", "0"))
+
+# Кэш переводов: исходный промпт -> английский промпт
+translation_cache = TieredCache("translations", max_items=5000, ttl=30 * 24 * 3600)
+# Индекс картинок: ключ генерации -> {"blob": хэш файла, "file_id": file_id в Telegram}
+image_index = TieredCache("images", max_items=5000, ttl=30 * 24 * 3600)
+# Сами картинки на диске
+image_blobs = DiskBlobCache(
+    get_setting("IMAGE_CACHE_DIR", os.path.join("cache", "images")),
+    max_bytes=int(get_setting("IMAGE_CACHE_MAX_MB", "512")) * 1024 * 1024,
+)
+
+# Одинаковые переводы и генерации, идущие одновременно, делаем один раз
+translate_flight = SingleFlight("translate")
+image_flight = SingleFlight("image")
 
 # Переводим промпт на английский
 async def translate_prompt(prompt: str) -> str:
     if not prompt.strip():
         return prompt
 
+    cache_key = make_key("translate", normalize_text(prompt))
+    cached = await translation_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     try:
-        translation_prompt = f"""
-        Переведи этот текст на английский. Только перевод, без лишних слов:
-        {prompt}
-        """
-        translated_text = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: text_model(translation_prompt)
-        )
-        translated_text = translated_text.strip()
-        logging.info(f"Перевёл: '{prompt}' -> '{translated_text}'")
+        translated_text = await translate_flight.do(cache_key, lambda: _request_translation(prompt, cache_key))
         return translated_text if translated_text else prompt
     except Exception as e:
         logging.error(f"Не смог перевести промпт: {str(e)}")
         return prompt
 
-# Генерируем картинку по промпту
-async def generate_image(prompt: str) -> tuple[bytes | str, bool]:
+async def _request_translation(prompt: str, cache_key: str) -> str:
+    translation_prompt = f"""
+    Переведи этот текст на английский. Только перевод, без лишних слов:
+    {prompt}
+    """
+    translated_text = await complete_task("translate", [{"role": "user", "content": translation_prompt}])
+    # Промпт уходит в адрес запроса к генератору - переносы строк там ни к чему
+    translated_text = " ".join(translated_text.split())
+    logging.info(f"Перевёл: '{prompt}' -> '{translated_text}'")
+    if translated_text:
+        await translation_cache.set(cache_key, translated_text)
+    return translated_text
+
+# Размеры под нужную сторону с сохранением пропорций (side=None - полный размер)
+def _dimensions(side: int | None) -> tuple[int, int]:
+    if not side or side >= max(IMAGE_WIDTH, IMAGE_HEIGHT):
+        return IMAGE_WIDTH, IMAGE_HEIGHT
+    scale = side / max(IMAGE_WIDTH, IMAGE_HEIGHT)
+    return round(IMAGE_WIDTH * scale), round(IMAGE_HEIGHT * scale)
+
+def _image_key(translated_prompt: str, side: int | None = None) -> str:
+    width, height = _dimensions(side)
+    parts = [translated_prompt, IMAGE_MODEL, str(width), str(height), str(IMAGE_ENHANCE)]
+    if IMAGE_OUTPUT_FORMAT != "original":
+        parts += [IMAGE_OUTPUT_FORMAT, IMAGE_QUALITY_TIER]
+    return make_key(*parts)
+
+async def _get_image_entry(prompt: str, side: int | None = None) -> tuple[str, dict | None]:
+    key = _image_key(await translate_prompt(prompt), side)
+    entry = await image_index.get(key)
+    return key, json.loads(entry) if entry else None
+
+# Имя файла для отправки по настоящему формату картинки
+def image_filename(image_data: bytes) -> str:
+    return f"image.{sniff_format(image_data) or 'jpg'}"
+
+# Полная картинка по такому промпту уже лежит в кэше - превью не нужно
+async def has_cached_image(prompt: str) -> bool:
+    if not prompt.strip():
+        return False
+    _, entry = await _get_image_entry(prompt)
+    return entry is not None
+
+# file_id картинки, которую уже отправляли по такому промпту (чтобы не загружать её снова)
+async def get_cached_file_id(prompt: str) -> str | None:
+    if not prompt.strip():
+        return None
+    _, entry = await _get_image_entry(prompt)
+    return entry.get("file_id") if entry else None
+
+# Запоминаем file_id после первой отправки
+async def remember_file_id(prompt: str, file_id: str):
+    key, entry = await _get_image_entry(prompt)
+    if entry is not None:
+        entry["file_id"] = file_id
+        await image_index.set(key, json.dumps(entry))
+
+# Telegram больше не знает этот file_id - забываем его
+async def forget_file_id(prompt: str):
+    key, entry = await _get_image_entry(prompt)
+    if entry is not None and entry.pop("file_id", None):
+        await image_index.set(key, json.dumps(entry))
+
+# Генерируем картинку по промпту. side - сторона картинки (например, 512 для быстрого превью)
+async def generate_image(prompt: str, side: int | None = None) -> tuple[bytes | str, bool]:
     if not prompt.strip():
         return "Напиши, какую картинку хочешь сгенерить.", False
 
@@ -43,29 +131,50 @@ async def generate_image(prompt: str) -> tuple[bytes | str, bool]:
     translated_prompt = await translate_prompt(prompt)
     logging.info(f"Генерирую с промптом: {translated_prompt}")
 
-    try:
-        # Настраиваем модель для генерации картинок
-        ai_image = pollinations.Image(
-            model="flux",
-            width=1024,
-            height=1024,
-            nologo=True,
-            enhance=True,
-        )
-
-        # Генерируем картинку
-        pil_image: PILImage = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: ai_image(translated_prompt)
-        )
+    # Такую картинку уже генерировали - отдаём с диска
+    key = _image_key(translated_prompt, side)
+    entry = await image_index.get(key)
+    if entry:
+        image_data = await image_blobs.get(json.loads(entry)["blob"])
+        if image_data:
+            logging.info("Картинка взята из кэша")
+            return image_data, True
 
-        if pil_image:
-            # Сохраняем картинку в память
-            image_bytes = BytesIO()
-            pil_image.save(image_bytes, format=pil_image.format or "JPEG")
-            return image_bytes.getvalue(), True
+    try:
+        # Одинаковые промпты, пришедшие одновременно, генерируем один раз
+        image_data = await image_flight.do(key, lambda: _request_image(translated_prompt, key, side))
+        if image_data:
+            return image_data, True
         else:
             return "Не получилось сгенерить картинку.", False
 
+    except QueueFull as e:
+        return str(e), False
     except Exception as e:
-        return f"Ошибка при генерации картинки: {str(e)}", False
\ No newline at end of file
+        return f"Ошибка при генерации картинки: {str(e)}", False
+
+async def _request_image(translated_prompt: str, key: str, side: int | None = None) -> bytes | None:
+    width, height = _dimensions(side)
+    # Генерируем картинку. Сид от промпта: превью и полная картинка выходят одинаковыми.
+    # Берём байты прямо из ответа генератора, без раскодирования и пережатия
+    async with slot("image"):
+        response = await run_image_model(
+            translated_prompt,
+            model=IMAGE_MODEL,
+            width=width,
+            height=height,
+            seed=zlib.crc32(translated_prompt.encode("utf-8")),
+            nologo=True,
+            enhance=IMAGE_ENHANCE,
+        )
+
+    if not response:
+        return None
+    image_data = await encode_image(response, IMAGE_OUTPUT_FORMAT, IMAGE_QUALITY_TIER,
+                                    max_side=max(width, height))
+    try:
+        blob_hash = await image_blobs.put(image_data)
+        await image_index.set(key, json.dumps({"blob": blob_hash}))
+    except OSError as e:
+        logging.error(f"Не смог сохранить картинку в кэш: {str(e)}")
+    return image_data
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+from io import BytesIO
+from typing import TYPE_CHECKING
+from aiogram.types import PhotoSize
+from media_mdl import ViewReader
+from config_mdl import get_setting
+
+if TYPE_CHECKING:
+    from PIL import Image as PILImage
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Модели распознавания всё равно уменьшают картинку, больше этой стороны слать незачем
+VISION_TARGET_SIDE = int(get_setting("VISION_TARGET_SIDE", "1024"))
+JPEG_QUALITY = 85
+
+# Выбираем самый маленький размер из тех, что Telegram уже нарезал, но не меньше нужного
+def choose_photo_size(photos: list[PhotoSize], target_side: int = VISION_TARGET_SIDE) -> PhotoSize:
+    suitable = [photo for photo in photos if max(photo.width, photo.height) >= target_side]
+    if suitable:
+        return min(suitable, key=lambda photo: photo.width * photo.height)
+    return max(photos, key=lambda photo: photo.width * photo.height)
+
+# Перцептивный хэш (dHash, 64 бита): у пересланных и пережатых копий он почти не меняется
+def _dhash(image: "PILImage.Image") -> int:
+    from PIL import Image as PILImage
+    small = image.convert("L").resize((9, 8), PILImage.Resampling.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+def hamming_distance(first: int, second: int) -> int:
+    return bin(first ^ second).count("1")
+
+def _prepare_image_sync(image_data: bytes | memoryview, target_side: int) -> tuple[bytes | memoryview, int]:
+    # PIL нужен только для фото - импортируем при первой картинке
+    from PIL import Image as PILImage
+    # Открываем прямо из буфера загрузки; если картинка уже подходит, возвращаем тот же буфер
+    with PILImage.open(ViewReader(image_data)) as image:
+        image_hash = _dhash(image)
+        if max(image.size) <= target_side and image.format == "JPEG":
+            # Размер уже подходит - отдаём как есть, без перекодирования
+            return image_data, image_hash
+        image = image.convert("RGB")
+        image.thumbnail((target_side, target_side), PILImage.Resampling.LANCZOS)
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        return output.getvalue(), image_hash
+
+# Уменьшаем картинку до нужного размера и считаем её хэш (в отдельном потоке, не тормозя бота)
+async def prepare_image(image_data: bytes | memoryview,
+                        target_side: int = VISION_TARGET_SIDE) -> tuple[bytes | memoryview, int]:
+    prepared, image_hash = await asyncio.to_thread(_prepare_image_sync, image_data, target_side)
+    logging.info(f"Подготовил картинку: {len(image_data)} -> {len(prepared)} байт, хэш {image_hash:016x}")
+    return prepared, image_hash
@@ -1,8 +1,10 @@
-import asyncio
-import base64
+import json
 import logging
-from openai import OpenAI
-from io import BytesIO
+from cache_mdl import TieredCache
+from img_prep_mdl import hamming_distance
+from scheduler_mdl import QueueFull
+from openai_client_mdl import VISION_TIMEOUT
+from router_mdl import complete_task, EmptyAnswer
 
 # Настраиваем логирование
 logging.basicConfig(
@@ -10,78 +12,101 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-# Читаем API ключ для OpenAI
-def load_openai_api_key():
-    import os
-    import json
-    api_keys_path = os.path.join('api_keys', 'api_keys.json')
-    try:
-        with open(api_keys_path, 'r') as file:
-            data = json.load(file)
-            return data['openai_api_key']
-    except FileNotFoundError:
-        logging.error("Не нашёл api_keys.json в папке api_keys")
-        raise
-    except KeyError:
-        logging.error("В api_keys.json нет ключа openai_api_key")
-        raise
-    except json.JSONDecodeError:
-        logging.error("Не смог разобрать JSON в api_keys.json")
-        raise
+# Описания картинок по перцептивному хэшу: дубликаты не отправляем в модель повторно
+description_cache = TieredCache("descriptions", max_items=2000, ttl=7 * 24 * 3600)
+# Насколько хэши могут отличаться, чтобы считать картинки одинаковыми
+HASH_DISTANCE = 4
+# Для поиска почти одинаковых хэшей делим 64 бита на HASH_DISTANCE + 1 полос: если хэши отличаются
+# не больше чем в HASH_DISTANCE битах, хотя бы одна полоса у них совпадает целиком.
+# Полоса -> список хэшей с такой полосой; лежит в том же постоянном хранилище, что и описания,
+# поэтому переживает перезапуск и общая для всех процессов
+HASH_BANDS = HASH_DISTANCE + 1
+BAND_MAX_HASHES = 32
+description_bands = TieredCache("description_bands", max_items=10000, ttl=7 * 24 * 3600)
 
-# Создаём клиент для OpenAI
-client = OpenAI(
-    api_key=load_openai_api_key(),
-    base_url="https://openrouter.ai/api/v1",
-)
+def _hash_key(image_hash: int) -> str:
+    return f"{image_hash:016x}"
+
+def _band_keys(image_hash: int) -> list[str]:
+    keys = []
+    start = 0
+    for band in range(HASH_BANDS):
+        width = (64 - start) // (HASH_BANDS - band)
+        keys.append(f"{band}:{(image_hash >> start) & ((1 << width) - 1):x}")
+        start += width
+    return keys
+
+async def _band_hashes(band_key: str) -> list[int]:
+    value = await description_bands.get(band_key)
+    return json.loads(value) if value else []
 
-# Распознаём, что на картинке
-async def recognize_image(image_data: bytes) -> tuple[str, bool]:
+async def get_cached_description(image_hash: int) -> str | None:
+    description = await description_cache.get(_hash_key(image_hash))
+    if description is not None:
+        return description
+    # Ищем почти такую же картинку (пережатые копии дают близкий хэш) среди хэшей с общей полосой
+    checked = {image_hash}
+    for band_key in _band_keys(image_hash):
+        for known_hash in await _band_hashes(band_key):
+            if known_hash in checked:
+                continue
+            checked.add(known_hash)
+            if hamming_distance(known_hash, image_hash) <= HASH_DISTANCE:
+                # Описание могло устареть раньше полосы - тогда смотрим следующих кандидатов
+                description = await description_cache.get(_hash_key(known_hash))
+                if description is not None:
+                    return description
+    return None
+
+async def store_description(image_hash: int, description: str):
+    await description_cache.set(_hash_key(image_hash), description)
+    for band_key in _band_keys(image_hash):
+        hashes = await _band_hashes(band_key)
+        if image_hash not in hashes:
+            hashes = (hashes + [image_hash])[-BAND_MAX_HASHES:]
+            await description_bands.set(band_key, json.dumps(hashes))
+
+# Распознаём, что на картинке. image_url - готовый data URL (см. media_mdl.encode_data_url):
+# кодируем заранее, чтобы не держать буфер с картинкой, пока ждём очередь к модели
+async def recognize_image(image_url: str) -> tuple[str, bool]:
     # Проверяем, есть ли картинка
-    if not image_data:
+    if not image_url:
         return "Картинку не прислали.", False
 
     try:
-        # Кодируем картинку в base64
-        encoded_image = base64.b64encode(image_data).decode("utf-8")
-
-        # Спрашиваем OpenAI, что на картинке
-        response = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: client.chat.completions.create(
-                extra_headers={
-                    "HTTP-Referer": "https://your-site-url",
-                    "X-Title": "AI YALY TG BOT",
-                },
-                model="opengvlab/internvl3-14b:free",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "Опиши подробно, что на этой картинке"
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{encoded_image}"
-                                }
+        # Спрашиваем модель из маршрута "vision", что на картинке (в порядке очереди)
+        description = await complete_task(
+            "vision",
+            [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": "Опиши подробно, что на этой картинке"
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_url
                             }
-                        ]
-                    }
-                ],
-                max_tokens=10000
-            )
+                        }
+                    ]
+                }
+            ],
+            max_tokens=10000,
+            timeout=VISION_TIMEOUT,
+            extra_headers={
+                "HTTP-Referer": "https://your-site-url",
+                "X-Title": "AI YALY TG BOT",
+            }
         )
+        return description, True
 
-        # Получаем описание
-        description = response.choices[0].message.content.strip()
-        if description:
-            return description, True
-        else:
-            return "Не смог разобрать, что на картинке.", False
-
+    except EmptyAnswer:
+        return "Не смог разобрать, что на картинке.", False
+    except QueueFull as e:
+        return str(e), False
     except Exception as e:
         logging.error(f"Ошибка при анализе картинки: {str(e)}")
         return f"Не получилось обработать картинку: {str(e)}", False
\ No newline at end of file
@@ -1,6 +1,10 @@
 import asyncio
 import logging
-import pollinations
+import math
+import re
+from collections import Counter, defaultdict
+from router_mdl import complete_task
+from config_mdl import get_setting
 
 # Настраиваем логи, чтобы видеть, что к чему
 logging.basicConfig(
@@ -8,8 +12,177 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-# Создаём модель для анализа текста
-model = pollinations.Text()
+INTENTS = ["[image]", "[question]", "[image_description]"]
+
+# Если локальный классификатор уверен меньше этого порога, спрашиваем LLM
+CONFIDENCE_THRESHOLD = float(get_setting("INTENT_CONFIDENCE_THRESHOLD", "0.75"))
+# Потолок словаря n-грамм: модель доучивается на ответах LLM и иначе росла бы всё время работы
+MAX_VOCABULARY = int(get_setting("INTENT_MAX_VOCABULARY", "200000"))
+
+# Счётчики: сколько раз хватило быстрого пути, а сколько раз пошли в LLM
+intent_stats = {"fast_path": 0, "llm_fallback": 0, "llm_errors": 0}
+
+# Вопросительное слово в начале или знак вопроса в конце
+_QUESTION_RULES = [
+    (re.compile(r"^(что|как|почему|зачем|когда|где|кто|какой|какая|какие|сколько|чем|можно ли|объясни|расскажи|what|how|why|when|where|who|which|explain|tell me)\b", re.I), "[question]", 0.85),
+    (re.compile(r"\?\s*$"), "[question]", 0.8),
+]
+
+# Правила по ключевым словам: (регулярка, намерение, уверенность)
+_RULES = [
+    (re.compile(r"\b(опиши|распознай|что (изображено|нарисовано) на|что на (этой |этом )?(картинк|фот|изображени|снимк)|describe (this|the|an?) (image|picture|photo)|what('s| is) (in|on) (this|the) (image|picture|photo))", re.I), "[image_description]", 0.9),
+    # Только повелительное наклонение: «как нарисовать кота?» - это вопрос, а не заказ картинки
+    (re.compile(r"\b(нарисуй|сгенерируй|сгенери|сгенерь|создай (картинк|изображени|рисун|арт|фото|иллюстраци)|сделай (картинк|изображени|рисун|арт)|картинк[ауи] (с|где|про)|изображени[ея] (с|где|про)|generate (an? )?(image|picture|photo|art)|image of|picture of)|^(please )?(draw|paint)\b", re.I), "[image]", 0.92),
+    *_QUESTION_RULES,
+]
+
+# Немного примеров, чтобы n-граммная модель работала с первого запуска
+_SEED_EXAMPLES = [
+    ("нарисуй кота в космосе", "[image]"),
+    ("закат над горами в стиле аниме", "[image]"),
+    ("сгенерируй картинку с драконом", "[image]"),
+    ("милый котёнок, акварель", "[image]"),
+    ("футуристический город ночью, неон", "[image]"),
+    ("портрет девушки маслом", "[image]"),
+    ("a cat astronaut, digital art", "[image]"),
+    ("логотип для кофейни, минимализм", "[image]"),
+    ("опиши картинку", "[image_description]"),
+    ("что на этой фотографии", "[image_description]"),
+    ("распознай изображение", "[image_description]"),
+    ("хочу чтобы ты описал фото", "[image_description]"),
+    ("что такое python", "[question]"),
+    ("как работает интернет", "[question]"),
+    ("столица франции", "[question]"),
+    ("почему небо голубое", "[question]"),
+    ("напиши функцию сортировки на питоне", "[question]"),
+    ("сколько будет 2+2", "[question]"),
+    ("переведи на английский привет", "[question]"),
+    ("чем отличается список от кортежа", "[question]"),
+]
+
+# Маленький наивный байес на символьных n-граммах
+class CharNgramModel:
+    def __init__(self, min_n: int = 2, max_n: int = 4, max_vocabulary: int = MAX_VOCABULARY):
+        self.min_n = min_n
+        self.max_n = max_n
+        self.max_vocabulary = max_vocabulary
+        self.class_counts = Counter()
+        self.ngram_counts = defaultdict(Counter)
+        self.total_ngrams = Counter()
+        self.vocabulary = set()
+
+    def _ngrams(self, text: str) -> list[str]:
+        text = f" {' '.join(text.lower().split())} "
+        return [
+            text[i:i + n]
+            for n in range(self.min_n, self.max_n + 1)
+            for i in range(len(text) - n + 1)
+        ]
+
+    def learn(self, text: str, label: str):
+        grams = self._ngrams(text)
+        if len(self.vocabulary) >= self.max_vocabulary:
+            # Словарь заполнен: уточняем счётчики известных n-грамм, новых не заводим
+            grams = [gram for gram in grams if gram in self.vocabulary]
+        self.class_counts[label] += 1
+        self.ngram_counts[label].update(grams)
+        self.total_ngrams[label] += len(grams)
+        self.vocabulary.update(grams)
+
+    def predict(self, text: str) -> tuple[str, float]:
+        if not self.class_counts:
+            return "[question]", 0.0
+        grams = self._ngrams(text)
+        total_docs = sum(self.class_counts.values())
+        vocabulary_size = len(self.vocabulary) + 1
+        scores = {}
+        for label, docs in self.class_counts.items():
+            counts = self.ngram_counts[label]
+            denominator = self.total_ngrams[label] + vocabulary_size
+            score = math.log(docs / total_docs)
+            for gram in grams:
+                score += math.log((counts[gram] + 1) / denominator)
+            scores[label] = score
+        # Переводим логарифмы в вероятности (softmax), усредняя по числу n-грамм,
+        # иначе длинные запросы дают слишком уверенные ответы
+        scale = max(len(grams), 1) ** 0.5
+        best = max(scores.values())
+        weights = {label: math.exp((score - best) / scale) for label, score in scores.items()}
+        total = sum(weights.values())
+        label = max(weights, key=weights.get)
+        return label, weights[label] / total
+
+_ngram_model = None
+
+# Учим модель на примерах и запросах (в user_queries попадают только вопросы)
+def build_model(queries: list[str]) -> CharNgramModel:
+    ngram_model = CharNgramModel()
+    for text, label in _SEED_EXAMPLES:
+        ngram_model.learn(text, label)
+    learned = 0
+    for query in queries:
+        # Не даём вопросам из базы «забить» редкие классы правилами
+        rule = _match_rules(query)
+        if rule is None or rule[0] == "[question]":
+            ngram_model.learn(query, "[question]")
+            learned += 1
+    logging.info(f"Классификатор намерений обучен, запросов из базы: {learned}")
+    return ngram_model
+
+# Обучаем при старте: запросы читаем через пул чтения базы, саму модель считаем в потоке,
+# чтобы не держать цикл событий
+async def train_from_db(db, limit: int = 5000) -> CharNgramModel:
+    global _ngram_model
+    queries = await db.get_recent_queries(limit)
+    _ngram_model = await asyncio.to_thread(build_model, queries)
+    return _ngram_model
+
+# Пока обучение не закончилось, хватает модели на примерах
+def _get_model() -> CharNgramModel:
+    global _ngram_model
+    if _ngram_model is None:
+        _ngram_model = build_model([])
+    return _ngram_model
+
+def _match_rules(query: str) -> tuple[str, float] | None:
+    for pattern, intent, confidence in _RULES:
+        if pattern.search(query):
+            return intent, confidence
+    return None
+
+# Быстрый локальный классификатор: правила + n-граммы, возвращает намерение и уверенность
+def classify_intent(query: str) -> tuple[str, float]:
+    rule = _match_rules(query)
+    intent, confidence = _get_model().predict(query)
+    if rule is None:
+        return intent, confidence
+    rule_intent, rule_confidence = rule
+    if rule_intent == intent:
+        # Правило и модель согласны - уверенность выше, чем у каждого по отдельности
+        combined = 1 - (1 - rule_confidence) * (1 - confidence)
+    else:
+        combined = rule_confidence * (1 - confidence / 2)
+    if rule_intent == "[image]" and any(pattern.search(query) for pattern, _, _ in _QUESTION_RULES):
+        # Заказ картинки и вопрос одновременно («а ты умеешь? нарисуй кота?») - пусть решает LLM
+        combined = min(combined, CONFIDENCE_THRESHOLD / 2)
+    return rule_intent, combined
+
+def get_intent_stats() -> dict:
+    total = intent_stats["fast_path"] + intent_stats["llm_fallback"]
+    return {**intent_stats, "fast_path_ratio": intent_stats["fast_path"] / total if total else 0.0}
+
+# Спрашиваем LLM, если локальный классификатор не уверен
+async def _analyze_intent_llm(query: str) -> str | None:
+    prompt = f"""
+    Посмотри на запрос и реши, что хочет пользователь.
+    Верни только одно из: [image], [question], [image_description]
+    [image] - хочет сгенерить картинку
+    [question] - задаёт вопрос
+    Запрос: {query}
+    """
+    response = await complete_task("intent", [{"role": "user", "content": prompt}])
+    intent = response.strip()
+    return intent if intent in INTENTS else None
 
 # Проверяем, что хочет пользователь
 async def analyze_intent(query: str) -> tuple[str, bool]:
@@ -17,26 +190,27 @@ async def analyze_intent(query: str) -> tuple[str, bool]:
     if not query.strip():
         return "Напиши запрос, пожалуйста.", False
 
+    local_intent, confidence = classify_intent(query)
+    if confidence >= CONFIDENCE_THRESHOLD:
+        intent_stats["fast_path"] += 1
+        logging.info(f"Намерение определено локально: {local_intent} ({confidence:.2f})")
+        return local_intent, True
+
+    intent_stats["llm_fallback"] += 1
     try:
-        # Формируем запрос для анализа
-        prompt = f"""
-        Посмотри на запрос и реши, что хочет пользователь.
-        Верни только одно из: [image], [question], [image_description]
-        [image] - хочет сгенерить картинку
-        [question] - задаёт вопрос
-        Запрос: {query}
-        """
-        response = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: model(prompt)
-        )
-
-        intent = response.strip()
-        if intent in ["[image]", "[question]", "[image_description]"]:
+        intent = await _analyze_intent_llm(query)
+        if intent:
+            # Запоминаем ответ LLM, чтобы в следующий раз справиться без неё
+            _get_model().learn(query, intent)
             return intent, True
-        else:
-            return "Не понял, что ты хочешь. Попробуй переформулировать.", False
+        if confidence > 0:
+            return local_intent, True
+        return "Не понял, что ты хочешь. Попробуй переформулировать.", False
 
     except Exception as e:
+        intent_stats["llm_errors"] += 1
         logging.error(f"Не смог разобрать намерение: {str(e)}")
-        return f"Ошибка при обработке запроса: {str(e)}", False
\ No newline at end of file
+        # LLM недоступна - лучше ответить по локальной догадке, чем ошибкой
+        if confidence > 0:
+            return local_intent, True
+        return f"Ошибка при обработке запроса: {str(e)}", False
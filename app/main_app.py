@@ -1,17 +1,37 @@
+import argparse
 import logging
-import json
 import os
+import secrets
 import sqlite3
 from aiogram import Bot, Dispatcher
-from aiogram.types import Message, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Message, BufferedInputFile, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaPhoto
 from aiogram.exceptions import TelegramBadRequest
-from ai_answer_mdl import answer_question
-from img_gen_mdl import generate_image
-from img_recgn_mdl import recognize_image
-from intent_analyzer_mdl import analyze_intent
+from ai_answer_mdl import answer_question, stream_answer, get_cached_answer, SYSTEM_PROMPT
+from img_gen_mdl import generate_image, get_cached_file_id, remember_file_id, forget_file_id, has_cached_image, image_filename, IMAGE_PREVIEW_SIDE
+from img_recgn_mdl import recognize_image, get_cached_description, store_description
+from img_prep_mdl import choose_photo_size, prepare_image
+from img_encode_mdl import shutdown_pool
+from media_mdl import photo_buffers, download_to_buffer, encode_data_url
+from voice_mdl import transcribe_voice
+from audio_prep_mdl import shutdown_pool as shutdown_audio_pool
+from intent_analyzer_mdl import analyze_intent, train_from_db
+from speculation_mdl import speculate
+from conversation_mdl import build_context, schedule_summary
+from explain_prefetch_mdl import schedule_explain_prefetch, get_prefetched_explanation, explain_prompt
 from response_formatter_mdl import format_response
+from message_stream_mdl import stream_to_message, StreamInterrupted
+from message_split_mdl import send_long_message, edit_long_message
+from send_queue_mdl import SendQueueMiddleware, TELEGRAM_GLOBAL_RATE
 from database_mdl import Database
+from storage_mdl import QUERY_MAPPING_TTL, create_fsm_storage, is_shared, namespaced, close_store
+from history_export_mdl import export_history, parse_history_args
+from openai_client_mdl import get_client, close_client
+from pollinations_client_mdl import get_text_client, close_text_client, close_image_models
+from config_mdl import get_setting, require_setting, load_config
+from startup_profile_mdl import print_startup_report
+from webhook_mdl import create_webhook_app, serve, set_webhook, bind_socket, start_workers
+from scheduler_mdl import set_request_context, QueueFull, PRIORITY_NORMAL, PRIORITY_CALLBACK
+from metrics_mdl import MetricsMiddleware, registry, span, set_trace_intent, start_metrics_server
 from io import BytesIO
 from aiogram import F
 import asyncio
@@ -22,28 +42,37 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-# Функция для чтения токена Telegram из JSON файла
-def load_api_token():
-    api_keys_path = os.path.join('api_keys', 'api_keys.json')
-    try:
-        with open(api_keys_path, 'r') as file:
-            data = json.load(file)
-            return data['telegram_api_token']
-    except FileNotFoundError:
-        logging.error("Не могу найти api_keys.json в папке api_keys")
-        raise
-    except KeyError:
-        logging.error("В api_keys.json нет ключа telegram_api_token")
-        raise
-    except json.JSONDecodeError:
-        logging.error("Не удалось разобрать JSON в api_keys.json")
-        raise
-
-# Создаём бота и базу данных
-API_TOKEN = load_api_token()
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(bot=bot, storage=MemoryStorage())
-db = Database()
+# Показываем ответ по мере генерации (STREAM_ANSWERS=0 выключает)
+STREAM_ANSWERS = get_setting("STREAM_ANSWERS", "1") == "1"
+
+# Бот и база создаются при запуске (create_bot / open_database), а не при импорте,
+# чтобы модуль можно было импортировать без токена - например, в бенчмарке
+bot: Bot | None = None
+db: Database | None = None
+dp = Dispatcher(storage=create_fsm_storage())
+
+# Создаём бота; session позволяет направить запросы на другой сервер Bot API.
+# workers - сколько процессов шлют от имени этого бота
+def create_bot(token: str | None = None, session=None, workers: int = 1) -> Bot:
+    global bot
+    bot = Bot(token=token or require_setting("TELEGRAM_API_TOKEN"), session=session)
+    # Вся отправка идёт через общую очередь с лимитами Telegram; лимит на бота делим между процессами
+    bot.session.middleware(SendQueueMiddleware(global_rate=TELEGRAM_GLOBAL_RATE / max(workers, 1)))
+    return bot
+
+# Открываем базу запросов
+def open_database(db_path: str = "user_queries.db") -> Database:
+    global db
+    # История пишется в локальный SQLite, а связки "сообщение -> запрос" дублируются в общее хранилище
+    db = Database(db_path, query_store=namespaced("query") if is_shared() else None, query_ttl=QUERY_MAPPING_TTL)
+    return db
+
+# Замеряем каждый обработчик; очередь записи в базу тоже видна в /metrics
+dp.message.middleware(MetricsMiddleware())
+dp.callback_query.middleware(MetricsMiddleware())
+registry.add_collector(lambda: [
+    ("bot_db_write_queue_depth", "gauge", "Запросов ждут записи в базу", {}, db.stats()["write_queue"]),
+] if db is not None else [])
 
 # Делаем инлайн-клавиатуру с кнопками
 def create_inline_keyboard(message_id: int) -> InlineKeyboardMarkup:
@@ -55,6 +84,73 @@ def create_inline_keyboard(message_id: int) -> InlineKeyboardMarkup:
     ])
     return keyboard
 
+# Если запрос встал в очередь к бэкенду, сразу говорим пользователю его позицию
+def queue_notifier(message: Message):
+    async def notify(position: int):
+        await message.answer(f"Ты в очереди, позиция {position}. Скоро отвечу!")
+    return notify
+
+# Генерируем и отправляем картинку. Если такую уже отправляли, шлём по file_id без загрузки
+async def send_generated_image(message: Message, prompt: str):
+    file_id = await get_cached_file_id(prompt)
+    if file_id:
+        try:
+            with span("send"):
+                await message.answer_photo(photo=file_id, caption=prompt)
+            logging.info("Отправил картинку по сохранённому file_id")
+            return
+        except TelegramBadRequest as e:
+            logging.warning(f"Сохранённый file_id не подошёл: {str(e)}")
+            await forget_file_id(prompt)
+
+    # Сначала быстрое превью, потом заменяем его полной картинкой (если полной ещё нет в кэше)
+    preview_message = None
+    full_task = asyncio.create_task(generate_image(prompt))
+    if IMAGE_PREVIEW_SIDE and not await has_cached_image(prompt):
+        preview_message = await send_image_preview(message, prompt, full_task)
+
+    with span("image"):
+        result, success = await full_task
+    logging.info(f"Результат генерации: {'картинка' if success else result}, получилось: {success}")
+    if success:
+        try:
+            photo = BufferedInputFile(result, filename=image_filename(result))
+            with span("send"):
+                if preview_message is not None:
+                    sent_message = await preview_message.edit_media(InputMediaPhoto(media=photo, caption=prompt))
+                else:
+                    sent_message = await message.answer_photo(photo=photo, caption=prompt)
+            if isinstance(sent_message, Message) and sent_message.photo:
+                await remember_file_id(prompt, sent_message.photo[-1].file_id)
+        except TelegramBadRequest as e:
+            logging.error(f"Ошибка Telegram при отправке картинки: {str(e)}")
+            if preview_message is None:
+                await message.answer("Не получилось отправить картинку. Попробуй ещё раз.")
+    elif preview_message is None:
+        await message.answer(result)
+
+# Генерим маленькую картинку параллельно с полной и отправляем её, если полная ещё не готова
+async def send_image_preview(message: Message, prompt: str, full_task: asyncio.Task) -> Message | None:
+    preview_task = asyncio.create_task(generate_image(prompt, side=IMAGE_PREVIEW_SIDE))
+    with span("image_preview"):
+        await asyncio.wait({full_task, preview_task}, return_when=asyncio.FIRST_COMPLETED)
+    if full_task.done():
+        preview_task.cancel()
+        return None
+
+    preview, success = preview_task.result()
+    if not success:
+        return None
+    try:
+        with span("send"):
+            return await message.answer_photo(
+                photo=BufferedInputFile(preview, filename=image_filename(preview)),
+                caption=prompt
+            )
+    except TelegramBadRequest as e:
+        logging.warning(f"Не получилось отправить превью: {str(e)}")
+        return None
+
 # Реакция на команду /start
 @dp.message(lambda message: message.text == "/start")
 async def send_welcome(message: Message):
@@ -70,6 +166,7 @@ async def send_help(message: Message):
     /start - Начать общение с ботом
     /help - Показать эту справку
     /history - Скачать историю твоих запросов в текстовом файле
+    /history 7d или /history last 500 - Только за период или последние запросы
     Просто пиши запрос, а я разберусь, что тебе нужно:
     - Задать вопрос
     - Сгенерировать картинку
@@ -77,36 +174,28 @@ async def send_help(message: Message):
     """
     await message.reply(help_text, parse_mode='HTML')
 
-# Отправляем историю запросов в txt файле
-@dp.message(lambda message: message.text == "/history")
+# Отправляем историю запросов в txt файле (/history, /history 7d, /history last 500)
+@dp.message(lambda message: message.text and message.text.split()[:1] == ["/history"])
 async def send_history(message: Message):
     user_id = message.from_user.id
     try:
-        # Тянем все запросы пользователя из базы
-        with sqlite3.connect(db.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT query, timestamp FROM user_queries
-                WHERE user_id = ?
-                ORDER BY timestamp ASC
-            """, (user_id,))
-            queries = cursor.fetchall()
-
-        if not queries:
-            await message.reply("Ты пока ничего не спрашивал.")
-            return
+        since, last = parse_history_args(message.text)
+    except ValueError as e:
+        await message.reply(f"{str(e)}. Примеры: /history, /history 7d, /history last 500")
+        return
 
-        # Собираем текст для файла
-        history_text = f"История запросов пользователя {message.from_user.username or message.from_user.first_name}:\n\n"
-        for query, timestamp in queries:
-            history_text += f"[{timestamp}] {query}\n"
+    path = None
+    try:
+        # Выгружаем историю по страницам во временный файл
+        title = message.from_user.username or message.from_user.first_name
+        path, filename, count = await export_history(db, user_id, title, since=since, last=last)
 
-        # Пишем текст в файл в памяти
-        history_bytes = history_text.encode('utf-8')
-        history_file = BufferedInputFile(history_bytes, filename=f"history_{user_id}.txt")
+        if not count:
+            await message.reply("Ты пока ничего не спрашивал.")
+            return
 
-        # Отправляем файл юзеру
-        await message.reply_document(history_file)
+        # Отправляем файл юзеру прямо с диска
+        await message.reply_document(FSInputFile(path, filename=filename))
         logging.info(f"Отправил историю запросов юзеру: user_id={user_id}")
 
     except sqlite3.Error as e:
@@ -115,16 +204,26 @@ async def send_history(message: Message):
     except Exception as e:
         logging.error(f"Ошибка при отправке истории: {str(e)}")
         await message.reply("Что-то пошло не так при отправке файла.")
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
 
-# Обрабатываем текстовые сообщения
-@dp.message(lambda message: message.text and not message.text.startswith("/"))
-async def handle_text(message: Message):
-    query = message.text.strip()
-    logging.info(f"Получил текст: {query}")
+# Запрос пользователя (текст или распознанное голосовое): намерение -> ответ, картинка или подсказка
+async def process_query(message: Message, query: str):
+    # Предыдущие реплики чата (в пределах бюджета токенов) - для ответа и для спекулятивного запуска
+    with span("context"):
+        context = await build_context(db, message.chat.id, query, SYSTEM_PROMPT)
+
+    # Пока намерение уточняется, можно заранее запустить самый вероятный следующий шаг
+    speculation = speculate(query, stream=STREAM_ANSWERS, context=context)
 
     # Проверяем, что хочет пользователь
-    intent, success = await analyze_intent(query)
+    with span("intent"):
+        intent, success = await analyze_intent(query)
     logging.info(f"Намерение: {intent}, получилось: {success}")
+    set_trace_intent(intent if success else "unknown")
+    if speculation is not None:
+        speculation.resolve(intent if success else "")
 
     if not success:
         formatted_intent, format_success = await format_response(intent)
@@ -132,56 +231,123 @@ async def handle_text(message: Message):
                              parse_mode='HTML' if format_success else None)
         return
 
-    if intent == "[question]":
-        result, success = await answer_question(query)
+    # Угаданный заранее ответ забираем у догадки, а не спрашиваем модель второй раз
+    speculative = speculation if speculation is not None and speculation.hit and intent == "[question]" else None
+
+    # Если ответ уже есть в кэше, поток не нужен
+    with span("cache_lookup"):
+        cached_answer = await get_cached_answer(query, context) if intent == "[question]" and not speculative else None
+
+    if intent == "[question]" and STREAM_ANSWERS and cached_answer is None:
+        try:
+            # Печатаем ответ прямо в сообщение, кнопки добавятся в конце
+            with span("answer_stream"):
+                result, sent_messages = await stream_to_message(
+                    message,
+                    speculative.answer_stream(lambda: stream_answer(query, context)) if speculative
+                    else stream_answer(query, context),
+                    reply_markup=create_inline_keyboard(message.message_id)
+                )
+            logging.info(f"Ответ (поток): {result}")
+            if sent_messages:
+                with span("db_save"):
+                    await db.save_query(
+                        user_id=message.from_user.id,
+                        chat_id=message.chat.id,
+                        message_id=message.message_id,
+                        query=query,
+                        answer=result
+                    )
+                schedule_summary(db, message.chat.id)
+                schedule_explain_prefetch(message.chat.id, message.message_id, query)
+            else:
+                await message.answer("Модель вернула пустой ответ. Попробуй ещё раз.")
+        except StreamInterrupted as e:
+            # Пользователь уже видит начало ответа с пометкой об обрыве; неполный ответ не сохраняем
+            logging.warning(f"Ответ оборвался на {len(e.text)} символах, в базу не пишу")
+        except QueueFull as e:
+            await message.answer(str(e))
+        except Exception as e:
+            logging.error(f"Ошибка при потоковом ответе: {str(e)}")
+            await message.answer(f"Что-то пошло не так с вопросом: {str(e)}")
+    elif intent == "[question]":
+        speculative_answer = await speculative.answer() if speculative else None
+        if cached_answer is not None:
+            result, success = cached_answer, True
+        elif speculative_answer is not None:
+            result, success = speculative_answer
+        else:
+            with span("answer"):
+                result, success = await answer_question(query, context=context, cache_checked=not speculative)
         logging.info(f"Ответ: {result}, получилось: {success}")
         if success:
-            formatted_result, format_success = await format_response(result)
+            with span("format"):
+                formatted_result, format_success = await format_response(result)
             try:
-                # Отправляем ответ и запоминаем ID сообщения
-                sent_message = await message.answer(
-                    formatted_result if format_success else result,
-                    parse_mode='HTML' if format_success else None,
-                    reply_markup=create_inline_keyboard(message.message_id)
-                )
-                # Сохраняем запрос в базу
-                db.save_query(
+                # Отправляем ответ (длинный - несколькими сообщениями, кнопки на последнем)
+                with span("send"):
+                    await send_long_message(
+                        message,
+                        formatted_result if format_success else result,
+                        parse_mode='HTML' if format_success else None,
+                        reply_markup=create_inline_keyboard(message.message_id)
+                    )
+            except TelegramBadRequest as e:
+                # Разметка не понравилась Telegram - шлём тот же ответ простым текстом, а не просим спросить заново
+                logging.error(f"Ошибка Telegram при отправке: {str(e)}")
+                with span("send"):
+                    await send_long_message(
+                        message, result, reply_markup=create_inline_keyboard(message.message_id)
+                    )
+            # Сохраняем запрос и ответ
+            with span("db_save"):
+                await db.save_query(
                     user_id=message.from_user.id,
                     chat_id=message.chat.id,
                     message_id=message.message_id,
-                    query=query
+                    query=query,
+                    answer=result
                 )
-            except TelegramBadRequest as e:
-                logging.error(f"Ошибка Telegram при отправке: {str(e)}")
-                await message.answer("Не удалось красиво оформить ответ. Попробуй спросить по-другому.")
+            schedule_summary(db, message.chat.id)
+            schedule_explain_prefetch(message.chat.id, message.message_id, query)
         else:
             await message.answer(result)
     elif intent == "[image]":
         prompt = query  # Берём запрос как промпт для генерации
         logging.info(f"Хочет сгенерить картинку: {prompt}")
-        result, success = await generate_image(prompt)
-        logging.info(f"Результат генерации: {result}, получилось: {success}")
-        if success:
-            try:
-                await message.answer_photo(
-                    photo=BufferedInputFile(result, filename="image.jpg"),
-                    caption=prompt
-                )
-            except TelegramBadRequest as e:
-                logging.error(f"Ошибка Telegram при отправке картинки: {str(e)}")
-                await message.answer("Не получилось отправить картинку. Попробуй ещё раз.")
-        else:
-            await message.answer(result)
+        await send_generated_image(message, prompt)
     elif intent == "[image_description]":
         formatted_result, format_success = await format_response("Пришли картинку, и я её опишу.")
         await message.answer(formatted_result if format_success else "Пришли картинку, и я её опишу.",
                              parse_mode='HTML' if format_success else None)
 
+# Обрабатываем текстовые сообщения
+@dp.message(lambda message: message.text and not message.text.startswith("/"))
+async def handle_text(message: Message):
+    query = message.text.strip()
+    logging.info(f"Получил текст: {query}")
+    set_request_context(message.from_user.id, PRIORITY_NORMAL, queue_notifier(message))
+    await process_query(message, query)
+
+# Голосовые и аудиофайлы: распознаём и дальше обрабатываем как текст
+@dp.message(F.voice | F.audio)
+async def handle_voice(message: Message):
+    set_request_context(message.from_user.id, PRIORITY_NORMAL, queue_notifier(message))
+    query, success = await transcribe_voice(message.bot, message.voice or message.audio)
+    if not success:
+        await message.answer(query)
+        return
+    # Показываем, что услышали, - так понятно, на что бот отвечает
+    with span("send"):
+        await send_long_message(message, f"Распознал: {query}")
+    await process_query(message, query)
+
 # Старый способ обработки вопросов (для совместимости)
 @dp.message(lambda message: message.text and message.text.lower().startswith("ask"))
 async def answer(message: Message):
     query = message.text[3:].strip()  # Убираем "Ask" из начала
     logging.info(f"Получил вопрос: {query}")
+    set_request_context(message.from_user.id, PRIORITY_NORMAL, queue_notifier(message))
     result, success = await answer_question(query)
     logging.info(f"Ответ: {result}, получилось: {success}")
     if success:
@@ -194,7 +360,7 @@ async def answer(message: Message):
                 reply_markup=create_inline_keyboard(message.message_id)
             )
             # Пишем запрос в базу
-            db.save_query(
+            await db.save_query(
                 user_id=message.from_user.id,
                 chat_id=message.chat.id,
                 message_id=message.message_id,
@@ -211,36 +377,47 @@ async def answer(message: Message):
 async def generate(message: Message):
     prompt = message.text[8:].strip()  # Убираем "Generate"
     logging.info(f"Запрос на картинку: {prompt}")
-    result, success = await generate_image(prompt)
-    logging.info(f"Результат: {result}, получилось: {success}")
-    if success:
-        try:
-            await message.answer_photo(
-                photo=BufferedInputFile(result, filename="image.jpg"),
-                caption=prompt
-            )
-        except TelegramBadRequest as e:
-            logging.error(f"Ошибка Telegram при отправке картинки: {str(e)}")
-            await message.answer("Не получилось отправить картинку. Попробуй ещё раз.")
-        else:
-            await message.answer(result)
+    set_request_context(message.from_user.id, PRIORITY_NORMAL, queue_notifier(message))
+    await send_generated_image(message, prompt)
 
 # Обрабатываем присланные фотки
 @dp.message(F.photo)
 async def handle_image(message: Message):
+    set_request_context(message.from_user.id, PRIORITY_NORMAL, queue_notifier(message))
     try:
-        # Берём фотку в лучшем качестве
-        photo = message.photo[-1]
-        file_info = await bot.get_file(photo.file_id)
-        image_data = await bot.download_file(file_info.file_path)
-
-        logging.info("Получил фотку для анализа")
-        description, success = await recognize_image(image_data.read())
+        # Берём самый маленький размер, которого хватит модели распознавания
+        photo = choose_photo_size(message.photo)
+        # Картинка живёт в буфере из пула только до кодирования в base64 - память на фотки ограничена
+        async with photo_buffers.acquire(photo.file_size) as buffer:
+            with span("download"):
+                file_info = await message.bot.get_file(photo.file_id)
+                image_data = await download_to_buffer(message.bot, file_info.file_path, buffer)
+
+            logging.info(f"Получил фотку для анализа: {photo.width}x{photo.height}")
+            with span("prepare"):
+                prepared_image, image_hash = await prepare_image(image_data)
+
+            # Такую же картинку уже описывали - не спрашиваем модель снова
+            description = await get_cached_description(image_hash)
+            image_url = await encode_data_url(prepared_image) if description is None else None
+            # Ссылки на буфер убираем до его возврата в пул
+            del image_data, prepared_image
+
+        if description is not None:
+            logging.info("Описание картинки взято из кэша")
+            success = True
+        else:
+            with span("vision"):
+                description, success = await recognize_image(image_url)
+            if success:
+                await store_description(image_hash, description)
 
         if success:
-            formatted_description, format_success = await format_response(description)
-            await message.answer(formatted_description if format_success else description,
-                                 parse_mode='HTML' if format_success else None)
+            with span("format"):
+                formatted_description, format_success = await format_response(description)
+            with span("send"):
+                await send_long_message(message, formatted_description if format_success else description,
+                                        parse_mode='HTML' if format_success else None)
         else:
             await message.answer(description)
 
@@ -252,7 +429,10 @@ async def handle_image(message: Message):
 @dp.callback_query(lambda c: c.data.startswith("regenerate_"))
 async def handle_regenerate(callback: CallbackQuery):
     message_id = int(callback.data.split("_")[1])
-    query = db.get_query(message_id=message_id, chat_id=callback.message.chat.id)
+    # Нажатия кнопок обслуживаем раньше новых запросов
+    set_request_context(callback.from_user.id, PRIORITY_CALLBACK, queue_notifier(callback.message))
+    with span("db_lookup"):
+        query = await db.get_query(message_id=message_id, chat_id=callback.message.chat.id)
 
     if not query:
         await callback.message.answer("Не нашёл исходный запрос. Задай вопрос заново.")
@@ -260,18 +440,25 @@ async def handle_regenerate(callback: CallbackQuery):
         return
 
     try:
-        # Пробуем заново сгенерить ответ
-        result, success = await answer_question(query)
+        # Пробуем заново сгенерить ответ мимо кэша и обновляем запись в нём.
+        # Контекст - разговор на момент исходного вопроса
+        context = await build_context(db, callback.message.chat.id, query, SYSTEM_PROMPT, before_message_id=message_id)
+        with span("answer"):
+            result, success = await answer_question(query, refresh=True, context=context)
         logging.info(f"Новый ответ: {result}, получилось: {success}")
         if success:
-            formatted_result, format_success = await format_response(result)
+            with span("format"):
+                formatted_result, format_success = await format_response(result)
             try:
-                # Меняем текст сообщения
-                await callback.message.edit_text(
-                    formatted_result if format_success else result,
-                    parse_mode='HTML' if format_success else None,
-                    reply_markup=create_inline_keyboard(message_id)
-                )
+                # Меняем текст сообщения; если ответ стал длиннее лимита, продолжение придёт следом
+                with span("send"):
+                    await edit_long_message(
+                        callback.message,
+                        formatted_result if format_success else result,
+                        parse_mode='HTML' if format_success else None,
+                        reply_markup=create_inline_keyboard(message_id)
+                    )
+                await db.save_answer(callback.message.chat.id, message_id, result)
             except TelegramBadRequest as e:
                 logging.error(f"Ошибка Telegram при редактировании: {str(e)}")
                 await callback.message.answer("Не получилось обновить ответ. Попробуй ещё раз.")
@@ -287,7 +474,10 @@ async def handle_regenerate(callback: CallbackQuery):
 @dp.callback_query(lambda c: c.data.startswith("explain_"))
 async def handle_explain(callback: CallbackQuery):
     message_id = int(callback.data.split("_")[1])
-    query = db.get_query(message_id=message_id, chat_id=callback.message.chat.id)
+    # Нажатия кнопок обслуживаем раньше новых запросов
+    set_request_context(callback.from_user.id, PRIORITY_CALLBACK, queue_notifier(callback.message))
+    with span("db_lookup"):
+        query = await db.get_query(message_id=message_id, chat_id=callback.message.chat.id)
 
     if not query:
         await callback.message.answer("Не нашёл исходный запрос. Задай вопрос заново.")
@@ -295,32 +485,168 @@ async def handle_explain(callback: CallbackQuery):
         return
 
     try:
-        # Просим подробное объяснение
-        explain_query = f"Объясните тему или вопрос подробно: {query}"
-        result, success = await answer_question(explain_query)
+        # Просим подробное объяснение; его могли подготовить заранее, пока пользователь читал ответ
+        explain_query = explain_prompt(query)
+        with span("prefetch_lookup"):
+            result = await get_prefetched_explanation(callback.message.chat.id, message_id)
+        cached_answer = None
+        if result is None:
+            with span("cache_lookup"):
+                cached_answer = await get_cached_answer(explain_query)
+        if result is None and cached_answer is None and STREAM_ANSWERS:
+            with span("answer_stream"):
+                result, sent_messages = await stream_to_message(callback.message, stream_answer(explain_query))
+            logging.info(f"Объяснение (поток): {result}")
+            if not sent_messages:
+                await callback.message.answer("Не получилось получить объяснение. Попробуй ещё раз.")
+            await callback.answer()
+            return
+        if result is not None:
+            logging.info("Объяснение взято из предзагрузки")
+            success = True
+        elif cached_answer is not None:
+            logging.info("Объяснение взято из кэша")
+            result, success = cached_answer, True
+        else:
+            with span("answer"):
+                result, success = await answer_question(explain_query, cache_checked=True)
         logging.info(f"Объяснение: {result}, получилось: {success}")
         if success:
-            formatted_result, format_success = await format_response(result)
+            with span("format"):
+                formatted_result, format_success = await format_response(result)
             try:
-                # Отправляем новое сообщение
-                await callback.message.answer(
-                    formatted_result if format_success else result,
-                    parse_mode='HTML' if format_success else None
-                )
+                # Отправляем новое сообщение (или несколько, если объяснение длинное)
+                with span("send"):
+                    await send_long_message(
+                        callback.message,
+                        formatted_result if format_success else result,
+                        parse_mode='HTML' if format_success else None
+                    )
             except TelegramBadRequest as e:
                 logging.error(f"Ошибка Telegram при отправке объяснения: {str(e)}")
                 await callback.message.answer("Не получилось отправить объяснение. Попробуй ещё раз.")
         else:
             await callback.message.answer(result)
+    except StreamInterrupted as e:
+        logging.warning(f"Объяснение оборвалось на {len(e.text)} символах")
     except Exception as e:
         logging.error(f"Ошибка при объяснении: {str(e)}")
         await callback.message.answer(f"Ошибка при объяснении: {str(e)}")
 
     await callback.answer()
 
+# Разбираем параметры запуска: по умолчанию polling, для продакшена - вебхук и несколько процессов
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="AI YALY Telegram бот")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=get_setting("BOT_MODE", "polling"))
+    parser.add_argument("--workers", type=int, default=int(get_setting("BOT_WORKERS", "1")))
+    parser.add_argument("--host", default=get_setting("WEBHOOK_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(get_setting("WEBHOOK_PORT", "8080")))
+    parser.add_argument("--webhook-url", default=get_setting("WEBHOOK_URL"))
+    parser.add_argument("--webhook-path", default=get_setting("WEBHOOK_PATH", "/webhook"))
+    parser.add_argument("--webhook-secret", default=get_setting("WEBHOOK_SECRET"))
+    # Метрики Prometheus на отдельном порту (по умолчанию выключены); у N-го процесса порт + N
+    parser.add_argument("--metrics-host", default=get_setting("METRICS_HOST", "127.0.0.1"))
+    parser.add_argument("--metrics-port", type=int, default=int(get_setting("METRICS_PORT", "0")))
+    # Показать, сколько стоят импорты и инициализация, и выйти
+    parser.add_argument("--profile-startup", action="store_true")
+    return parser.parse_args()
+
+async def shutdown():
+    if db is not None:
+        await db.close()
+    await close_client()
+    await close_text_client()
+    close_image_models()
+    await close_store()
+    shutdown_pool()
+    shutdown_audio_pool()
+    if bot is not None:
+        await bot.session.close()
+
+async def start_metrics(args: argparse.Namespace, worker_number: int = 0):
+    if not args.metrics_port:
+        return None
+    port = args.metrics_port + worker_number
+    try:
+        return await start_metrics_server(args.metrics_host, port)
+    except OSError as e:
+        # Порт занят или адрес недоступен: бот работает дальше, просто без /metrics
+        logging.error(f"Не смог открыть метрики на {args.metrics_host}:{port}, работаю без них: {str(e)}")
+        return None
+
 # Запускаем бота
-async def main():
-    await dp.start_polling(bot)
+async def main(args: argparse.Namespace):
+    create_bot()
+    open_database()
+    await train_from_db(db)
+    metrics_runner = await start_metrics(args)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await shutdown()
+
+# Один процесс с вебхуком: принимает апдейты и обрабатывает их из своей очереди
+async def run_webhook(args: argparse.Namespace, sock=None, worker_number: int = 0):
+    create_bot(workers=args.workers)
+    open_database()
+    await train_from_db(db)
+    app = create_webhook_app(dp, bot, args.webhook_secret, path=args.webhook_path)
+    metrics_runner = await start_metrics(args, worker_number)
+    try:
+        await serve(app, host=args.host, port=args.port, sock=sock)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await shutdown()
+
+# Всё, что бот делает при запуске и на первых запросах, - по шагам, для --profile-startup
+def startup_steps() -> list[tuple]:
+    return [
+        ("конфиг", load_config),
+        ("бот", create_bot),
+        ("база", open_database),
+        ("классификатор намерений", lambda: train_from_db(db)),
+        ("клиент OpenRouter", get_client),
+        ("клиент pollinations", get_text_client),
+    ]
+
+async def profile_startup():
+    await print_startup_report(startup_steps())
+    await shutdown()
+
+def webhook_worker(worker_number: int, sock, args: argparse.Namespace):
+    asyncio.run(run_webhook(args, sock, worker_number))
+
+async def register_webhook(args: argparse.Namespace):
+    if not args.webhook_url:
+        raise SystemExit("Для режима webhook нужен --webhook-url (или WEBHOOK_URL)")
+    await set_webhook(bot, args.webhook_url.rstrip("/") + args.webhook_path, args.webhook_secret)
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    args = parse_args()
+    if args.profile_startup:
+        asyncio.run(profile_startup())
+    elif args.mode == "polling":
+        asyncio.run(main(args))
+    else:
+        # Без секрета любой, кто знает адрес, может слать нам поддельные апдейты.
+        # Если секрет не задан, придумываем свой на этот запуск: его получат Telegram и все процессы
+        if not args.webhook_secret:
+            args.webhook_secret = secrets.token_urlsafe(32)
+            logging.info("WEBHOOK_SECRET не задан, сгенерировал случайный секрет для вебхука")
+
+        # Вебхук ставим один раз, дальше один или N процессов слушают один сокет
+        async def prepare():
+            create_bot()
+            await register_webhook(args)
+            await bot.session.close()
+        asyncio.run(prepare())
+        if args.workers <= 1:
+            asyncio.run(run_webhook(args))
+        else:
+            listener = bind_socket(args.host, args.port)
+            for process in start_workers(args.workers, webhook_worker, listener, args):
+                process.join()
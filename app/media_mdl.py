@@ -0,0 +1,147 @@
+import asyncio
+import binascii
+import io
+import logging
+from contextlib import asynccontextmanager
+from aiogram import Bot
+from metrics_mdl import registry
+from config_mdl import get_setting
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Сколько картинок одновременно держим в памяти; остальные ждут свободный буфер
+MEDIA_MAX_IN_FLIGHT = int(get_setting("MEDIA_MAX_IN_FLIGHT", "8"))
+# Больше этого Bot API всё равно не отдаёт
+MEDIA_MAX_BYTES = 20 * 1024 * 1024
+# Буферы крупнее этого после использования не храним, чтобы одна большая фотка не держала память
+MEDIA_KEEP_BYTES = 4 * 1024 * 1024
+# С какого размера base64 считаем в отдельном потоке, а не в цикле событий
+THREAD_ENCODE_BYTES = 256 * 1024
+
+class MediaTooLarge(Exception):
+    pass
+
+# Переиспользуемый буфер под одну скачанную картинку. Умеет принимать куски от bot.download_file
+# (как файл на запись), а данные отдаёт через memoryview без копирования
+class MediaBuffer:
+    def __init__(self, capacity: int = 0):
+        self.data = bytearray(capacity)
+        self.length = 0
+
+    def reserve(self, size: int):
+        if size > len(self.data):
+            # Новый массив вместо extend: на старый ещё могут смотреть memoryview, и resize упадёт
+            data = bytearray(size)
+            data[:self.length] = memoryview(self.data)[:self.length]
+            self.data = data
+
+    def write(self, chunk: bytes) -> int:
+        end = self.length + len(chunk)
+        if end > MEDIA_MAX_BYTES:
+            raise MediaTooLarge(f"Файл больше {MEDIA_MAX_BYTES // (1024 * 1024)} МБ")
+        if end > len(self.data):
+            # Telegram не сообщил размер или ошибся - растём с запасом
+            self.reserve(max(end, len(self.data) * 2))
+        self.data[self.length:end] = chunk
+        self.length = end
+        return len(chunk)
+
+    def flush(self):
+        pass
+
+    def view(self) -> memoryview:
+        return memoryview(self.data)[:self.length]
+
+    def reset(self):
+        self.length = 0
+        if len(self.data) > MEDIA_KEEP_BYTES:
+            try:
+                # Обрезаем на месте: новые 4 МБ после каждой большой фотки не выделяем
+                del self.data[MEDIA_KEEP_BYTES:]
+            except BufferError:
+                # На буфер ещё смотрит memoryview (например, из traceback) - отпускаем его,
+                # память под следующую картинку выделит reserve по её размеру
+                self.data = bytearray()
+
+# Чтение из memoryview как из файла - так PIL открывает картинку прямо из буфера, без BytesIO-копии
+class ViewReader(io.RawIOBase):
+    def __init__(self, view: memoryview | bytes):
+        self._view = memoryview(view)
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        size = min(len(target), len(self._view) - self._position)
+        target[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+# Пул буферов: ограничивает и число картинок в памяти, и выделения памяти под каждую
+class MediaBufferPool:
+    def __init__(self, max_in_flight: int = MEDIA_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._free = []
+        self.in_use = 0
+
+    @asynccontextmanager
+    async def acquire(self, expected_size: int | None = None):
+        async with self._semaphore:
+            buffer = self._free.pop() if self._free else MediaBuffer()
+            if expected_size:
+                buffer.reserve(min(expected_size, MEDIA_MAX_BYTES))
+            self.in_use += 1
+            try:
+                yield buffer
+            finally:
+                self.in_use -= 1
+                buffer.reset()
+                self._free.append(buffer)
+
+    def allocated_bytes(self) -> int:
+        return sum(len(buffer.data) for buffer in self._free)
+
+photo_buffers = MediaBufferPool()
+
+# Качаем файл из Telegram прямо в буфер, кусками, без промежуточного BytesIO
+async def download_to_buffer(bot: Bot, file_path: str, buffer: MediaBuffer, timeout: int = 30) -> memoryview:
+    await bot.download_file(file_path, destination=buffer, timeout=timeout, seek=False)
+    return buffer.view()
+
+def _encode_data_url(data, mime: str) -> str:
+    return f"data:{mime};base64," + binascii.b2a_base64(data, newline=False).decode("ascii")
+
+# Готовим data URL для модели. Большие картинки кодируем в отдельном потоке, чтобы не стопорить бота
+async def encode_data_url(data: bytes | memoryview, mime: str = "image/jpeg") -> str:
+    if len(data) >= THREAD_ENCODE_BYTES:
+        return await asyncio.to_thread(_encode_data_url, data, mime)
+    return _encode_data_url(data, mime)
+
+def _collect_metrics() -> list[tuple]:
+    return [
+        ("bot_media_buffers_in_use", "gauge", "Картинки, которые сейчас в памяти", {}, photo_buffers.in_use),
+        ("bot_media_buffer_free_bytes", "gauge", "Память свободных буферов под картинки", {},
+         photo_buffers.allocated_bytes()),
+    ]
+
+registry.add_collector(_collect_metrics)
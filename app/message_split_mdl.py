@@ -0,0 +1,158 @@
+import html
+import logging
+import re
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, InlineKeyboardMarkup, BufferedInputFile
+from config_mdl import get_setting
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Лимит длины одного сообщения в Telegram. Считаем вместе с разметкой - так с запасом
+MESSAGE_LIMIT = 4096
+# Больше стольких сообщений не шлём - такой ответ уходит файлом
+SPLIT_MAX_PARTS = int(get_setting("SPLIT_MAX_PARTS", "5"))
+
+_TAG = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^>]*>")
+_ENTITY = re.compile(r"&(#\d+|#x[0-9a-fA-F]+|\w+);")
+
+# Приоритеты мест разреза: граница абзаца или блока кода, перенос строки, пробел
+_PARAGRAPH, _LINE, _SPACE = 3, 2, 1
+
+# Ищем, где резать текст, начиная со start. stack - открытые теги ((имя, открывающий тег), ...).
+# None - остаток влезает целиком, иначе (позиция, открытые в ней теги). Позиция start - резать негде
+def _find_cut(text: str, start: int, stack: tuple, budget: int, parse_html: bool) -> tuple[int, tuple] | None:
+    assert budget > 0
+    candidates = {}
+    closers = sum(len(name) + 3 for name, _ in stack)
+    last_safe = None
+    position = start
+    while True:
+        fits = position - start + closers <= budget
+        if position >= len(text) and fits:
+            return None
+        if position >= len(text) or not fits:
+            break
+        last_safe = (position, stack)
+        char = text[position]
+        if parse_html and char == "<":
+            match = _TAG.match(text, position)
+            if match:
+                closing, name = match.group(1), match.group(2).lower()
+                position = match.end()
+                if closing:
+                    if stack and stack[-1][0] == name:
+                        stack = stack[:-1]
+                        closers -= len(name) + 3
+                    if name == "pre" and not stack and position - start + closers <= budget:
+                        candidates[_PARAGRAPH] = (position, stack)
+                else:
+                    stack = stack + ((name, match.group(0)),)
+                    closers += len(name) + 3
+                continue
+        if parse_html and char == "&":
+            match = _ENTITY.match(text, position)
+            if match:
+                position = match.end()
+                continue
+        position += 1
+        if position - start + closers > budget:
+            continue
+        if char == "\n":
+            in_pre = any(name == "pre" for name, _ in stack)
+            if not in_pre and text.startswith("\n", position):
+                candidates[_PARAGRAPH] = (position, stack)
+            else:
+                candidates[_LINE] = (position, stack)
+        elif char == " ":
+            candidates[_SPACE] = (position, stack)
+
+    # Берём лучшую границу, если она не слишком близко к началу; иначе режем где пришлось
+    for priority in (_PARAGRAPH, _LINE, _SPACE):
+        candidate = candidates.get(priority)
+        if candidate and candidate[0] - start >= budget // 4:
+            return candidate
+    if last_safe is None or last_safe[0] == start:
+        # Даже один тег не влез. В HTML по лимиту резать нельзя - разорвём тег, решает split_message
+        return (start, stack) if parse_html else (start + budget, stack)
+    return last_safe
+
+# Режем текст на части не длиннее limit. Для HTML закрываем открытые теги в конце части
+# и открываем их заново в начале следующей, чтобы каждая часть была валидной
+def split_message(text: str, parse_html: bool = False, limit: int = MESSAGE_LIMIT) -> list[str]:
+    parts = []
+    start = 0
+    stack = ()
+    while start < len(text):
+        prefix = "".join(tag for _, tag in stack)
+        budget = limit - len(prefix)
+        cut = _find_cut(text, start, stack, budget, parse_html) if budget > 0 else (start, stack)
+        if cut is None:
+            parts.append(prefix + text[start:])
+            break
+        position, open_tags = cut
+        if position <= start:
+            # Тег длиннее лимита (например, ссылка с огромным адресом) - валидные HTML-части не собрать.
+            # Шлём текст без разметки, экранированный: в нём тегов нет, и резать есть где
+            if parse_html and _TAG.search(text):
+                return split_message(html.escape(_plain_text(text, "HTML"), quote=False), True, limit)
+            position, open_tags = start + max(budget, 1), ()
+        closers = "".join(f"</{name}>" for name, _ in reversed(open_tags))
+        part = prefix + text[start:position]
+        parts.append((part.rstrip() if not open_tags else part) + closers)
+        start, stack = position, open_tags
+        if not stack:
+            # Пустые строки на стыке частей не нужны
+            while start < len(text) and text[start] in "\n ":
+                start += 1
+    return [part for part in parts if part.strip()] or [text[:limit]]
+
+def _plain_text(text: str, parse_mode: str | None) -> str:
+    if parse_mode != "HTML":
+        return text
+    return html.unescape(_TAG.sub("", text))
+
+async def _send_document(message: Message, text: str, parse_mode: str | None,
+                         reply_markup: InlineKeyboardMarkup | None) -> Message:
+    document = BufferedInputFile(_plain_text(text, parse_mode).encode("utf-8"), filename="answer.txt")
+    return await message.answer_document(document, caption="Ответ получился длинным - он в файле.",
+                                         reply_markup=reply_markup)
+
+async def _send_rest(message: Message, parts: list[str], parse_mode: str | None,
+                     reply_markup: InlineKeyboardMarkup | None) -> list[Message]:
+    # Части уходят строго по очереди: Telegram нумерует сообщения в порядке прихода запросов.
+    # Лимиты и повторы после 429 берёт на себя очередь отправки (send_queue_mdl)
+    sent = []
+    for index, part in enumerate(parts):
+        sent.append(await message.answer(
+            part, parse_mode=parse_mode, reply_markup=reply_markup if index == len(parts) - 1 else None
+        ))
+    return sent
+
+# Отправляем ответ любой длины: несколько сообщений (кнопки на последнем) или файл, если частей слишком много
+async def send_long_message(message: Message, text: str, parse_mode: str | None = None,
+                            reply_markup: InlineKeyboardMarkup | None = None) -> list[Message]:
+    parts = split_message(text, parse_html=parse_mode == "HTML")
+    if len(parts) > SPLIT_MAX_PARTS:
+        return [await _send_document(message, text, parse_mode, reply_markup)]
+    return await _send_rest(message, parts, parse_mode, reply_markup)
+
+# То же для уже отправленного сообщения: первая часть заменяет его текст, остальные приходят следом
+async def edit_long_message(sent: Message, text: str, parse_mode: str | None = None,
+                            reply_markup: InlineKeyboardMarkup | None = None) -> list[Message]:
+    parts = split_message(text, parse_html=parse_mode == "HTML")
+    document = len(parts) > SPLIT_MAX_PARTS
+    first = "Ответ получился длинным - отправляю файлом." if document else parts[0]
+    try:
+        await sent.edit_text(first, parse_mode=None if document else parse_mode,
+                             reply_markup=reply_markup if len(parts) == 1 else None)
+    except TelegramBadRequest as e:
+        # Текст не поменялся - это не ошибка
+        if "message is not modified" not in str(e):
+            raise
+    if document:
+        return [sent, await _send_document(sent, text, parse_mode, reply_markup)]
+    return [sent] + await _send_rest(sent, parts[1:], parse_mode, reply_markup)
@@ -0,0 +1,91 @@
+import logging
+import time
+from typing import AsyncIterator
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, InlineKeyboardMarkup
+from response_formatter_mdl import format_response
+from message_split_mdl import edit_long_message, MESSAGE_LIMIT
+from config_mdl import get_setting
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Telegram не любит частые правки одного сообщения, поэтому правим не чаще раза в секунду
+EDIT_INTERVAL = float(get_setting("STREAM_EDIT_INTERVAL", "1.0"))
+# Минимальный прирост текста, ради которого стоит делать правку
+EDIT_MIN_GROWTH = 20
+CURSOR = " ▌"
+
+# Поток оборвался, когда часть ответа уже показали: такой ответ неполный, его не сохраняем
+class StreamInterrupted(Exception):
+    def __init__(self, text: str, messages: list[Message]):
+        self.text = text
+        self.messages = messages
+        super().__init__("Поток ответа оборвался")
+
+def _preview(text: str) -> str:
+    text = text.strip()
+    if len(text) + len(CURSOR) > MESSAGE_LIMIT:
+        text = text[:MESSAGE_LIMIT - len(CURSOR) - 1] + "…"
+    return text + CURSOR
+
+async def _safe_edit(sent: Message, text: str, **kwargs):
+    try:
+        await sent.edit_text(text, **kwargs)
+    except TelegramBadRequest as e:
+        # Текст не поменялся - это не ошибка
+        if "message is not modified" not in str(e):
+            raise
+
+# Пишем поток кусочков текста в одно сообщение, сливая правки по времени.
+# Возвращаем полный текст и отправленные сообщения (длинный ответ в конце делится на части;
+# пустой список, если ничего не пришло). Если поток оборвался после первого куска - StreamInterrupted
+async def stream_to_message(
+    message: Message,
+    chunks: AsyncIterator[str],
+    reply_markup: InlineKeyboardMarkup | None = None,
+) -> tuple[str, list[Message]]:
+    text = ""
+    sent = None
+    shown_length = 0
+    last_edit = 0.0
+
+    try:
+        async for delta in chunks:
+            text += delta
+            if not text.strip():
+                continue
+            now = time.monotonic()
+            if sent is None:
+                # Первый кусочек отправляем сразу - это и есть время до первого ответа
+                sent = await message.answer(_preview(text))
+                shown_length, last_edit = len(text), now
+            elif now - last_edit >= EDIT_INTERVAL and len(text) - shown_length >= EDIT_MIN_GROWTH:
+                # Пока ждём Telegram, новые кусочки копятся в очереди и уйдут одной правкой
+                await _safe_edit(sent, _preview(text))
+                shown_length, last_edit = len(text), time.monotonic()
+    except Exception as e:
+        logging.error(f"Поток ответа оборвался: {str(e)}")
+        if sent is None:
+            raise
+        await _safe_edit(sent, _preview(text).removesuffix(CURSOR) + "\n\n(ответ оборвался)")
+        raise StreamInterrupted(text, [sent]) from e
+
+    if sent is None:
+        return text, []
+
+    # Поток закончился: форматируем целиком, длинный ответ делим на части, кнопки - на последнюю
+    formatted_text, format_success = await format_response(text)
+    try:
+        return text, await edit_long_message(
+            sent,
+            formatted_text if format_success else text,
+            parse_mode='HTML' if format_success else None,
+            reply_markup=reply_markup
+        )
+    except TelegramBadRequest as e:
+        logging.error(f"Ошибка Telegram при финальной правке: {str(e)}")
+        return text, await edit_long_message(sent, text.strip(), reply_markup=reply_markup)
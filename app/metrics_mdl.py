@@ -0,0 +1,302 @@
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Iterable
+from aiohttp import web
+from config_mdl import get_setting
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Границы корзин гистограмм задержек, в секундах
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Сколько последних замеров держим на каждую метку для p50/p95/p99
+RESERVOIR_SIZE = 2048
+# Писать ли по каждому апдейту JSON-строку с таймингами этапов
+METRICS_JSON_LOG = get_setting("METRICS_JSON_LOG", "0") == "1"
+
+json_logger = logging.getLogger("timings")
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+def _percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+# Базовая метрика: имя, описание и набор меток
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+# Счётчик, который только растёт (ошибки, вызовы)
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+# Текущее значение (сколько сейчас выполняется, длина очереди)
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+# Гистограмма задержек + последние замеры для перцентилей
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._recent = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+                self._recent[key] = deque(maxlen=RESERVOIR_SIZE)
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state["buckets"][index] += 1
+            state["count"] += 1
+            state["sum"] += value
+            self._recent[key].append(value)
+
+    def percentiles(self, percents: tuple = (50, 95, 99)) -> dict:
+        # {значения меток: {"count": N, "p50": ..., ...}} по последним замерам
+        with self._lock:
+            recent = {key: list(values) for key, values in self._recent.items()}
+            counts = {key: state["count"] for key, state in self._values.items()}
+        return {
+            key: {"count": counts[key], **{f"p{percent}": _percentile(values, percent) for percent in percents}}
+            for key, values in recent.items()
+        }
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = [(key, dict(state, buckets=list(state["buckets"]))) for key, state in self._values.items()]
+        lines = self.header()
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state["buckets"]):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ("le",), key + (repr(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames + ("le",), key + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {state['count']}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {state['sum']}")
+            lines.append(f"{self.name}_count{labels} {state['count']}")
+        return lines
+
+# Все метрики процесса и функции, которые снимают значения в момент запроса /metrics
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    # collector возвращает [(имя, тип, описание, {метки}, значение)]
+    def add_collector(self, collector: Callable[[], list[tuple]]):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        described = set()
+        for collector in self.collectors:
+            try:
+                samples = collector()
+            except Exception as e:
+                logging.error(f"Метрики: сборщик упал: {str(e)}")
+                continue
+            for name, kind, documentation, labels, value in samples:
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {name} {documentation}")
+                    lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+stage_latency = registry.register(Histogram(
+    "bot_stage_latency_seconds", "Время этапа обработки апдейта", ("stage", "intent")))
+stage_in_flight = registry.register(Gauge(
+    "bot_stage_in_flight", "Сколько этапов выполняется прямо сейчас", ("stage",)))
+handler_latency = registry.register(Histogram(
+    "bot_handler_latency_seconds", "Полное время обработчика", ("handler",)))
+updates_in_flight = registry.register(Gauge(
+    "bot_updates_in_flight", "Сколько апдейтов обрабатывается прямо сейчас"))
+backend_latency = registry.register(Histogram(
+    "bot_backend_latency_seconds", "Время вызова бэкенда (без ожидания в очереди)", ("backend",)))
+backend_wait = registry.register(Histogram(
+    "bot_backend_queue_wait_seconds", "Ожидание слота бэкенда в очереди", ("backend",)))
+backend_in_flight = registry.register(Gauge(
+    "bot_backend_in_flight", "Сколько вызовов бэкенда выполняется прямо сейчас", ("backend",)))
+errors_total = registry.register(Counter(
+    "bot_errors_total", "Ошибки по этапам и бэкендам", ("stage", "backend", "exception")))
+
+# Трасса текущего апдейта: ID, пользователь, намерение и список этапов
+_trace = contextvars.ContextVar("trace", default=None)
+
+def start_trace(update_id: int | None, user_id: int | None, handler: str) -> dict:
+    trace = {"update_id": update_id, "user_id": user_id, "handler": handler, "intent": None, "spans": []}
+    _trace.set(trace)
+    return trace
+
+def set_trace_intent(intent: str):
+    trace = _trace.get()
+    if trace is not None:
+        trace["intent"] = intent
+
+def finish_trace(trace: dict, duration: float, error: BaseException | None = None):
+    handler_latency.observe(duration, handler=trace["handler"])
+    if error is not None:
+        errors_total.inc(stage="handler", backend="", exception=type(error).__name__)
+    if METRICS_JSON_LOG:
+        json_logger.info(json.dumps({
+            **trace,
+            "duration_ms": round(duration * 1000, 2),
+            "error": type(error).__name__ if error is not None else None,
+        }, ensure_ascii=False))
+
+# Замеряем этап обработки: гистограмма, счётчик ошибок и запись в трассу апдейта
+@contextmanager
+def span(stage: str):
+    trace = _trace.get()
+    stage_in_flight.inc(stage=stage)
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        stage_in_flight.dec(stage=stage)
+        intent = trace["intent"] if trace is not None else None
+        stage_latency.observe(duration, stage=stage, intent=intent or "")
+        if error is not None:
+            errors_total.inc(stage=stage, backend="", exception=type(error).__name__)
+        if trace is not None:
+            trace["spans"].append({
+                "stage": stage,
+                "ms": round(duration * 1000, 2),
+                **({"error": type(error).__name__} if error is not None else {}),
+            })
+
+# Замеряем вызов бэкенда внутри слота планировщика
+@contextmanager
+def backend_call(backend: str):
+    backend_in_flight.inc(backend=backend)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        errors_total.inc(stage="", backend=backend, exception=type(e).__name__)
+        raise
+    finally:
+        backend_in_flight.dec(backend=backend)
+        backend_latency.observe(time.perf_counter() - started, backend=backend)
+
+# p50/p95/p99 по этапам и обработчикам - для логов и бенчмарков
+def get_latency_summary() -> dict:
+    return {
+        "stages": {"/".join(filter(None, key)): value for key, value in stage_latency.percentiles().items()},
+        "handlers": {key[0]: value for key, value in handler_latency.percentiles().items()},
+        "backends": {key[0]: value for key, value in backend_latency.percentiles().items()},
+    }
+
+# Middleware для диспетчера: трасса и время на каждый вызов обработчика
+class MetricsMiddleware:
+    async def __call__(self, handler, event, data: dict):
+        update = data.get("event_update")
+        user = data.get("event_from_user")
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", type(event).__name__)
+        trace = start_trace(update.update_id if update else None, user.id if user else None, name)
+        updates_in_flight.inc()
+        started = time.perf_counter()
+        error = None
+        try:
+            return await handler(event, data)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            updates_in_flight.dec()
+            finish_trace(trace, time.perf_counter() - started, error)
+
+async def _metrics_handler(_: web.Request) -> web.Response:
+    return web.Response(body=registry.render().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+def add_metrics_route(app: web.Application, path: str = "/metrics"):
+    app.router.add_get(path, _metrics_handler)
+
+# Отдельный HTTP-сервер с /metrics (чтобы не светить метрики на публичном порту вебхука)
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    add_metrics_route(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,62 @@
+import importlib.util
+import logging
+from typing import TYPE_CHECKING
+import httpx
+from config_mdl import get_setting, require_setting
+
+# openai импортируется в get_client при первом запросе; здесь - только ради аннотации
+if TYPE_CHECKING:
+    import openai
+
+# Настраиваем логирование
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+OPENROUTER_BASE_URL = get_setting("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+
+# Пул соединений: сколько запросов держим одновременно и сколько соединений оставляем тёплыми
+MAX_CONNECTIONS = int(get_setting("OPENAI_MAX_CONNECTIONS", "500"))
+MAX_KEEPALIVE_CONNECTIONS = int(get_setting("OPENAI_MAX_KEEPALIVE", "100"))
+KEEPALIVE_EXPIRY = 60.0
+
+# Таймауты на вызов (в секундах): ответы и картинки бывают долгими, форматирование - нет
+ANSWER_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
+VISION_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
+FORMAT_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+
+# Один асинхронный клиент на весь процесс
+client = None
+
+# Клиент и сам пакет openai (его импорт - около трети секунды) появляются при первом запросе к модели
+def get_client() -> "openai.AsyncOpenAI":
+    global client
+    if client is None:
+        import openai
+        # HTTP/2 включаем, только если установлен пакет h2
+        http2 = importlib.util.find_spec("h2") is not None
+        http_client = openai.DefaultAsyncHttpxClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            timeout=ANSWER_TIMEOUT,
+        )
+        client = openai.AsyncOpenAI(
+            api_key=require_setting("OPENAI_API_KEY"),
+            base_url=OPENROUTER_BASE_URL,
+            http_client=http_client,
+            max_retries=2,
+        )
+        logging.info(f"Создал общий клиент OpenRouter (HTTP/2: {http2}, соединений: {MAX_CONNECTIONS})")
+    return client
+
+# Закрываем соединения при остановке бота
+async def close_client():
+    global client
+    if client is not None:
+        await client.close()
+        client = None
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from typing import TYPE_CHECKING
+import httpx
+from config_mdl import get_setting
+
+# pollinations импортируется в _create_image_model; здесь - только ради аннотации
+if TYPE_CHECKING:
+    import pollinations
+
+# Настраиваем логирование
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Адреса API pollinations можно подменить (например, на локальные заглушки в бенчмарке)
+POLLINATIONS_TEXT_URL = get_setting("POLLINATIONS_TEXT_URL")
+POLLINATIONS_IMAGE_URL = get_setting("POLLINATIONS_IMAGE_URL")
+
+# Библиотека берёт адрес из констант, поэтому свой адрес ставим, заменив её клиент
+def _override_client(model, base_url: str | None):
+    if base_url:
+        model._client.close()
+        model._client = httpx.Client(base_url=base_url)
+    return model
+
+# Модели картинок не создаём на каждый запрос: у каждой свой httpx-клиент с пулом соединений.
+# Свободные модели ждут здесь; одновременно занятых не больше, чем слотов бэкенда "image"
+_idle_image_models = []
+
+# Пакет pollinations импортируем при первой генерации: воркеру, который картинки не рисует, он не нужен
+def _create_image_model() -> "pollinations.Image":
+    import pollinations
+    return _override_client(pollinations.Image(), POLLINATIONS_IMAGE_URL)
+
+# Генерируем картинку свободной моделью из пула, настроив её на запрос (размер, сид и т.д.).
+# Возвращаем байты ответа. Модель возвращается в пул из потока, когда тот с ней закончил, -
+# даже если ожидающего уже отменили
+async def run_image_model(prompt: str, **params) -> bytes | None:
+    loop = asyncio.get_running_loop()
+    model = _idle_image_models.pop() if _idle_image_models else _create_image_model()
+    for name, value in params.items():
+        setattr(model, name, value)
+
+    def generate() -> bytes | None:
+        try:
+            model(prompt)
+            return model.response
+        finally:
+            model.request = model.response = model.image = None
+            try:
+                loop.call_soon_threadsafe(_idle_image_models.append, model)
+            except RuntimeError:
+                # Цикл уже закрыт - бот выключается
+                model._client.close()
+
+    return await loop.run_in_executor(None, generate)
+
+def close_image_models():
+    while _idle_image_models:
+        _idle_image_models.pop()._client.close()
+
+# Текстовые запросы к pollinations идут через общий асинхронный клиент, а не через pollinations.Text:
+# тот блокирует поток и хранит последний ответ в самом объекте, так что общий объект нельзя звать параллельно
+POLLINATIONS_TEXT_API = "https://text.pollinations.ai/"
+POLLINATIONS_TIMEOUT = httpx.Timeout(100.0, connect=5.0)
+
+text_client = None
+
+def get_text_client() -> httpx.AsyncClient:
+    global text_client
+    if text_client is None:
+        text_client = httpx.AsyncClient(
+            base_url=POLLINATIONS_TEXT_URL or POLLINATIONS_TEXT_API,
+            headers={"Accept": "application/json"},
+            timeout=POLLINATIONS_TIMEOUT,
+        )
+    return text_client
+
+async def close_text_client():
+    global text_client
+    if text_client is not None:
+        await text_client.aclose()
+        text_client = None
@@ -1,8 +1,10 @@
-import asyncio
+import html
 import logging
-from openai import OpenAI
-import os
-import json
+import re
+from html.parser import HTMLParser
+from openai_client_mdl import FORMAT_TIMEOUT
+from router_mdl import complete_task
+from config_mdl import get_setting
 
 # Настраиваем логирование
 logging.basicConfig(
@@ -10,64 +12,206 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-# Читаем API ключ для OpenAI
-def load_openai_api_key():
-    api_keys_path = os.path.join('api_keys', 'api_keys.json')
-    try:
-        with open(api_keys_path, 'r') as file:
-            data = json.load(file)
-            return data['openai_api_key']
-    except FileNotFoundError:
-        logging.error("Не нашёл api_keys.json в папке api_keys")
-        raise
-    except KeyError:
-        logging.error("В api_keys.json нет ключа openai_api_key")
-        raise
-    except json.JSONDecodeError:
-        logging.error("Не смог разобрать JSON в api_keys.json")
-        raise
-
-# Создаём клиент для OpenAI
-client = OpenAI(
-    api_key=load_openai_api_key(),
-    base_url="https://openrouter.ai/api/v1",
+# Режим форматирования: "local" - быстро и без сети, "llm" - через OpenRouter (по желанию)
+FORMATTER_MODE = get_setting("FORMATTER_MODE", "local")
+
+# Теги, которые Telegram понимает в parse_mode='HTML', и их разрешённые атрибуты
+ALLOWED_TAGS = {
+    "b": set(), "strong": set(),
+    "i": set(), "em": set(),
+    "u": set(), "ins": set(),
+    "s": set(), "strike": set(), "del": set(),
+    "code": {"class"}, "pre": set(),
+    "a": {"href"},
+    "tg-spoiler": set(), "span": {"class"},
+    "blockquote": {"expandable"},
+}
+
+# Чистим HTML: оставляем только теги Telegram и закрываем всё незакрытое
+class _TelegramHTMLSanitizer(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.open_tags = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "br":
+            self.parts.append("\n")
+            return
+        if tag not in ALLOWED_TAGS:
+            return
+        if tag == "span" and ("class", "tg-spoiler") not in attrs:
+            return
+        allowed_attrs = ALLOWED_TAGS[tag]
+        rendered = "".join(
+            f' {name}="{html.escape(value or "", quote=True)}"'
+            for name, value in attrs
+            if name in allowed_attrs and value is not None
+        )
+        self.parts.append(f"<{tag}{rendered}>")
+        self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag not in self.open_tags:
+            return
+        # Закрываем всё, что открыто внутри, чтобы вложенность была правильной
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.parts.append(f"</{open_tag}>")
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        self.parts.append(html.escape(data, quote=False))
+
+    def result(self) -> str:
+        self.close()
+        while self.open_tags:
+            self.parts.append(f"</{self.open_tags.pop()}>")
+        return "".join(self.parts)
+
+def sanitize_html(text: str) -> str:
+    sanitizer = _TelegramHTMLSanitizer()
+    sanitizer.feed(text)
+    return sanitizer.result()
+
+_FENCE_RE = re.compile(r"^```[ \t]*([\w+#.-]*)[ \t]*\n(.*?)(?:^```[ \t]*$|\Z)", re.S | re.M)
+_HEADING_RE = re.compile(r"^#{1,6}\s+(.+?)\s*#*\s*$")
+_BULLET_RE = re.compile(r"^(\s*)[-*+•]\s+(.+)$")
+_NUMBERED_RE = re.compile(r"^(\s*)(\d+)[.)]\s+(.+)$")
+_CODE_LINE_RE = re.compile(
+    r"^\s*(import \w|from [\w.]+ import |def \w+\(|class \w+[:(]|#include|public |private |"
+    r"function \w+\(|const \w+ =|let \w+ =|var \w+ =|for \(|if \(.*\)\s*\{|return\b.*;$|\}$|SELECT |print\()"
 )
+_INLINE_RULES = [
+    (re.compile(r"\*\*(?=\S)(.+?)(?<=\S)\*\*"), r"<b>\1</b>"),
+    (re.compile(r"~~(?=\S)(.+?)(?<=\S)~~"), r"<s>\1</s>"),
+    (re.compile(r"(?<![\w*])\*(?=[^\s*])(.+?)(?<=[^\s*])\*(?![\w*])"), r"<i>\1</i>"),
+    (re.compile(r"(?<![\w_])_(?=[^\s_])(.+?)(?<=[^\s_])_(?![\w_])"), r"<i>\1</i>"),
+]
+_LINK_RE = re.compile(r"\[([^\]\n]+)\]\((https?://[^\s)\x00]+)\)")
+_CODE_SPAN_RE = re.compile(r"`([^`\n]+)`")
+# Готовые куски HTML (код, ссылки) на время разбора курсива и жирного заменяем на \x00номер\x00
+_PLACEHOLDER_RE = re.compile(r"\x00(\d+)\x00")
+
+# Похож ли абзац на код без явных ``` вокруг
+def _looks_like_code(lines: list[str]) -> bool:
+    code_lines = sum(1 for line in lines if _CODE_LINE_RE.match(line))
+    return code_lines > 0 and code_lines * 2 >= len(lines)
+
+def _code_block(code: str, language: str = "") -> str:
+    escaped = html.escape(code.strip("\n"), quote=False)
+    if language:
+        return f'<pre><code class="language-{html.escape(language, quote=True)}">{escaped}</code></pre>'
+    return f"<pre><code>{escaped}</code></pre>"
+
+def _emphasize(escaped: str) -> str:
+    for pattern, replacement in _INLINE_RULES:
+        escaped = pattern.sub(replacement, escaped)
+    return escaped
+
+# Строка уже экранирована целиком, поэтому в адресе осталось закрыть только кавычки
+def _link(match: re.Match) -> str:
+    url = match.group(2).replace('"', "&quot;")
+    return f'<a href="{url}">{_emphasize(match.group(1))}</a>'
+
+# Инлайн-разметка: `код`, **жирный**, *курсив*, ссылки.
+# Код и ссылки прячем за заглушками, чтобы * и _ внутри них (в адресе, в коде) не стали курсивом
+def _format_inline(line: str) -> str:
+    spans = []
+
+    def protect(fragment: str) -> str:
+        spans.append(fragment)
+        return f"\x00{len(spans) - 1}\x00"
+
+    line = _CODE_SPAN_RE.sub(
+        lambda match: protect(f"<code>{html.escape(match.group(1), quote=False)}</code>"),
+        line.replace("\x00", ""),
+    )
+    escaped = html.escape(line, quote=False)
+    escaped = _LINK_RE.sub(lambda match: protect(_link(match)), escaped)
+    escaped = _emphasize(escaped)
+    # Текст ссылки сам может содержать заглушку кода, поэтому возвращаем куски, пока они есть
+    while "\x00" in escaped:
+        escaped = _PLACEHOLDER_RE.sub(lambda match: spans[int(match.group(1))], escaped)
+    return escaped
+
+def _format_paragraph(paragraph: str) -> str:
+    lines = paragraph.split("\n")
+    if _looks_like_code(lines):
+        return _code_block(paragraph)
+
+    formatted = []
+    for line in lines:
+        heading = _HEADING_RE.match(line)
+        bullet = _BULLET_RE.match(line)
+        numbered = _NUMBERED_RE.match(line)
+        if heading:
+            formatted.append(f"<b>{_format_inline(heading.group(1))}</b>")
+        elif bullet:
+            formatted.append(f"{bullet.group(1)}• {_format_inline(bullet.group(2))}")
+        elif numbered:
+            formatted.append(f"{numbered.group(1)}{numbered.group(2)}. {_format_inline(numbered.group(3))}")
+        else:
+            formatted.append(_format_inline(line))
+    return "\n".join(formatted)
+
+# Локальное форматирование в HTML для Telegram, без запросов в сеть
+def format_html_local(text: str) -> str:
+    text = text.replace("\r\n", "\n").strip()
+    blocks = []
+    position = 0
+    for match in _FENCE_RE.finditer(text):
+        before = text[position:match.start()]
+        blocks.extend(_format_paragraph(p) for p in re.split(r"\n\s*\n", before) if p.strip())
+        blocks.append(_code_block(match.group(2), match.group(1)))
+        position = match.end()
+    blocks.extend(_format_paragraph(p) for p in re.split(r"\n\s*\n", text[position:]) if p.strip())
+    # На всякий случай прогоняем через фильтр тегов, чтобы Telegram не ругался
+    return sanitize_html("\n\n".join(blocks))
+
+# Старый путь: просим модель (маршрут "format") отформатировать текст в HTML для Telegram
+async def _format_with_llm(text: str) -> str:
+    formatted = await complete_task(
+        "format",
+        [
+            {
+                "role": "system",
+                "content": """
+                Ты спец по форматированию. Переведи текст в HTML для Telegram.
+                - Если видишь код (например, начинается с 'import'), оберни в <pre><code>.
+                - Экранируй символы: '<' → '&lt;', '>' → '&gt;', '&' → '&amp;'.
+                - Для обычного текста добавляй <b>, <i> или другие теги, где нужно.
+                - Верни только готовый HTML для parse_mode='HTML'.
+                """
+            },
+            {"role": "user", "content": text},
+        ],
+        temperature=0.2,
+        max_tokens=10000,
+        timeout=FORMAT_TIMEOUT
+    )
+    return sanitize_html(formatted)
 
 # Форматируем текст для Telegram
-async def format_response(text: str) -> tuple[str, bool]:
+async def format_response(text: str, use_llm: bool | None = None) -> tuple[str, bool]:
     # Проверяем, есть ли текст
     if not text.strip():
         return "Пустой текст, нечего форматировать.", False
 
-    try:
-        # Просим OpenAI отформатировать текст в HTML для Telegram
-        response = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: client.chat.completions.create(
-                model="nousresearch/deephermes-3-mistral-24b-preview:free",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
-                        Ты спец по форматированию. Переведи текст в HTML для Telegram.
-                        - Если видишь код (например, начинается с 'import'), оберни в <pre><code>.
-                        - Экранируй символы: '<' → '&lt;', '>' → '&gt;', '&' → '&amp;'.
-                        - Для обычного текста добавляй <b>, <i> или другие теги, где нужно.
-                        - Верни только готовый HTML для parse_mode='HTML'.
-                        """
-                    },
-                    {"role": "user", "content": text},
-                ],
-                temperature=0.2,
-                stream=False,
-                max_completion_tokens=10000
-            )
-        )
+    if use_llm is None:
+        use_llm = FORMATTER_MODE == "llm"
 
-        # Берём отформатированный текст
-        formatted_text = response.choices[0].message.content.strip()
-        return formatted_text, True
+    if use_llm:
+        try:
+            formatted_text = await _format_with_llm(text)
+            if formatted_text.strip():
+                return formatted_text, True
+        except Exception as e:
+            logging.error(f"Не смог отформатировать текст через LLM, форматирую локально: {str(e)}")
 
+    try:
+        return format_html_local(text), True
     except Exception as e:
         logging.error(f"Не смог отформатировать текст: {str(e)}")
-        return f"Ошибка при форматировании: {str(e)}", False
\ No newline at end of file
+        return f"Ошибка при форматировании: {str(e)}", False
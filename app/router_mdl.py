@@ -0,0 +1,408 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncIterator, Awaitable, Callable
+import httpx
+from metrics_mdl import registry, Counter
+from openai_client_mdl import get_client
+from pollinations_client_mdl import get_text_client, POLLINATIONS_TIMEOUT
+from scheduler_mdl import slot, has_spare_capacity, QueueFull
+from config_mdl import get_setting
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+DEEPHERMES = "openrouter:nousresearch/deephermes-3-mistral-24b-preview:free"
+INTERNVL = "openrouter:opengvlab/internvl3-14b:free"
+POLLINATIONS_OPENAI = "pollinations:openai"
+
+# Модели для каждой задачи в порядке предпочтения: "провайдер:модель".
+# Переопределяется через MODEL_ROUTE_<ЗАДАЧА>, например MODEL_ROUTE_ANSWER="openrouter:a,pollinations:openai"
+DEFAULT_ROUTES = {
+    "answer": [DEEPHERMES, POLLINATIONS_OPENAI],
+    "format": [DEEPHERMES, POLLINATIONS_OPENAI],
+    "summary": [DEEPHERMES, POLLINATIONS_OPENAI],
+    "vision": [INTERNVL, POLLINATIONS_OPENAI],
+    "intent": [POLLINATIONS_OPENAI, DEEPHERMES],
+    "translate": [POLLINATIONS_OPENAI, DEEPHERMES],
+}
+PROVIDERS = ("openrouter", "pollinations")
+
+# Сколько последних вызовов помним и сколько нужно, чтобы верить p95 и доле ошибок
+HEALTH_WINDOW = 100
+MIN_SAMPLES = 20
+# Предохранитель: открывается после стольких ошибок подряд или при такой доле ошибок в окне
+BREAKER_FAILURES = 5
+BREAKER_ERROR_RATE = 0.5
+# Сколько секунд модель отдыхает, прежде чем пустим к ней один пробный запрос
+BREAKER_COOLDOWN = float(get_setting("ROUTER_BREAKER_COOLDOWN", "30"))
+# Дублирующий запрос к следующей модели, если первая думает дольше своего p95 (не раньше, чем через секунду)
+ROUTER_HEDGING = get_setting("ROUTER_HEDGING", "1") == "1"
+HEDGE_MIN_DELAY = 1.0
+
+# Модель вернула пустой ответ - считаем это ошибкой и идём к следующей
+class EmptyAnswer(Exception):
+    pass
+
+def load_routes() -> dict[str, list[str]]:
+    routes = {}
+    for task, default in DEFAULT_ROUTES.items():
+        value = get_setting(f"MODEL_ROUTE_{task.upper()}")
+        routes[task] = [spec.strip() for spec in value.split(",") if spec.strip()] if value else default
+    return routes
+
+# Состояние одной модели: закрыт - работаем, открыт - пропускаем, полуоткрыт - ждём пробный запрос
+class CircuitBreaker:
+    def __init__(self):
+        self.results = deque(maxlen=HEALTH_WINDOW)
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.opened_until = 0.0
+        self.trial_running = False
+
+    def error_rate(self) -> float:
+        return self.results.count(False) / len(self.results) if self.results else 0.0
+
+    # Можно ли сейчас слать запрос. Только проверка - пробный запрос занимает begin()
+    def available(self) -> bool:
+        if self.state == "open":
+            return time.monotonic() >= self.opened_until
+        return self.state == "closed" or not self.trial_running
+
+    # Запрос уходит к модели. После паузы первый такой запрос становится пробным и занимает место:
+    # пока он не вернулся, остальных не пускаем (False)
+    def begin(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() < self.opened_until:
+                return False
+            self.state = "half_open"
+        elif self.trial_running:
+            return False
+        self.trial_running = True
+        return True
+
+    def record(self, ok: bool):
+        self.trial_running = False
+        self.results.append(ok)
+        if ok:
+            self.consecutive_failures = 0
+            if self.state != "closed":
+                self.state = "closed"
+                self.results.clear()
+            return
+        self.consecutive_failures += 1
+        if (self.state == "half_open" or self.consecutive_failures >= BREAKER_FAILURES
+                or (len(self.results) >= MIN_SAMPLES and self.error_rate() > BREAKER_ERROR_RATE)):
+            self.state = "open"
+            self.opened_until = time.monotonic() + BREAKER_COOLDOWN
+
+    # Запрос не дошёл до модели (отменён или не дождался очереди) - результата нет
+    def release(self):
+        self.trial_running = False
+
+# Одна модель у одного провайдера. Предохранитель общий для всех задач, задержки - по задачам
+class Target:
+    def __init__(self, spec: str):
+        provider, _, model = spec.partition(":")
+        if provider not in PROVIDERS or not model:
+            raise ValueError(f"Не понимаю модель '{spec}': нужно 'провайдер:модель', провайдеры: {', '.join(PROVIDERS)}")
+        self.name = spec
+        self.provider = provider
+        self.model = model
+        self.breaker = CircuitBreaker()
+
+    async def complete(self, messages: list[dict], temperature: float | None = None, max_tokens: int = 10000,
+                       timeout: httpx.Timeout | None = None, extra_headers: dict | None = None) -> str:
+        if self.provider == "openrouter":
+            options = {"temperature": temperature} if temperature is not None else {}
+            response = await get_client().chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=False,
+                max_completion_tokens=max_tokens,
+                timeout=timeout,
+                extra_headers=extra_headers,
+                **options
+            )
+            answer = (response.choices[0].message.content or "").strip()
+        else:
+            response = await get_text_client().post(
+                "", json=self._pollinations_params(messages, temperature), timeout=timeout or POLLINATIONS_TIMEOUT
+            )
+            response.raise_for_status()
+            answer = response.text.strip()
+        if not answer:
+            raise EmptyAnswer(f"{self.name} вернула пустой ответ")
+        return answer
+
+    async def stream(self, messages: list[dict], temperature: float | None = None, max_tokens: int = 10000,
+                     timeout: httpx.Timeout | None = None) -> AsyncIterator[str]:
+        if self.provider == "openrouter":
+            options = {"temperature": temperature} if temperature is not None else {}
+            stream = await get_client().chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                max_completion_tokens=max_tokens,
+                timeout=timeout,
+                **options
+            )
+            # Если нас перестали слушать, закрываем поток и соединение уходит обратно в пул
+            async with stream:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield delta
+        else:
+            # pollinations отдаёт ответ одним текстом - читаем его кусками по мере прихода
+            async with get_text_client().stream(
+                "POST", "", json=self._pollinations_params(messages, temperature),
+                timeout=timeout or POLLINATIONS_TIMEOUT
+            ) as response:
+                response.raise_for_status()
+                async for text in response.aiter_text():
+                    if text:
+                        yield text
+
+    def _pollinations_params(self, messages: list[dict], temperature: float | None) -> dict:
+        params = {"model": self.model, "messages": messages, "private": True}
+        if temperature is not None:
+            params["temperature"] = temperature
+        return params
+
+# Задержки успешных вызовов одной модели в одной задаче
+class LatencyWindow:
+    def __init__(self):
+        self.samples = deque(maxlen=HEALTH_WINDOW)
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+
+    # p95, когда замеров достаточно; иначе None - хеджировать ещё рано
+    def p95(self) -> float | None:
+        if len(self.samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, round(0.95 * len(ordered)) - 1)]
+
+model_requests = registry.register(Counter(
+    "bot_model_requests_total", "Вызовы моделей по задаче, модели и исходу", ("task", "target", "outcome")))
+model_hedges = registry.register(Counter(
+    "bot_model_hedges_total", "Дублирующие запросы: отправлено и выиграно", ("task", "event")))
+
+# Маршрутизатор: для каждой задачи перебирает модели по порядку, пропуская те, у кого открыт предохранитель
+class ModelRouter:
+    def __init__(self, routes: dict[str, list[str]]):
+        self.targets = {}
+        self.routes = {}
+        for task, specs in routes.items():
+            self.routes[task] = [self.targets.setdefault(spec, Target(spec)) for spec in specs]
+        self.latency = {}
+
+    def _latency(self, task: str, target: Target) -> LatencyWindow:
+        return self.latency.setdefault((task, target.name), LatencyWindow())
+
+    # Строка с маршрутом задачи - для ключей кэша
+    def signature(self, task: str) -> str:
+        return ",".join(target.name for target in self.routes[task])
+
+    # Модели, которым сейчас можно слать запрос, и признак "все на паузе" - тогда пробуем все, кроме тех,
+    # к кому уже ушёл пробный запрос: лучше попытка, чем отказ
+    def _candidates(self, task: str) -> tuple[list[Target], bool]:
+        route = self.routes[task]
+        allowed = [target for target in route if target.breaker.available()]
+        if allowed:
+            return allowed, False
+        return [target for target in route if target.breaker.state != "half_open"], True
+
+    # Следующая модель из candidates, начиная с index, которая пустит запрос: пробный к полуоткрытой
+    # модели уже мог уйти от соседнего запроса. Возвращаем модель (или None) и новый index
+    def _next_target(self, candidates: list[Target], index: int, forced: bool) -> tuple[Target | None, int]:
+        while index < len(candidates):
+            target = candidates[index]
+            index += 1
+            if target.breaker.begin() or forced:
+                return target, index
+        return None, index
+
+    def _record(self, task: str, target: Target, started: float, error: BaseException | None):
+        if error is None:
+            self._latency(task, target).observe(time.monotonic() - started)
+            target.breaker.record(True)
+            model_requests.inc(task=task, target=target.name, outcome="ok")
+        elif isinstance(error, (QueueFull, asyncio.CancelledError)):
+            target.breaker.release()
+        else:
+            target.breaker.record(False)
+            model_requests.inc(task=task, target=target.name, outcome="error")
+            logging.warning(f"Модель {target.name} не справилась с задачей {task}: {type(error).__name__}: {error}")
+
+    # call(target, mark_started): mark_started() зовётся, когда слот планировщика получен, -
+    # ожидание в очереди не должно попадать в задержку модели
+    async def _attempt(self, task: str, target: Target, call: Callable[[Target, Callable[[], None]], Awaitable]):
+        started = time.monotonic()
+
+        def mark_started():
+            nonlocal started
+            started = time.monotonic()
+
+        try:
+            result = await call(target, mark_started)
+        except BaseException as e:
+            self._record(task, target, started, e)
+            raise
+        self._record(task, target, started, None)
+        return result
+
+    # Когда слать дублирующий запрос: после p95 первой модели, если есть куда и бэкенд не занят
+    def _hedge_delay(self, task: str, target: Target) -> float | None:
+        if not ROUTER_HEDGING:
+            return None
+        p95 = self._latency(task, target).p95()
+        return None if p95 is None else max(HEDGE_MIN_DELAY, p95)
+
+    # Выполняем call(target) на первой здоровой модели; при ошибке - на следующей.
+    # Если первая отвечает дольше обычного, параллельно спрашиваем следующую и берём, кто ответит раньше
+    async def run(self, task: str, call: Callable[[Target, Callable[[], None]], Awaitable]):
+        candidates, forced = self._candidates(task)
+        first_target = None
+        pending = {}
+        next_index = 0
+        hedged = False
+        last_error = None
+        try:
+            while pending or next_index < len(candidates):
+                if not pending:
+                    target, next_index = self._next_target(candidates, next_index, forced)
+                    if target is None:
+                        break
+                    first_target = first_target or target
+                    pending[asyncio.create_task(self._attempt(task, target, call))] = target
+                timeout = None
+                if not hedged and len(pending) == 1 and next_index < len(candidates):
+                    timeout = self._hedge_delay(task, next(iter(pending.values())))
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    if has_spare_capacity(task):
+                        target, next_index = self._next_target(candidates, next_index, forced)
+                        if target is not None:
+                            model_hedges.inc(task=task, event="sent")
+                            pending[asyncio.create_task(self._attempt(task, target, call))] = target
+                    continue
+                for finished in done:
+                    target = pending.pop(finished)
+                    try:
+                        result = finished.result()
+                    except QueueFull:
+                        # Очередь общая для всех моделей задачи - следующая упрётся в неё же
+                        if not pending:
+                            raise
+                        continue
+                    except Exception as e:
+                        last_error = e
+                        continue
+                    if hedged and target is not first_target:
+                        model_hedges.inc(task=task, event="won")
+                    return result
+            raise last_error or RuntimeError(f"Для задачи {task} нет доступной модели")
+        finally:
+            # Проигравший запрос больше не нужен; его ошибку забираем, чтобы asyncio не ругался
+            for task_left in pending:
+                task_left.cancel()
+                task_left.add_done_callback(lambda done_task: done_task.cancelled() or done_task.exception())
+
+    # Поток ответа. Переключаемся на следующую модель, только пока не отдали ни одного куска;
+    # задержка до первого куска идёт в статистику модели. Потоки не дублируем - это двойной расход токенов
+    async def stream(self, task: str,
+                     make_stream: Callable[[Target, Callable[[], None]], AsyncIterator[str]]) -> AsyncIterator[str]:
+        last_error = None
+        candidates, forced = self._candidates(task)
+        for target in candidates:
+            if not target.breaker.begin() and not forced:
+                continue
+            started = time.monotonic()
+            first = True
+
+            def mark_started():
+                nonlocal started
+                started = time.monotonic()
+
+            try:
+                async with aclosing(make_stream(target, mark_started)) as chunks:
+                    async for chunk in chunks:
+                        if first:
+                            first = False
+                            self._record(task, target, started, None)
+                        yield chunk
+            except (QueueFull, asyncio.CancelledError):
+                target.breaker.release()
+                raise
+            except Exception as e:
+                if first:
+                    self._record(task, target, started, e)
+                    last_error = e
+                    continue
+                # Часть ответа уже ушла пользователю - менять модель поздно
+                target.breaker.record(False)
+                model_requests.inc(task=task, target=target.name, outcome="error")
+                raise
+            if first:
+                raise EmptyAnswer(f"{target.name} вернула пустой ответ")
+            return
+        raise last_error or RuntimeError(f"Для задачи {task} нет доступной модели")
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "state": target.breaker.state,
+                "error_rate": target.breaker.error_rate(),
+                "p95": {task: window.p95() for (task, target_name), window in self.latency.items()
+                        if target_name == name},
+            }
+            for name, target in self.targets.items()
+        }
+
+model_router = ModelRouter(load_routes())
+
+# Обычный вызов модели для задачи: слот планировщика занимается на каждую попытку отдельно
+async def complete_task(task: str, messages: list[dict], temperature: float | None = None, max_tokens: int = 10000,
+                   timeout: httpx.Timeout | None = None, extra_headers: dict | None = None) -> str:
+    async def call(target: Target, mark_started: Callable[[], None]) -> str:
+        async with slot(task):
+            mark_started()
+            return await target.complete(messages, temperature, max_tokens, timeout, extra_headers)
+    return await model_router.run(task, call)
+
+# Потоковый вызов: слот держим, пока читаем поток
+def stream_task(task: str, messages: list[dict], temperature: float | None = None, max_tokens: int = 10000,
+           timeout: httpx.Timeout | None = None) -> AsyncIterator[str]:
+    async def make_stream(target: Target, mark_started: Callable[[], None]) -> AsyncIterator[str]:
+        async with slot(task):
+            mark_started()
+            async for chunk in target.stream(messages, temperature, max_tokens, timeout):
+                yield chunk
+    return model_router.stream(task, make_stream)
+
+def _collect_metrics() -> list[tuple]:
+    samples = []
+    for name, target in model_router.targets.items():
+        samples.append(("bot_model_breaker_open", "gauge", "Предохранитель модели открыт (1) или полуоткрыт (0.5)",
+                        {"target": name}, {"closed": 0, "half_open": 0.5, "open": 1}[target.breaker.state]))
+    for (task, name), window in model_router.latency.items():
+        p95 = window.p95()
+        if p95 is not None:
+            samples.append(("bot_model_latency_p95_seconds", "gauge", "p95 задержки модели по задаче",
+                            {"task": task, "target": name}, p95))
+    return samples
+
+registry.add_collector(_collect_metrics)
@@ -0,0 +1,238 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+from metrics_mdl import registry, backend_call, backend_wait, errors_total
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Приоритеты: меньше - раньше
+PRIORITY_CALLBACK = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# Лимиты по бэкендам: одновременных вызовов, вызовов в секунду, запас на всплеск, длина очереди
+BACKEND_LIMITS = {
+    "intent": {"concurrency": 8, "rate": 5.0, "burst": 10, "max_queue": 200},
+    "answer": {"concurrency": 16, "rate": 3.0, "burst": 10, "max_queue": 200},
+    "format": {"concurrency": 4, "rate": 3.0, "burst": 5, "max_queue": 100},
+    "translate": {"concurrency": 8, "rate": 5.0, "burst": 10, "max_queue": 200},
+    "image": {"concurrency": 4, "rate": 1.0, "burst": 4, "max_queue": 50},
+    "vision": {"concurrency": 4, "rate": 2.0, "burst": 4, "max_queue": 50},
+    "summary": {"concurrency": 2, "rate": 1.0, "burst": 2, "max_queue": 500},
+    # Куски голосовых распознаются параллельно, поэтому запас на всплеск большой
+    "speech": {"concurrency": 8, "rate": 10.0, "burst": 20, "max_queue": 200},
+}
+
+# Очередь переполнена - отвечаем пользователю сразу, а не ждём таймаута
+class QueueFull(Exception):
+    def __init__(self, backend: str):
+        self.backend = backend
+        super().__init__("Сейчас слишком много запросов, попробуй через минуту.")
+
+# Кто и с каким приоритетом сейчас делает запрос (ставится в начале обработчика)
+class _RequestContext:
+    def __init__(self, user_id, priority: int, on_queued: Callable[[int], Awaitable] | None):
+        self.user_id = user_id
+        self.priority = priority
+        self.on_queued = on_queued
+        # Один запрос может встать в очередь к нескольким бэкендам (намерение, ответ, форматирование),
+        # а о позиции сообщаем только один раз
+        self.queued_notified = False
+
+    async def notify_queued(self, position: int):
+        if self.queued_notified:
+            return
+        self.queued_notified = True
+        await self.on_queued(position)
+
+_request_context = contextvars.ContextVar("request_context", default=_RequestContext(None, PRIORITY_NORMAL, None))
+
+def set_request_context(user_id: int | None, priority: int = PRIORITY_NORMAL,
+                        on_queued: Callable[[int], Awaitable] | None = None):
+    _request_context.set(_RequestContext(user_id, priority, on_queued))
+
+class _Job:
+    def __init__(self, user_id, priority: int, future: asyncio.Future):
+        self.user_id = user_id
+        self.priority = priority
+        self.future = future
+
+# Планировщик одного бэкенда: лимит параллельности, бюджет по скорости и честная очередь
+class BackendScheduler:
+    def __init__(self, name: str, concurrency: int, rate: float, burst: int, max_queue: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        self.completed = 0
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._wakeup = None
+        # priority -> user_id -> очередь заявок; по пользователям ходим по кругу
+        self._queues = {}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _position(self, user_id, priority: int) -> int:
+        # Сколько заявок пройдёт раньше этой при обходе пользователей по кругу
+        ahead = sum(
+            len(jobs)
+            for level, users in self._queues.items() if level < priority
+            for jobs in users.values()
+        )
+        users = self._queues.get(priority, {})
+        own = len(users.get(user_id, ()))
+        ahead += own + sum(min(len(jobs), own + 1) for other, jobs in users.items() if other != user_id)
+        return ahead + 1
+
+    def _next_job(self) -> _Job | None:
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            while users:
+                user_id, jobs = next(iter(users.items()))
+                job = jobs.popleft()
+                if jobs:
+                    users.move_to_end(user_id)
+                else:
+                    del users[user_id]
+                self.queued -= 1
+                if not job.future.done():
+                    return job
+            del self._queues[priority]
+        return None
+
+    def _remove(self, job: _Job):
+        users = self._queues.get(job.priority, {})
+        jobs = users.get(job.user_id)
+        if jobs and job in jobs:
+            jobs.remove(job)
+            self.queued -= 1
+            if not jobs:
+                del users[job.user_id]
+
+    def _dispatch(self):
+        self._wakeup = None
+        self._refill()
+        while self.active < self.concurrency and self.queued:
+            if self._tokens < 1:
+                # Бюджет кончился - проснёмся, когда накопится следующий токен
+                delay = (1 - self._tokens) / self.rate
+                self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            job = self._next_job()
+            if job is None:
+                return
+            self._tokens -= 1
+            self.active += 1
+            job.future.set_result(None)
+
+    async def acquire(self, user_id=None, priority: int = PRIORITY_NORMAL,
+                      on_queued: Callable[[int], Awaitable] | None = None):
+        self._refill()
+        if self.active < self.concurrency and not self.queued and self._tokens >= 1:
+            self._tokens -= 1
+            self.active += 1
+            return
+
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull(self.name)
+
+        position = self._position(user_id, priority)
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(user_id, priority, future)
+        users = self._queues.setdefault(priority, OrderedDict())
+        users.setdefault(user_id, deque()).append(job)
+        self.queued += 1
+        if self._wakeup is None:
+            self._dispatch()
+
+        if on_queued is not None and not future.done():
+            try:
+                await on_queued(position)
+            except Exception as e:
+                logging.warning(f"Не смог сообщить позицию в очереди: {str(e)}")
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдали, но ждать перестали - возвращаем его
+                self.release()
+            else:
+                self._remove(job)
+            raise
+
+    def release(self):
+        self.active -= 1
+        self.completed += 1
+        if self._wakeup is None:
+            self._dispatch()
+
+    # Есть ли запас: никто не ждёт, и после ещё reserve вызовов останутся свободные слоты и бюджет
+    def has_spare_capacity(self, reserve: int = 1) -> bool:
+        self._refill()
+        return not self.queued and self.active + reserve < self.concurrency and self._tokens >= reserve + 1
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "concurrency": self.concurrency,
+        }
+
+schedulers = {name: BackendScheduler(name, **limits) for name, limits in BACKEND_LIMITS.items()}
+
+# Занимаем слот бэкенда на время вызова; пользователь и приоритет берутся из контекста запроса
+@asynccontextmanager
+async def slot(backend: str, priority: int | None = None):
+    context = _request_context.get()
+    scheduler = schedulers[backend]
+    started = time.perf_counter()
+    try:
+        await scheduler.acquire(context.user_id, context.priority if priority is None else priority,
+                                context.notify_queued if context.on_queued else None)
+    except QueueFull:
+        errors_total.inc(stage="", backend=backend, exception="QueueFull")
+        raise
+    backend_wait.observe(time.perf_counter() - started, backend=backend)
+    try:
+        with backend_call(backend):
+            yield
+    finally:
+        scheduler.release()
+
+# Можно ли сейчас занять бэкенд фоновой работой, не задерживая живые запросы
+def has_spare_capacity(backend: str, reserve: int = 1) -> bool:
+    return schedulers[backend].has_spare_capacity(reserve)
+
+def get_scheduler_stats() -> dict:
+    return {name: scheduler.stats() for name, scheduler in schedulers.items()}
+
+# Длины очередей и занятые слоты - снимаем в момент запроса /metrics
+def _collect_metrics() -> list[tuple]:
+    samples = []
+    for name, scheduler in schedulers.items():
+        samples.append(("bot_backend_queue_depth", "gauge", "Заявок в очереди к бэкенду", {"backend": name}, scheduler.queued))
+        samples.append(("bot_backend_active_slots", "gauge", "Занятых слотов бэкенда", {"backend": name}, scheduler.active))
+        samples.append(("bot_backend_rejected_total", "counter", "Отказов из-за переполненной очереди", {"backend": name}, scheduler.rejected))
+    return samples
+
+registry.add_collector(_collect_metrics)
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import time
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from metrics_mdl import registry, Counter, Gauge, Histogram
+from config_mdl import get_setting
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около одного в секунду на чат
+TELEGRAM_GLOBAL_RATE = float(get_setting("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(get_setting("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE = float(get_setting("TELEGRAM_GROUP_RATE", "1"))
+# Короткий всплеск в личке Telegram прощает (ответ из нескольких частей), в группах строже
+CHAT_BURST = 3
+GROUP_BURST = 3
+# Сколько раз повторяем после 429 и сколько готовы ждать за один раз
+MAX_RETRIES = 5
+MAX_RETRY_AFTER = 60
+# Сколько чатов помним, прежде чем выбросить тех, у кого ведро уже полное
+MAX_TRACKED_CHATS = 10000
+
+# Методы, которые считаются в лимиты. Ответы на кнопки, getFile и прочее идут мимо очереди
+LIMITED_METHODS = {
+    "sendMessage", "sendPhoto", "sendDocument", "sendMediaGroup", "sendChatAction",
+    "copyMessage", "forwardMessage",
+    "editMessageText", "editMessageMedia", "editMessageCaption", "editMessageReplyMarkup",
+}
+# Правки: если к тому же сообщению уже пришла более свежая правка, старую не отправляем
+EDIT_METHODS = {"editMessageText", "editMessageMedia", "editMessageCaption", "editMessageReplyMarkup"}
+
+send_queue_depth = registry.register(Gauge(
+    "bot_telegram_send_queue_depth", "Запросов к Telegram, ждущих лимита"))
+send_latency = registry.register(Histogram(
+    "bot_telegram_send_latency_seconds", "Время отправки в Telegram вместе с ожиданием лимита", ("method",)))
+send_events = registry.register(Counter(
+    "bot_telegram_send_events_total", "Повторы после 429 и схлопнутые правки", ("event",)))
+
+# Ведро токенов: rate в секунду, burst про запас; после 429 ведро закрыто до указанного времени
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    # Сколько ждать до следующего токена (0 - можно отправлять)
+    def delay(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    # Ведро полное и не закрыто - его состояние можно забыть
+    def idle(self) -> bool:
+        return self.delay() == 0 and self.tokens >= self.burst
+
+# Правку схлопнули, а заменившая её правка так и не ушла (её отменили)
+class EditCollapsed(Exception):
+    pass
+
+# Очередь одного чата: замок держит порядок отправки, ведро - лимит чата и пауза после 429
+class _ChatQueue:
+    def __init__(self, bucket: TokenBucket):
+        self.lock = asyncio.Lock()
+        self.bucket = bucket
+        self.users = 0
+
+# Все исходящие запросы к Telegram проходят здесь: ждут лимитов, повторяются после 429,
+# устаревшие правки одного сообщения схлопываются. Подключается через bot.session.middleware
+class SendQueueMiddleware(BaseRequestMiddleware):
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 group_rate: float = TELEGRAM_GROUP_RATE):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self._chats = {}
+        self._latest_edits = {}
+        self._edit_sequence = 0
+
+    def _chat_queue(self, chat_id) -> _ChatQueue:
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            if len(self._chats) >= MAX_TRACKED_CHATS:
+                self._forget_idle_chats()
+            # У групп и каналов ID отрицательные (или @username) - им свой лимит
+            is_group = isinstance(chat_id, str) or (chat_id is not None and chat_id < 0)
+            rate, burst = (self.group_rate, GROUP_BURST) if is_group else (self.chat_rate, CHAT_BURST)
+            queue = self._chats[chat_id] = _ChatQueue(TokenBucket(rate, burst))
+        return queue
+
+    def _forget_idle_chats(self):
+        for chat_id, queue in list(self._chats.items()):
+            if not queue.users and queue.bucket.idle():
+                del self._chats[chat_id]
+
+    def _superseded(self, edit_key, sequence: int) -> bool:
+        latest = self._latest_edits.get(edit_key)
+        return edit_key is not None and (latest is None or latest[0] != sequence)
+
+    # Новая правка сообщения: предыдущая получит её результат, если так и не уйдёт
+    def _register_edit(self, edit_key) -> tuple[int, asyncio.Future]:
+        self._edit_sequence += 1
+        outcome = asyncio.get_running_loop().create_future()
+        previous = self._latest_edits.get(edit_key)
+        if previous is not None:
+            outcome.add_done_callback(lambda done: None if previous[1].done() else previous[1].set_result(done.result()))
+        self._latest_edits[edit_key] = (self._edit_sequence, outcome)
+        return self._edit_sequence, outcome
+
+    # Ждём, пока освободятся общий лимит и лимит чата. Вызывается под замком чата.
+    # False - правка устарела, отправлять не надо
+    async def _wait_turn(self, queue: _ChatQueue, edit_key, sequence: int) -> bool:
+        while True:
+            if self._superseded(edit_key, sequence):
+                return False
+            delay = max(self.global_bucket.delay(), queue.bucket.delay())
+            if delay <= 0:
+                self.global_bucket.take()
+                queue.bucket.take()
+                return True
+            await asyncio.sleep(delay)
+
+    # Отправка целиком под замком чата: запросы одного чата уходят строго по очереди, и повтор
+    # после 429 не даёт следующему запросу обогнать этот. None - правку схлопнули
+    async def _send(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod,
+                    queue: _ChatQueue, edit_key, sequence: int):
+        name = method.__api_method__
+        chat_id = getattr(method, "chat_id", None)
+        send_queue_depth.inc()
+        waiting = True
+        try:
+            async with queue.lock:
+                for attempt in range(MAX_RETRIES + 1):
+                    ready = await self._wait_turn(queue, edit_key, sequence)
+                    if waiting:
+                        send_queue_depth.dec()
+                        waiting = False
+                    if not ready:
+                        return None
+                    try:
+                        return (True, await make_request(bot, method))
+                    except TelegramRetryAfter as e:
+                        if attempt == MAX_RETRIES or e.retry_after > MAX_RETRY_AFTER:
+                            raise
+                        send_events.inc(event="retry_after")
+                        logging.warning(f"Telegram просит подождать {e.retry_after} с перед {name} в чат {chat_id}")
+                        # Притормаживаем только этот чат; запросы без чата - всю отправку
+                        (queue.bucket if chat_id is not None else self.global_bucket).block(e.retry_after)
+        finally:
+            if waiting:
+                send_queue_depth.dec()
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        name = method.__api_method__
+        if name not in LIMITED_METHODS:
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        edit_key = None
+        sequence = 0
+        outcome = None
+        if name in EDIT_METHODS and getattr(method, "message_id", None) is not None:
+            edit_key = (chat_id, method.message_id)
+            sequence, outcome = self._register_edit(edit_key)
+
+        queue = self._chat_queue(chat_id)
+        queue.users += 1
+        started = time.perf_counter()
+        try:
+            try:
+                result = await self._send(make_request, bot, method, queue, edit_key, sequence)
+            except BaseException as e:
+                result = (False, e)
+                raise
+            finally:
+                if outcome is not None and result is not None and not outcome.done():
+                    outcome.set_result(result)
+            if result is not None:
+                return result[1]
+            # Поверх этой правки уже пришла новая - Telegram покажет её, а эту пропускаем.
+            # Вызывающему отдаём результат той правки, что её заменила
+            send_events.inc(event="edit_collapsed")
+            ok, value = await outcome
+            if ok:
+                return value
+            if isinstance(value, asyncio.CancelledError):
+                raise EditCollapsed(f"Правку {name} в чате {chat_id} заменила другая, но та не отправлена")
+            raise value
+        finally:
+            send_latency.observe(time.perf_counter() - started, method=name)
+            queue.users -= 1
+            latest = self._latest_edits.get(edit_key)
+            if latest is not None and latest[0] == sequence:
+                del self._latest_edits[edit_key]
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable
+from metrics_mdl import registry
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Сколько ключей держим в статистике
+MAX_TRACKED_KEYS = 1000
+
+# Общий поток для всех, кто ждёт одинаковый ответ: кусочки копятся, подписчики читают с начала
+class _SharedStream:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+
+    def publish(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+# Все SingleFlight процесса - для /metrics
+_flights = []
+
+# Схлопываем одинаковые одновременные вызовы в один вызов к бэкенду
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        _flights.append(self)
+        self._calls = {}
+        self._waiters = {}
+        self._streams = {}
+        self._key_stats = OrderedDict()
+        self.calls = 0
+        self.shared = 0
+        self.errors = 0
+
+    def _track(self, key: str, field: str):
+        stats = self._key_stats.get(key)
+        if stats is None:
+            stats = self._key_stats[key] = {"calls": 0, "shared": 0, "errors": 0}
+            while len(self._key_stats) > MAX_TRACKED_KEYS:
+                self._key_stats.popitem(last=False)
+        self._key_stats.move_to_end(key)
+        stats[field] += 1
+
+    def _start(self, key: str, factory: Callable[[], Awaitable]) -> asyncio.Task:
+        task = self._calls.get(key)
+        if task is not None:
+            self.shared += 1
+            self._track(key, "shared")
+            return task
+
+        self.calls += 1
+        self._track(key, "calls")
+        task = asyncio.create_task(factory())
+        self._calls[key] = task
+
+        def finished(done_task: asyncio.Task):
+            if self._calls.get(key) is done_task:
+                # Вызов и его общий поток уходят вместе: иначе новый подписчик застанет вызов без потока
+                del self._calls[key]
+                self._streams.pop(key, None)
+            # Забираем ошибку, даже если ждать её уже некому
+            if not done_task.cancelled() and done_task.exception() is not None:
+                self.errors += 1
+                self._track(key, "errors")
+
+        task.add_done_callback(finished)
+        return task
+
+    async def _wait(self, key: str, task: asyncio.Task):
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # shield: отмена одного ожидающего не отменяет общий вызов
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                # Последний ожидающий ушёл - общий вызов больше никому не нужен
+                if not task.done():
+                    task.cancel()
+
+    # Ждём результат общего вызова; ошибка вызова достаётся всем ожидающим
+    async def do(self, key: str, factory: Callable[[], Awaitable]):
+        return await self._wait(key, self._start(key, factory))
+
+    # То же для потоков: один поток из бэкенда, каждый подписчик получает его с начала
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        flight_key = f"stream:{key}"
+        state = self._streams.get(flight_key) if flight_key in self._calls else None
+        if state is None:
+            state = self._streams[flight_key] = _SharedStream()
+
+            async def produce():
+                try:
+                    async for chunk in factory():
+                        state.chunks.append(chunk)
+                        state.publish()
+                except BaseException as e:
+                    state.error = e
+                    raise
+                finally:
+                    state.done = True
+                    state.publish()
+
+        else:
+            produce = None
+        task = self._start(flight_key, produce)
+
+        self._waiters[flight_key] = self._waiters.get(flight_key, 0) + 1
+        try:
+            position = 0
+            while True:
+                changed = state.changed
+                while position < len(state.chunks):
+                    yield state.chunks[position]
+                    position += 1
+                if state.done:
+                    if state.error is not None:
+                        raise state.error
+                    return
+                await changed.wait()
+        finally:
+            self._waiters[flight_key] -= 1
+            if not self._waiters[flight_key]:
+                del self._waiters[flight_key]
+                # Читателей не осталось - останавливаем поток из бэкенда
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "errors": self.errors,
+            "in_flight": len(self._calls),
+            "keys": dict(self._key_stats),
+        }
+
+def _collect_metrics() -> list[tuple]:
+    samples = []
+    for flight in _flights:
+        labels = {"flight": flight.name}
+        samples.append(("bot_singleflight_in_flight", "gauge", "Общих вызовов в полёте", labels, len(flight._calls)))
+        samples.append(("bot_singleflight_shared_total", "counter", "Вызовов, присоединившихся к уже идущему", labels, flight.shared))
+    return samples
+
+registry.add_collector(_collect_metrics)
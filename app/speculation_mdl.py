@@ -0,0 +1,163 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Callable
+from ai_answer_mdl import answer_question, stream_answer
+from img_gen_mdl import translate_prompt, generate_image
+from intent_analyzer_mdl import classify_intent, CONFIDENCE_THRESHOLD
+from metrics_mdl import registry
+from config_mdl import get_setting
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Спекулятивный режим: пока LLM уточняет намерение, уже запускаем самый вероятный следующий шаг
+SPECULATIVE_INTENT = get_setting("SPECULATIVE_INTENT", "0") == "1"
+
+# Политики по намерениям: с какой уверенности локальной догадки рискуем, что запускаем
+# и сколько таких догадок одновременно готовы оплачивать впустую.
+# "answer" - ответ на вопрос, "translate" - только перевод промпта, "image" - перевод и генерация
+SPECULATION_POLICIES = {
+    "[question]": {"min_confidence": 0.35, "start": "answer", "max_in_flight": 32},
+    "[image]": {"min_confidence": 0.45, "start": "translate", "max_in_flight": 16},
+}
+
+# Счётчики по намерениям: запущено, угадали, не угадали, пропущено и сколько вызовов ушло впустую
+# (не угадали, но вызов успел вернуться, или угадали, но вызов упал и ответ пришлось просить заново)
+speculation_stats = {}
+_in_flight = {}
+
+def _count(intent: str, field: str):
+    stats = speculation_stats.setdefault(
+        intent, {"started": 0, "hits": 0, "misses": 0, "skipped": 0, "wasted": 0, "cancelled": 0}
+    )
+    stats[field] += 1
+
+# Запущенная догадка: задача с вызовом и намерение, под которое она запущена
+class Speculation:
+    def __init__(self, intent: str):
+        self.intent = intent
+        self.task = None
+        self.hit = False
+        # Для потока: кусочки ответа, которые обработчик потом прочитает с начала
+        self.chunks = []
+        self.changed = asyncio.Event()
+
+    def start(self, work):
+        _in_flight[self.intent] = _in_flight.get(self.intent, 0) + 1
+        self.task = asyncio.create_task(work)
+        self.task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Task):
+        _in_flight[self.intent] -= 1
+        self._publish()
+        # Ошибку догадки никто не ждёт - забираем её, чтобы asyncio не ругался
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"Спекулятивный вызов упал: {str(task.exception())}")
+
+    def _publish(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    # Сами читаем поток ответа и запоминаем кусочки: если догадка закончится раньше, чем определится
+    # намерение, общий поток single-flight уже закроется, а ответ с контекстом не попадает в кэш
+    async def _record(self, chunks: AsyncIterator[str]):
+        async for chunk in chunks:
+            self.chunks.append(chunk)
+            self._publish()
+
+    # Намерение определено: если угадали, обработчик забирает результат прямо отсюда
+    # (answer() или answer_stream()), иначе отменяем вызов
+    def resolve(self, intent: str):
+        if intent == self.intent:
+            self.hit = True
+            _count(self.intent, "hits")
+            return
+        _count(self.intent, "misses")
+        if self.task.done():
+            # Вызов уже успел дойти до бэкенда и вернуться - он потрачен зря
+            _count(self.intent, "wasted")
+        else:
+            _count(self.intent, "cancelled")
+            self.task.cancel()
+
+    # Готовый ответ угаданной догадки (как у answer_question). Если вызов упал, None - спросим заново
+    async def answer(self) -> tuple[str, bool] | None:
+        try:
+            return await asyncio.shield(self.task)
+        except Exception:
+            _count(self.intent, "wasted")
+            return None
+
+    # Поток угаданной догадки с самого начала: уже пришедшие кусочки сразу, остальные по мере прихода.
+    # Если догадка упала, не отдав ни кусочка, читаем fallback - обычный поток ответа
+    async def answer_stream(self, fallback: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        position = 0
+        try:
+            while True:
+                changed = self.changed
+                while position < len(self.chunks):
+                    yield self.chunks[position]
+                    position += 1
+                if self.task.done():
+                    error = self.task.exception() if not self.task.cancelled() else asyncio.CancelledError()
+                    if error is None:
+                        return
+                    if position:
+                        raise error
+                    _count(self.intent, "wasted")
+                    async for chunk in fallback():
+                        yield chunk
+                    return
+                await changed.wait()
+        finally:
+            # Обработчик перестал читать - продолжать вызов незачем
+            if not self.task.done():
+                self.task.cancel()
+
+# Решаем по локальной догадке, стоит ли что-то запускать заранее
+def speculate(query: str, stream: bool = False, context: list[dict] | None = None) -> Speculation | None:
+    if not SPECULATIVE_INTENT or not query.strip():
+        return None
+    intent, confidence = classify_intent(query)
+    if confidence >= CONFIDENCE_THRESHOLD:
+        # Намерение определится локально и мгновенно - спекулировать незачем
+        return None
+    policy = SPECULATION_POLICIES.get(intent)
+    if policy is None:
+        return None
+    if confidence < policy["min_confidence"] or _in_flight.get(intent, 0) >= policy["max_in_flight"]:
+        _count(intent, "skipped")
+        return None
+
+    speculation = Speculation(intent)
+    if policy["start"] == "answer":
+        work = speculation._record(stream_answer(query, context)) if stream else answer_question(query, context=context)
+    elif policy["start"] == "image":
+        work = generate_image(query)
+    else:
+        # Перевод подхватится через кэш переводов и single-flight
+        work = translate_prompt(query)
+    _count(intent, "started")
+    logging.info(f"Спекулятивно запускаю {policy['start']} для {intent} ({confidence:.2f})")
+    speculation.start(work)
+    return speculation
+
+def get_speculation_stats() -> dict:
+    result = {}
+    for intent, stats in speculation_stats.items():
+        resolved = stats["hits"] + stats["misses"]
+        result[intent] = {**stats, "hit_rate": stats["hits"] / resolved if resolved else 0.0}
+    return result
+
+def _collect_metrics() -> list[tuple]:
+    samples = []
+    for intent, stats in speculation_stats.items():
+        for field in ("started", "hits", "misses", "skipped", "wasted", "cancelled"):
+            samples.append(("bot_speculation_total", "counter", "Спекулятивные вызовы по исходу",
+                            {"intent": intent, "outcome": field}, stats[field]))
+    return samples
+
+registry.add_collector(_collect_metrics)
@@ -0,0 +1,84 @@
+import inspect
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Callable
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Сколько самых тяжёлых пакетов показывать
+TOP_PACKAGES = 15
+
+_IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+# Импортируем модуль в свежем процессе с -X importtime: в текущем всё уже импортировано.
+# Возвращаем (модуль, своё время, время вместе со всем, что он потянул) в микросекундах
+def measure_imports(module: str = "main_app") -> list[tuple[str, int, int]]:
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [app_dir, os.environ.get("PYTHONPATH")])))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Не смог импортировать {module}: {result.stderr.strip().splitlines()[-1:]}")
+    imports = []
+    for line in result.stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match:
+            imports.append((match.group(4), int(match.group(1)), int(match.group(2))))
+    return imports
+
+# Своё время импорта по пакетам верхнего уровня (aiogram, openai, ...) - видно, кто тянет больше всего
+def group_by_package(imports: list[tuple[str, int, int]]) -> dict[str, int]:
+    packages = {}
+    for name, own, _ in imports:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + own
+    return dict(sorted(packages.items(), key=lambda item: item[1], reverse=True))
+
+# Замеряем шаги инициализации по очереди: (название, функция без аргументов)
+async def measure_steps(steps: list[tuple[str, Callable]]) -> list[tuple[str, float, str | None]]:
+    results = []
+    for name, step in steps:
+        started = time.perf_counter()
+        try:
+            result = step()
+            # Асинхронный шаг (например, обучение классификатора на запросах из базы) ждём до конца
+            if inspect.isawaitable(result):
+                await result
+            error = None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        results.append((name, time.perf_counter() - started, error))
+    return results
+
+# Отчёт для --profile-startup: импорты по пакетам и модулям бота, потом инициализация
+async def print_startup_report(steps: list[tuple[str, Callable]], module: str = "main_app"):
+    imports = measure_imports(module)
+    total = next((cumulative for name, _, cumulative in imports if name == module), 0)
+    print(f"\nИмпорт {module}: {total / 1000:.1f} мс")
+
+    print(f"\nПакеты (своё время, топ-{TOP_PACKAGES}):")
+    print(f"  {'пакет':<36}{'мс':>10}{'доля':>8}")
+    for package, own in list(group_by_package(imports).items())[:TOP_PACKAGES]:
+        print(f"  {package:<36}{own / 1000:>10.1f}{own / max(total, 1):>8.0%}")
+
+    # Модули бота: время вместе с зависимостями, которые они импортировали первыми
+    print("\nМодули бота (вместе с зависимостями):")
+    print(f"  {'модуль':<36}{'мс':>10}")
+    for name, _, cumulative in imports:
+        if name.endswith("_mdl"):
+            print(f"  {name:<36}{cumulative / 1000:>10.1f}")
+
+    print("\nИнициализация:")
+    print(f"  {'шаг':<36}{'мс':>10}")
+    for name, seconds, error in await measure_steps(steps):
+        print(f"  {name:<36}{seconds * 1000:>10.1f}" + (f"  ошибка: {error}" if error else ""))
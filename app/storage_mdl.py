@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+from config_mdl import get_setting
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Где живёт общее состояние: "local" - в процессе и в локальных файлах SQLite,
+# "redis" - в сетевом key-value хранилище (Redis или совместимом), общем для всех хостов
+STORAGE_BACKEND = get_setting("STORAGE_BACKEND", "local")
+REDIS_URL = get_setting("REDIS_URL", "redis://localhost:6379/0")
+# Префикс ключей, чтобы несколько ботов могли жить в одном хранилище
+STORAGE_PREFIX = get_setting("STORAGE_PREFIX", "yaly")
+# Сколько храним связку "сообщение -> запрос" для кнопок под ответом
+QUERY_MAPPING_TTL = int(get_setting("QUERY_MAPPING_TTL", str(30 * 24 * 3600)))
+
+# Хранилище недоступно или ответило ошибкой
+class StorageError(Exception):
+    pass
+
+# Key-value хранилище в памяти процесса: для одного процесса и для проверок
+class MemoryKeyValueStore:
+    def __init__(self, max_items: int = 100000):
+        self.max_items = max_items
+        self._items = OrderedDict()
+
+    async def get(self, key: str) -> str | None:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires is not None and expires < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: float | None = None):
+        self._items[key] = (time.monotonic() + ttl if ttl else None, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    async def delete(self, key: str):
+        self._items.pop(key, None)
+
+    async def close(self):
+        self._items.clear()
+
+# Key-value хранилище в Redis: общее для всех процессов и хостов
+class RedisKeyValueStore:
+    def __init__(self, url: str = REDIS_URL, prefix: str = STORAGE_PREFIX):
+        try:
+            from redis.asyncio import Redis
+            from redis.exceptions import RedisError
+        except ImportError:
+            raise StorageError("Для STORAGE_BACKEND=redis нужен пакет redis: pip install redis")
+        self.url = url
+        self.prefix = prefix
+        self.client = Redis.from_url(url, decode_responses=True)
+        self._errors = (RedisError, OSError, asyncio.TimeoutError)
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+    async def get(self, key: str) -> str | None:
+        try:
+            return await self.client.get(self._key(key))
+        except self._errors as e:
+            raise StorageError(f"Redis: не смог прочитать ключ: {str(e)}") from e
+
+    async def set(self, key: str, value: str, ttl: float | None = None):
+        try:
+            await self.client.set(self._key(key), value, ex=max(int(ttl), 1) if ttl else None)
+        except self._errors as e:
+            raise StorageError(f"Redis: не смог записать ключ: {str(e)}") from e
+
+    async def delete(self, key: str):
+        try:
+            await self.client.delete(self._key(key))
+        except self._errors as e:
+            raise StorageError(f"Redis: не смог удалить ключ: {str(e)}") from e
+
+    async def close(self):
+        await self.client.aclose()
+
+# Часть ключей общего хранилища под своим пространством имён (кэш, связки сообщений и т.д.)
+class NamespacedStore:
+    def __init__(self, store, namespace: str):
+        self.store = store
+        self.namespace = namespace
+        self.evictions = 0
+
+    async def get(self, key: str) -> str | None:
+        return await self.store.get(f"{self.namespace}:{key}")
+
+    async def set(self, key: str, value: str, ttl: float | None = None):
+        await self.store.set(f"{self.namespace}:{key}", value, ttl)
+
+    async def delete(self, key: str):
+        await self.store.delete(f"{self.namespace}:{key}")
+
+_store = None
+
+def is_shared() -> bool:
+    return STORAGE_BACKEND == "redis"
+
+# Общее key-value хранилище (создаётся при первом обращении)
+def get_store():
+    global _store
+    if _store is None:
+        if STORAGE_BACKEND == "redis":
+            _store = RedisKeyValueStore(REDIS_URL, STORAGE_PREFIX)
+            logging.info(f"Общее состояние хранится в Redis: {REDIS_URL}")
+        elif STORAGE_BACKEND == "local":
+            _store = MemoryKeyValueStore()
+        else:
+            raise StorageError(f"Неизвестный STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return _store
+
+def namespaced(namespace: str) -> NamespacedStore:
+    return NamespacedStore(get_store(), namespace)
+
+# Хранилище состояний FSM для диспетчера
+def create_fsm_storage() -> BaseStorage:
+    if not is_shared():
+        return MemoryStorage()
+    from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+    return RedisStorage(get_store().client, key_builder=DefaultKeyBuilder(prefix=f"{STORAGE_PREFIX}:fsm"))
+
+async def close_store():
+    global _store
+    if _store is not None:
+        await _store.close()
+        _store = None
@@ -0,0 +1,139 @@
+import asyncio
+import importlib
+import inspect
+import logging
+from typing import Awaitable, Callable
+from aiogram import Bot
+from aiogram.types import Audio, Voice
+from audio_prep_mdl import decode_and_split, SAMPLE_RATE, SAMPLE_WIDTH
+from config_mdl import get_setting
+from media_mdl import MediaBufferPool, download_to_buffer
+from metrics_mdl import registry, Counter, span
+from scheduler_mdl import slot, QueueFull
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Чем распознаём речь: google (SpeechRecognition, запись уходит в Google - нужен интернет),
+# sphinx (офлайн, нужен pocketsphinx - его нет в requirements.txt, ставится отдельно),
+# stub (заглушка без распознавания - для бенчмарков и проверок) или свой "модуль:функция"
+VOICE_TRANSCRIBER = get_setting("VOICE_TRANSCRIBER", "google")
+VOICE_LANGUAGE = get_setting("VOICE_LANGUAGE", "ru-RU")
+# Голосовые длиннее этого не распознаём
+VOICE_MAX_SECONDS = int(get_setting("VOICE_MAX_SECONDS", "600"))
+# Сколько голосовых одновременно держим в памяти до раскодирования
+VOICE_MAX_IN_FLIGHT = int(get_setting("VOICE_MAX_IN_FLIGHT", "4"))
+
+# Что Telegram присылает -> формат для ffmpeg. Голосовые всегда OGG/Opus
+AUDIO_FORMATS = {
+    "audio/ogg": "ogg", "audio/mpeg": "mp3", "audio/mp3": "mp3", "audio/mp4": "mp4", "audio/x-m4a": "mp4",
+    "audio/wav": "wav", "audio/x-wav": "wav", "audio/flac": "flac", "audio/webm": "webm",
+}
+
+# Распознаватель: (сырые 16-битные моно сэмплы, частота, язык) -> текст. Может быть синхронным
+# (тогда зовём в потоке) или асинхронным. Пустая строка - речи в куске не нашлось
+Transcriber = Callable[[bytes, int, str], str | Awaitable[str]]
+
+voice_buffers = MediaBufferPool(VOICE_MAX_IN_FLIGHT)
+
+voice_events = registry.register(Counter(
+    "bot_voice_total", "Голосовые по исходу и распознанные куски", ("event",)))
+
+def _transcribe_google(pcm: bytes, sample_rate: int, language: str) -> str:
+    import speech_recognition
+    try:
+        return speech_recognition.Recognizer().recognize_google(
+            speech_recognition.AudioData(pcm, sample_rate, SAMPLE_WIDTH), language=language
+        )
+    except speech_recognition.UnknownValueError:
+        return ""
+
+def _transcribe_sphinx(pcm: bytes, sample_rate: int, language: str) -> str:
+    import speech_recognition
+    try:
+        return speech_recognition.Recognizer().recognize_sphinx(
+            speech_recognition.AudioData(pcm, sample_rate, SAMPLE_WIDTH), language=language.replace("-", "_").lower()
+        )
+    except speech_recognition.UnknownValueError:
+        return ""
+
+# Заглушка: ничего не распознаёт, только сообщает длину куска
+def _transcribe_stub(pcm: bytes, sample_rate: int, language: str) -> str:
+    return f"фрагмент {len(pcm) / (sample_rate * SAMPLE_WIDTH):.1f} с"
+
+TRANSCRIBERS = {"google": _transcribe_google, "sphinx": _transcribe_sphinx, "stub": _transcribe_stub}
+
+_transcriber = None
+
+def _load_transcriber(name: str) -> Transcriber:
+    if name in TRANSCRIBERS:
+        return TRANSCRIBERS[name]
+    module_name, _, function_name = name.partition(":")
+    if not function_name:
+        raise ValueError(f"Не знаю распознаватель '{name}': {', '.join(TRANSCRIBERS)} или 'модуль:функция'")
+    return getattr(importlib.import_module(module_name), function_name)
+
+def get_transcriber() -> Transcriber:
+    global _transcriber
+    if _transcriber is None:
+        _transcriber = _load_transcriber(VOICE_TRANSCRIBER)
+    return _transcriber
+
+# Подменяем распознаватель из кода (например, локальной заглушкой в проверках)
+def set_transcriber(transcriber: Transcriber | None):
+    global _transcriber
+    _transcriber = transcriber
+
+async def _transcribe_chunk(pcm: bytes) -> str:
+    transcriber = get_transcriber()
+    async with slot("speech"):
+        if inspect.iscoroutinefunction(transcriber):
+            text = await transcriber(pcm, SAMPLE_RATE, VOICE_LANGUAGE)
+        else:
+            text = await asyncio.to_thread(transcriber, pcm, SAMPLE_RATE, VOICE_LANGUAGE)
+    voice_events.inc(event="chunk")
+    return text.strip()
+
+# Распознаём куски параллельно: длинное голосовое распознаётся примерно за время самого длинного куска
+async def transcribe_chunks(chunks: list[tuple[int, bytes]]) -> str:
+    texts = await asyncio.gather(*(_transcribe_chunk(pcm) for _, pcm in chunks))
+    return " ".join(text for text in texts if text)
+
+# Голосовое или аудиофайл -> текст. Качаем в буфер из пула, раскодируем и режем в пуле процессов,
+# куски распознаём параллельно
+async def transcribe_voice(bot: Bot, audio: Voice | Audio) -> tuple[str, bool]:
+    if audio.duration and audio.duration > VOICE_MAX_SECONDS:
+        voice_events.inc(event="too_long")
+        return f"Голосовое слишком длинное: распознаю до {VOICE_MAX_SECONDS // 60} мин.", False
+
+    try:
+        with span("download"):
+            async with voice_buffers.acquire(audio.file_size) as buffer:
+                file_info = await bot.get_file(audio.file_id)
+                # В процесс пула всё равно уходят байты, а не буфер - копируем и сразу возвращаем буфер
+                audio_data = bytes(await download_to_buffer(bot, file_info.file_path, buffer))
+        with span("decode"):
+            chunks = await decode_and_split(audio_data, AUDIO_FORMATS.get(audio.mime_type or ""))
+        del audio_data
+
+        if not chunks:
+            voice_events.inc(event="silent")
+            return "Не услышал в голосовом ни слова.", False
+        with span("transcribe"):
+            text = await transcribe_chunks(chunks)
+        if not text:
+            voice_events.inc(event="unrecognized")
+            return "Не смог разобрать, что сказано в голосовом.", False
+        voice_events.inc(event="ok")
+        logging.info(f"Распознал голосовое ({len(chunks)} кусков): {text}")
+        return text, True
+
+    except QueueFull as e:
+        return str(e), False
+    except Exception as e:
+        voice_events.inc(event="error")
+        logging.error(f"Ошибка при распознавании голосового: {str(e)}")
+        return f"Не получилось распознать голосовое: {str(e)}", False
@@ -0,0 +1,121 @@
+import asyncio
+import hmac
+import logging
+import multiprocessing
+import signal
+import socket
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from metrics_mdl import registry
+
+# Настраиваем логи
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Сколько апдейтов может ждать обработки, прежде чем мы попросим Telegram повторить позже
+UPDATE_QUEUE_SIZE = 10000
+# Сколько апдейтов обрабатываем одновременно в одном процессе
+UPDATE_CONSUMERS = 256
+
+# Принимаем апдейт, кладём в очередь и сразу отвечаем Telegram - обработка идёт отдельно
+def create_webhook_app(dp: Dispatcher, bot: Bot, secret: str | None, path: str = "/webhook",
+                       queue_size: int = UPDATE_QUEUE_SIZE, consumers: int = UPDATE_CONSUMERS) -> web.Application:
+    app = web.Application()
+    updates: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    workers = []
+
+    async def receive_update(request: web.Request) -> web.Response:
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            logging.warning("Вебхук: неверный секретный токен")
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception as e:
+            logging.error(f"Вебхук: не смог разобрать апдейт: {str(e)}")
+            return web.Response(status=400)
+        try:
+            updates.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже - апдейт не потеряется
+            logging.warning("Вебхук: очередь апдейтов переполнена")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def consume():
+        while True:
+            update = await updates.get()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                logging.error(f"Ошибка при обработке апдейта {update.update_id}: {str(e)}")
+            finally:
+                updates.task_done()
+
+    async def on_startup(_: web.Application):
+        workers.extend(asyncio.create_task(consume()) for _ in range(consumers))
+
+    async def on_shutdown(_: web.Application):
+        # Даём дообработать то, что уже приняли
+        try:
+            await asyncio.wait_for(updates.join(), timeout=30)
+        except asyncio.TimeoutError:
+            logging.warning(f"Вебхук: остановка с необработанными апдейтами: {updates.qsize()}")
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    registry.add_collector(lambda: [
+        ("bot_webhook_queue_depth", "gauge", "Апдейтов ждут обработки", {}, updates.qsize()),
+    ])
+    app.router.add_post(path, receive_update)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app["update_queue"] = updates
+    return app
+
+# Один слушающий сокет на все рабочие процессы
+def bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    return sock
+
+# Запускаем aiohttp-приложение и ждём, пока нас не остановят
+async def serve(app: web.Application, host: str = "0.0.0.0", port: int = 8080, sock: socket.socket | None = None):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.SockSite(runner, sock) if sock is not None else web.TCPSite(runner, host, port)
+    await site.start()
+    logging.info(f"Вебхук слушает: {site.name}")
+
+    # По SIGTERM/SIGINT останавливаемся аккуратно, дообработав принятые апдейты
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+async def set_webhook(bot: Bot, url: str, secret: str | None):
+    await bot.set_webhook(url, secret_token=secret, drop_pending_updates=False)
+    logging.info(f"Вебхук установлен: {url}")
+
+# Запускаем N процессов за одним сокетом (spawn: каждый процесс собирает бота заново).
+# Первым аргументом target получает номер процесса
+def start_workers(count: int, target, *args) -> list[multiprocessing.Process]:
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for number in range(count):
+        process = context.Process(target=target, args=(number, *args), name=f"bot-worker-{number}")
+        process.start()
+        processes.append(process)
+    logging.info(f"Запустил рабочих процессов: {count}")
+    return processes
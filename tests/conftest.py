@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модули бота лежат в app/ и импортируют друг друга по имени, как при запуске python app/main_app.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
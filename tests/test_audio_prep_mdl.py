@@ -0,0 +1,30 @@
+from audio_prep_mdl import chunk_ranges, KEEP_SILENCE_MS
+
+
+def test_no_speech_gives_no_chunks():
+    assert chunk_ranges([], 10000) == []
+
+
+def test_phrases_are_padded_and_clamped_to_the_recording():
+    # Фраза у самого начала и у самого конца: запас тишины не выходит за границы записи
+    assert chunk_ranges([(100, 900)], 1000) == [(0, 1000)]
+    assert chunk_ranges([(1000, 2000)], 5000) == [(1000 - KEEP_SILENCE_MS, 2000 + KEEP_SILENCE_MS)]
+
+
+def test_short_phrases_are_merged_up_to_target():
+    speech = [(0, 3000), (4000, 7000), (8000, 11000), (12000, 15000)]
+    chunks = chunk_ranges(speech, 20000, target_ms=8000, max_ms=30000)
+    assert chunks == [(0, 7200), (7800, 15200)]
+
+
+def test_long_phrase_without_pauses_is_cut_at_max():
+    chunks = chunk_ranges([(0, 25000)], 25000, target_ms=5000, max_ms=10000)
+    assert chunks == [(0, 10000), (10000, 20000), (20000, 25000)]
+    assert all(end - start <= 10000 for start, end in chunks)
+
+
+def test_far_apart_phrases_stay_separate():
+    # Между фразами пауза длиннее цели - склеивать их нельзя; длинная фраза режется по MAX
+    speech = [(500, 1500), (20000, 21000), (21500, 60000)]
+    chunks = chunk_ranges(speech, 61000, target_ms=15000, max_ms=30000)
+    assert chunks == [(300, 1700), (19800, 21200), (21300, 51300), (51300, 60200)]
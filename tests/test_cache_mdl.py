@@ -0,0 +1,52 @@
+import cache_mdl
+from cache_mdl import LRUCache
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_least_recently_used_item_is_evicted():
+    cache = LRUCache(max_items=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # Чтение освежает запись: вытесняется b, а не a
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_items_expire_after_ttl(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(cache_mdl.time, "monotonic", clock)
+    cache = LRUCache(max_items=10, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=600)
+    clock.now += 61
+    assert cache.get("a") is None
+    # Свой ttl у записи важнее общего
+    assert cache.get("b") == 2
+    assert len(cache) == 1
+    stats = cache.stats()
+    assert stats["expirations"] == 1
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+def test_overwrite_refreshes_value_and_ttl(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(cache_mdl.time, "monotonic", clock)
+    cache = LRUCache(max_items=10, ttl=60)
+    cache.set("a", 1)
+    clock.now += 50
+    cache.set("a", 2)
+    clock.now += 50
+    assert cache.get("a") == 2
+    cache.delete("a")
+    assert cache.get("a") is None
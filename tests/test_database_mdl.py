@@ -0,0 +1,142 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from database_mdl import Database, MIGRATIONS
+
+
+def _schema(path) -> tuple[int, set[str]]:
+    with sqlite3.connect(path) as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    return version, tables
+
+
+def test_fresh_database_gets_the_latest_schema(tmp_path):
+    path = tmp_path / "queries.db"
+
+    async def run():
+        db = Database(str(path))
+        await db.close()
+        # Повторное открытие ничего не ломает и не прогоняет миграции заново
+        db = Database(str(path))
+        await db.close()
+
+    asyncio.run(run())
+    version, tables = _schema(path)
+    assert version == len(MIGRATIONS)
+    assert {"user_queries", "conversation_summaries"} <= tables
+    assert "reply_messages" not in tables
+
+
+def test_old_database_is_migrated_without_losing_rows(tmp_path):
+    path = tmp_path / "queries.db"
+    # База первой версии: только таблица запросов, без ответов
+    with sqlite3.connect(path) as conn:
+        for statement in MIGRATIONS[0]:
+            conn.execute(statement)
+        conn.execute("PRAGMA user_version = 1")
+        conn.execute(
+            "INSERT INTO user_queries (user_id, chat_id, message_id, query, timestamp) VALUES (1, 10, 100, 'старый', 't')"
+        )
+
+    async def run():
+        db = Database(str(path))
+        try:
+            return await db.get_query(100, 10)
+        finally:
+            await db.close()
+
+    assert asyncio.run(run()) == "старый"
+    version, _ = _schema(path)
+    assert version == len(MIGRATIONS)
+    with sqlite3.connect(path) as conn:
+        assert "answer" in {row[1] for row in conn.execute("PRAGMA table_info(user_queries)")}
+
+
+def test_batched_writer_saves_everything_and_serves_pending_rows(tmp_path):
+    path = tmp_path / "queries.db"
+
+    async def run():
+        # Большое окно: запросы точно ждут в очереди, пока мы их читаем
+        db = Database(str(path), batch_size=50, flush_interval=0.5)
+        try:
+            for number in range(120):
+                await db.save_query(1, 10, number, f"вопрос {number}", answer=f"ответ {number}")
+            # Ещё не записано, но уже находится
+            pending = await db.get_query(119, 10)
+            await db.flush()
+            await db.save_answer(10, 5, "новый ответ")
+            await db.flush()
+            saved = await db.get_query(5, 10)
+            return pending, saved, db.stats()
+        finally:
+            await db.close()
+
+    pending, saved, stats = asyncio.run(run())
+    assert pending == "вопрос 119"
+    assert saved == "вопрос 5"
+    assert stats == {"write_queue": 0, "pending": 0}
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM user_queries").fetchone()[0] == 120
+        assert conn.execute("SELECT answer FROM user_queries WHERE message_id = 5").fetchone()[0] == "новый ответ"
+
+
+def test_close_flushes_the_queue(tmp_path):
+    path = tmp_path / "queries.db"
+
+    async def run():
+        db = Database(str(path), flush_interval=5)
+        for number in range(10):
+            await db.save_query(1, 10, number, f"вопрос {number}")
+        await db.close()
+
+    asyncio.run(run())
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM user_queries").fetchone()[0] == 10
+
+
+def test_bad_row_does_not_drop_the_rest_of_the_batch(tmp_path):
+    path = tmp_path / "queries.db"
+
+    async def run():
+        db = Database(str(path), flush_interval=0.5)
+        try:
+            await db.save_query(1, 10, 1, "первый")
+            # query NOT NULL - эта строка не запишется, но соседи по пачке должны
+            await db.save_query(1, 10, 2, None)
+            await db.save_query(1, 10, 3, "третий")
+            await db.flush()
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+    with sqlite3.connect(path) as conn:
+        rows = conn.execute("SELECT message_id FROM user_queries ORDER BY message_id").fetchall()
+    assert rows == [(1,), (3,)]
+
+
+def test_failing_callback_does_not_stop_the_writer(tmp_path):
+    path = tmp_path / "queries.db"
+
+    def broken_callback():
+        raise RuntimeError("обработчик упал")
+
+    async def run():
+        db = Database(str(path))
+        try:
+            db._write_queue.put(broken_callback)
+            await db.save_query(1, 10, 1, "после ошибки")
+            await asyncio.wait_for(db.flush(), 5)
+            return await db.get_query(1, 10), list(db._read_conns)
+        finally:
+            await db.close()
+
+    query, read_conns = asyncio.run(run())
+    assert query == "после ошибки"
+    # close() закрывает и подключения потоков чтения
+    assert read_conns
+    for conn in read_conns:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
@@ -0,0 +1,39 @@
+import asyncio
+
+from media_mdl import MEDIA_KEEP_BYTES, MediaBuffer, MediaBufferPool
+
+
+def test_large_buffer_is_truncated_in_place():
+    buffer = MediaBuffer()
+    buffer.write(b"x" * (MEDIA_KEEP_BYTES + 1))
+    data = buffer.data
+    buffer.reset()
+    # Тот же массив, только обрезанный до MEDIA_KEEP_BYTES
+    assert buffer.data is data
+    assert len(buffer.data) == MEDIA_KEEP_BYTES
+    assert buffer.length == 0
+
+
+def test_buffer_with_live_view_is_released():
+    buffer = MediaBuffer()
+    buffer.write(b"x" * (MEDIA_KEEP_BYTES + 1))
+    view = buffer.view()
+    buffer.reset()
+    # Обрезать нельзя, пока жив memoryview - буфер отпускаем, а данные под view остаются целыми
+    assert len(buffer.data) == 0
+    assert view[-1] == ord("x")
+
+
+def test_pool_reuses_buffers():
+    async def run():
+        pool = MediaBufferPool(max_in_flight=2)
+        async with pool.acquire(1024) as first:
+            first.write(b"abc")
+            assert bytes(first.view()) == b"abc"
+        async with pool.acquire(16) as second:
+            assert second is first
+            assert second.length == 0
+            assert len(second.data) == 1024
+        return pool.allocated_bytes(), pool.in_use
+
+    assert asyncio.run(run()) == (1024, 0)
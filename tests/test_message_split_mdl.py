@@ -0,0 +1,31 @@
+import threading
+
+from message_split_mdl import split_message, MESSAGE_LIMIT
+
+
+def _split_with_timeout(*args, timeout: float = 5, **kwargs) -> list[str]:
+    result = []
+    thread = threading.Thread(target=lambda: result.append(split_message(*args, **kwargs)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert result, "split_message завис"
+    return result[0]
+
+
+def test_tag_longer_than_limit_falls_back_to_plain_text():
+    text = '<a href="https://x.com/' + "h" * 5000 + '">x</a>'
+    assert _split_with_timeout(text, parse_html=True) == ["x"]
+
+
+def test_plain_fallback_is_escaped_and_fits():
+    text = '<a href="' + "h" * 5000 + '">1 < 2 & 3 ' + "слово " * 1000 + "</a>"
+    parts = _split_with_timeout(text, parse_html=True)
+    assert parts[0].startswith("1 &lt; 2 &amp; 3 ")
+    assert all(len(part) <= MESSAGE_LIMIT for part in parts)
+
+
+def test_open_tags_are_reopened_in_next_part():
+    parts = _split_with_timeout("<b>" + "слово " * 2000 + "</b>", parse_html=True)
+    assert len(parts) > 1
+    assert all(part.startswith("<b>") and part.endswith("</b>") for part in parts)
+    assert all(len(part) <= MESSAGE_LIMIT for part in parts)
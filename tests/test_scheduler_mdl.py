@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+import scheduler_mdl
+from scheduler_mdl import (BackendScheduler, QueueFull, PRIORITY_CALLBACK, PRIORITY_NORMAL,
+                           set_request_context, slot)
+
+
+def _scheduler(concurrency: int = 1, max_queue: int = 100) -> BackendScheduler:
+    # Бюджет по скорости огромный: проверяем только очередь
+    return BackendScheduler("test", concurrency=concurrency, rate=10**6, burst=10**6, max_queue=max_queue)
+
+
+async def _take_turns(scheduler: BackendScheduler, jobs: list[tuple[str, int]]) -> list[str]:
+    order = []
+
+    async def job(name: str, user_id: str, priority: int):
+        await scheduler.acquire(user_id, priority)
+        order.append(name)
+        await asyncio.sleep(0)
+        scheduler.release()
+
+    # Первый занимает единственный слот, остальные встают в очередь в порядке списка
+    await scheduler.acquire("держатель")
+    tasks = []
+    for number, (user_id, priority) in enumerate(jobs):
+        tasks.append(asyncio.create_task(job(f"{user_id}{number}", user_id, priority)))
+        await asyncio.sleep(0)
+    scheduler.release()
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_users_are_served_round_robin():
+    scheduler = _scheduler()
+    jobs = [("a", PRIORITY_NORMAL)] * 3 + [("b", PRIORITY_NORMAL)]
+    order = asyncio.run(_take_turns(scheduler, jobs))
+    # Пользователь b не ждёт, пока a разгребёт все свои запросы
+    assert order == ["a0", "b3", "a1", "a2"]
+
+
+def test_callbacks_go_before_normal_requests():
+    scheduler = _scheduler()
+    jobs = [("a", PRIORITY_NORMAL), ("a", PRIORITY_NORMAL), ("b", PRIORITY_CALLBACK)]
+    order = asyncio.run(_take_turns(scheduler, jobs))
+    assert order == ["b2", "a0", "a1"]
+
+
+def test_full_queue_is_rejected_right_away():
+    async def run():
+        scheduler = _scheduler(max_queue=1)
+        await scheduler.acquire("a")
+        waiting = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            await scheduler.acquire("c")
+        waiting.cancel()
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert scheduler.rejected == 1
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        scheduler = _scheduler()
+        await scheduler.acquire("a")
+        waiting = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        assert scheduler.queued == 1
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        scheduler.release()
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert scheduler.queued == 0
+    assert scheduler.active == 0
+
+
+def test_queue_position_is_reported_once_per_request(monkeypatch):
+    async def run():
+        schedulers = {"first": _scheduler(), "second": _scheduler()}
+        monkeypatch.setattr(scheduler_mdl, "schedulers", schedulers)
+        for scheduler in schedulers.values():
+            await scheduler.acquire("другой")
+        positions = []
+
+        async def notify(position: int):
+            positions.append(position)
+
+        async def request():
+            set_request_context("пользователь", PRIORITY_NORMAL, notify)
+            async with slot("first"):
+                pass
+            async with slot("second"):
+                pass
+
+        task = asyncio.create_task(request())
+        await asyncio.sleep(0)
+        schedulers["first"].release()
+        await asyncio.sleep(0)
+        schedulers["second"].release()
+        await task
+        return positions
+
+    # Запрос постоял в двух очередях, а сообщение об очереди одно
+    assert asyncio.run(run()) == [1]
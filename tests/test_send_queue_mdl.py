@@ -0,0 +1,96 @@
+import asyncio
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendMessage
+
+from send_queue_mdl import SendQueueMiddleware
+
+
+class _FakeTelegram:
+    # Записывает, что ушло в Telegram; отправку можно придержать, чтобы за ней выстроилась очередь
+    def __init__(self):
+        self.sent = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+        self.retry_after = {}
+
+    async def __call__(self, bot, method):
+        await self.gate.wait()
+        text = method.text
+        if self.retry_after.pop(text, None) is not None:
+            raise TelegramRetryAfter(method, "Too Many Requests", 0)
+        self.sent.append((method.__api_method__, text))
+        return text
+
+
+def _middleware() -> SendQueueMiddleware:
+    return SendQueueMiddleware(global_rate=1000, chat_rate=1000, group_rate=1000)
+
+
+def test_messages_of_one_chat_go_out_in_order():
+    async def run():
+        middleware = _middleware()
+        telegram = _FakeTelegram()
+        tasks = [
+            asyncio.create_task(middleware(telegram, None, SendMessage(chat_id=1, text=str(number))))
+            for number in range(10)
+        ]
+        await asyncio.gather(*tasks)
+        return telegram.sent
+
+    assert asyncio.run(run()) == [("sendMessage", str(number)) for number in range(10)]
+
+
+def test_stale_edits_are_collapsed_into_the_latest():
+    async def run():
+        middleware = _middleware()
+        telegram = _FakeTelegram()
+        # Пока первое сообщение «отправляется», к другому копятся правки
+        telegram.gate.clear()
+        first = asyncio.create_task(middleware(telegram, None, SendMessage(chat_id=1, text="ответ")))
+        await asyncio.sleep(0)
+        edits = []
+        for text in ("черновик 1", "черновик 2", "готово"):
+            edits.append(asyncio.create_task(
+                middleware(telegram, None, EditMessageText(chat_id=1, message_id=7, text=text))
+            ))
+            await asyncio.sleep(0)
+        telegram.gate.set()
+        await first
+        return telegram.sent, await asyncio.gather(*edits)
+
+    sent, results = asyncio.run(run())
+    # Ушла только последняя правка, а все вызвавшие получили её результат
+    assert sent == [("sendMessage", "ответ"), ("editMessageText", "готово")]
+    assert results == ["готово"] * 3
+
+
+def test_edits_of_different_messages_are_not_collapsed():
+    async def run():
+        middleware = _middleware()
+        telegram = _FakeTelegram()
+        telegram.gate.clear()
+        edits = [
+            asyncio.create_task(middleware(telegram, None, EditMessageText(chat_id=1, message_id=number, text=str(number))))
+            for number in (1, 2)
+        ]
+        await asyncio.sleep(0)
+        telegram.gate.set()
+        await asyncio.gather(*edits)
+        return telegram.sent
+
+    assert asyncio.run(run()) == [("editMessageText", "1"), ("editMessageText", "2")]
+
+
+def test_retry_after_keeps_the_chat_order():
+    async def run():
+        middleware = _middleware()
+        telegram = _FakeTelegram()
+        telegram.retry_after["1"] = True
+        await asyncio.gather(*(
+            middleware(telegram, None, SendMessage(chat_id=1, text=str(number))) for number in range(3)
+        ))
+        return telegram.sent
+
+    # Повтор после 429 не даёт следующим сообщениям обогнать первое
+    assert asyncio.run(run()) == [("sendMessage", "0"), ("sendMessage", "1"), ("sendMessage", "2")]
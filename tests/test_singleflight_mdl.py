@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+from singleflight_mdl import SingleFlight
+
+
+def test_concurrent_calls_share_one_backend_call():
+    async def run():
+        flight = SingleFlight("test")
+        calls = 0
+        release = asyncio.Event()
+
+        async def backend():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return "ответ"
+
+        waiters = [asyncio.create_task(flight.do("ключ", backend)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters)
+        return flight, calls, results
+
+    flight, calls, results = asyncio.run(run())
+    assert calls == 1
+    assert results == ["ответ"] * 5
+    assert flight.stats()["calls"] == 1
+    assert flight.stats()["shared"] == 4
+    assert flight.stats()["in_flight"] == 0
+    assert flight._waiters == {}
+
+
+def test_cancelled_waiter_does_not_cancel_the_others():
+    async def run():
+        flight = SingleFlight("test")
+        release = asyncio.Event()
+
+        async def backend():
+            await release.wait()
+            return "ответ"
+
+        first = asyncio.create_task(flight.do("ключ", backend))
+        second = asyncio.create_task(flight.do("ключ", backend))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        waiting = flight._waiters.get("ключ")
+        release.set()
+        result = await second
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return flight, waiting, result
+
+    flight, waiting, result = asyncio.run(run())
+    assert waiting == 1
+    assert result == "ответ"
+    assert flight._waiters == {}
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_last_waiter_leaving_cancels_the_backend_call():
+    async def run():
+        flight = SingleFlight("test")
+        cancelled = asyncio.Event()
+
+        async def backend():
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.create_task(flight.do("ключ", backend))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        return flight
+
+    flight = asyncio.run(run())
+    assert flight._waiters == {}
+    assert flight.stats()["in_flight"] == 0
+    # Отменённый вызов - не ошибка бэкенда
+    assert flight.stats()["errors"] == 0
+
+
+def test_error_reaches_every_waiter_and_is_counted_once():
+    async def run():
+        flight = SingleFlight("test")
+
+        async def backend():
+            await asyncio.sleep(0)
+            raise RuntimeError("бэкенд упал")
+
+        return flight, await asyncio.gather(
+            *(flight.do("ключ", backend) for _ in range(3)), return_exceptions=True
+        )
+
+    flight, results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert flight.stats()["errors"] == 1
+
+
+def test_stream_readers_get_the_whole_stream_from_one_call():
+    async def run():
+        flight = SingleFlight("test")
+        calls = 0
+
+        async def backend():
+            nonlocal calls
+            calls += 1
+            for chunk in ("раз ", "два ", "три"):
+                await asyncio.sleep(0)
+                yield chunk
+
+        async def read():
+            return "".join([chunk async for chunk in flight.stream("ключ", backend)])
+
+        texts = await asyncio.gather(read(), read())
+        return flight, calls, texts
+
+    flight, calls, texts = asyncio.run(run())
+    assert calls == 1
+    assert texts == ["раз два три"] * 2
+    assert flight._waiters == {}
+    assert flight._streams == {}
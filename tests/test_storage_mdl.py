@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+import cache_mdl
+import storage_mdl
+from database_mdl import Database
+from fake_services_mdl import FakeRedis
+from storage_mdl import create_fsm_storage, namespaced
+
+
+@pytest.fixture
+def redis_backend(monkeypatch):
+    # Общее состояние уходит в заглушку Redis, как при STORAGE_BACKEND=redis
+    monkeypatch.setattr(storage_mdl, "STORAGE_BACKEND", "redis")
+    monkeypatch.setattr(storage_mdl, "REDIS_URL", storage_mdl.REDIS_URL)
+    monkeypatch.setattr(storage_mdl, "_store", None)
+    return FakeRedis()
+
+
+def _run(fake: FakeRedis, check):
+    # Заглушка и клиент живут в одном цикле событий
+    async def main():
+        port = await fake.start()
+        storage_mdl.REDIS_URL = f"redis://127.0.0.1:{port}/0"
+        try:
+            await check()
+        finally:
+            await storage_mdl.close_store()
+            await fake.close()
+    asyncio.run(main())
+
+
+def test_query_mapping_is_shared_between_hosts(redis_backend, tmp_path):
+    async def check():
+        # Два процесса со своими файлами SQLite: кнопка под ответом работает на любом из них
+        first = Database(str(tmp_path / "first.db"), query_store=namespaced("query"))
+        second = Database(str(tmp_path / "second.db"), query_store=namespaced("query"))
+        try:
+            await first.save_query(1, 10, 100, "что такое RESP?")
+            assert await second.get_query(100, 10) == "что такое RESP?"
+            assert await second.get_query(999, 10) is None
+        finally:
+            await first.close()
+            await second.close()
+    _run(redis_backend, check)
+
+
+def test_tiered_cache_reads_other_process_entries(redis_backend):
+    async def check():
+        writer = cache_mdl.TieredCache("shared_test", ttl=60)
+        reader = cache_mdl.TieredCache("shared_test", ttl=60)
+        try:
+            await writer.set("ключ", "значение")
+            assert await reader.get("ключ") == "значение"
+            assert reader.persistent_hits == 1
+            assert await reader.get("нет такого") is None
+        finally:
+            cache_mdl._tiered_caches.remove(writer)
+            cache_mdl._tiered_caches.remove(reader)
+    _run(redis_backend, check)
+    assert any(key.startswith(b"yaly:cache:shared_test:") for key in redis_backend.data)
+
+
+def test_fsm_state_round_trip(redis_backend):
+    async def check():
+        storage = create_fsm_storage()
+        key = StorageKey(bot_id=1, chat_id=10, user_id=20)
+        await storage.set_state(key, "Form:waiting_period")
+        await storage.set_data(key, {"period": "week"})
+        # Другой процесс с тем же Redis видит то же состояние
+        other = create_fsm_storage()
+        assert await other.get_state(key) == "Form:waiting_period"
+        assert await other.get_data(key) == {"period": "week"}
+        await storage.set_state(key, None)
+        assert await other.get_state(key) is None
+    _run(redis_backend, check)
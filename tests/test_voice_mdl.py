@@ -0,0 +1,57 @@
+import asyncio
+import io
+import math
+import struct
+import wave
+
+import pytest
+
+import voice_mdl
+from audio_prep_mdl import decode_and_split, shutdown_pool, KEEP_SILENCE_MS, SAMPLE_RATE, SAMPLE_WIDTH, TARGET_CHUNK_MS
+
+
+def _synthetic_wav(pattern: list[tuple[float, bool]], rate: int = 8000) -> bytes:
+    # Тон 440 Гц там, где "речь", и тишина в паузах
+    frames = bytearray()
+    position = 0
+    for seconds, voiced in pattern:
+        for _ in range(int(seconds * rate)):
+            sample = int(12000 * math.sin(2 * math.pi * 440 * position / rate)) if voiced else 0
+            frames += struct.pack("<h", sample)
+            position += 1
+    output = io.BytesIO()
+    with wave.open(output, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(bytes(frames))
+    return output.getvalue()
+
+
+@pytest.fixture
+def stub_transcriber():
+    voice_mdl.set_transcriber(voice_mdl.TRANSCRIBERS["stub"])
+    yield
+    voice_mdl.set_transcriber(None)
+    shutdown_pool()
+
+
+def test_wav_is_split_by_pauses_and_transcribed_by_stub(stub_transcriber):
+    # Две фразы по 2 с через паузу длиннее VOICE_CHUNK_SECONDS: склеивать их нельзя
+    pause = TARGET_CHUNK_MS / 1000 + 1
+    wav = _synthetic_wav([(0.5, False), (2, True), (pause, False), (2, True), (0.5, False)])
+
+    async def run():
+        chunks = await decode_and_split(wav, "wav")
+        return chunks, await voice_mdl.transcribe_chunks(chunks)
+
+    chunks, text = asyncio.run(run())
+    assert [start for start, _ in chunks] == [500 - KEEP_SILENCE_MS, 500 + 2000 + int(pause * 1000) - KEEP_SILENCE_MS]
+    seconds = [len(pcm) / (SAMPLE_RATE * SAMPLE_WIDTH) for _, pcm in chunks]
+    assert seconds == [2 + 2 * KEEP_SILENCE_MS / 1000] * 2
+    assert text == "фрагмент 2.4 с фрагмент 2.4 с"
+
+
+def test_silent_wav_has_no_chunks(stub_transcriber):
+    chunks = asyncio.run(decode_and_split(_synthetic_wav([(1, False)]), "wav"))
+    assert chunks == []